@@ -81,7 +81,9 @@ class DVSAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
         self.iter_num = 0
 
         self.network_map = dvs_util.create_network_map_from_config(
-            cfg.CONF.ML2_VMWARE, pg_cache=True)
+            cfg.CONF.ML2_VMWARE, pg_cache=True,
+            port_index=cfg.CONF.DVS.use_port_index,
+            task_tracker=cfg.CONF.DVS.use_task_tracker)
         uplink_map = dvs_util.create_uplink_map_from_config(
             cfg.CONF.ML2_VMWARE, self.network_map)
         for phys, dvs in six.iteritems(self.network_map):
@@ -94,10 +96,21 @@ class DVSAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
         self.booked_ports = set()
         LOG.info(_LI("Agent out of sync with plugin!"))
         connected_ports = self._get_dvs_ports()
-        self.added_ports = connected_ports
-        if cfg.CONF.DVS.clean_on_restart:
+        # Ports filtered before the restart are only refreshed, in the
+        # background, the others are set up like new ports.
+        restored_ports = self.sg_agent.restore_devices_filter(
+            connected_ports)
+        self.added_ports = connected_ports - (restored_ports or set())
+        self.known_ports |= restored_ports or set()
+        if (cfg.CONF.DVS.clean_on_restart and
+                restored_ports != connected_ports):
             self._clean_up_vsphere_extra_resources(connected_ports)
         self.fullsync = False
+        self.last_port_sync = time.time()
+        self.port_monitor = cfg.CONF.DVS.use_port_monitor
+        if self.port_monitor:
+            for dvs in self.network_map.values():
+                dvs.start_port_monitor(self._dvs_ports_changed)
 
         # The initialization is complete; we can start receiving messages
         self.connection.consume_in_threads()
@@ -315,7 +328,10 @@ class DVSAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
                 if cfg.CONF.DVS.clean_on_restart:
                     self._clean_up_vsphere_extra_resources(connected_ports)
                 self.fullsync = False
+                self.last_port_sync = time.time()
                 polling_manager.force_polling()
+            elif self._port_sync_required():
+                self._sync_connected_ports()
             if self._agent_has_updates(polling_manager):
                 LOG.debug("Agent rpc_loop - update")
                 self.process_ports()
@@ -328,7 +344,45 @@ class DVSAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
     def _agent_has_updates(self, polling_manager):
         return (polling_manager.is_polling_required or
                 self.sg_agent.firewall_refresh_needed() or
-                self.updated_ports or self.deleted_ports)
+                self.added_ports or self.updated_ports or
+                self.deleted_ports)
+
+    def _port_sync_required(self):
+        interval = cfg.CONF.DVS.port_full_sync_interval
+        return (self.port_monitor and interval > 0 and
+                time.time() - self.last_port_sync >= interval)
+
+    def _sync_connected_ports(self):
+        """Find the connected ports the port monitors missed."""
+        LOG.debug("Sync connected ports")
+        missed_ports = self._get_dvs_ports() - self.known_ports
+        if missed_ports:
+            LOG.info(_LI("Found connected ports %s missed by the port "
+                         "monitor."), missed_ports)
+            self.added_ports |= missed_ports
+        self.last_port_sync = time.time()
+
+    def _dvs_ports_changed(self, added, removed):
+        """Sync the ports connected to or disconnected from a DVS.
+
+        The port groups reset the configuration of their ports at
+        disconnect, so the rules of the known ports are applied again. A
+        disconnected port keeps its filter and its DVS port, they are only
+        removed by port_delete.
+        """
+        reset = set()
+        for port_id in added:
+            if port_id in self.known_ports:
+                reset.add(port_id)
+            else:
+                self.added_ports.add(port_id)
+        for port_id in removed:
+            if port_id in self.known_ports:
+                reset.add(port_id)
+            else:
+                self.added_ports.discard(port_id)
+        self.sg_agent.reset_devices_filter(reset)
+        self.updated_ports |= reset
 
     def loop_count_and_wait(self, start_time):
         # sleep till end of polling interval
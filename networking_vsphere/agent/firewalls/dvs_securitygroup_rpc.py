@@ -13,16 +13,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+import time
+
 from oslo_log import log as logging
-from threading import Timer
 
-from networking_vsphere._i18n import _LI
+from networking_vsphere._i18n import _LE, _LI
+from networking_vsphere.common import vmware_conf as config
 from networking_vsphere.utils.rpc_translator import update_rules
 from neutron.agent import securitygroups_rpc
 
 
 LOG = logging.getLogger(__name__)
 
+CONF = config.CONF
+
 
 class DVSSecurityGroupRpc(securitygroups_rpc.SecurityGroupAgentRpc):
 
@@ -31,6 +36,11 @@ class DVSSecurityGroupRpc(securitygroups_rpc.SecurityGroupAgentRpc):
         self.context = context
         self.plugin_rpc = plugin_rpc
         self._devices_to_update = set()
+        # Guards _devices_to_update and the times of the pending refresh.
+        self._refresh_lock = threading.Condition()
+        self._first_refresh_request = None
+        self._last_refresh_request = None
+        self._refresher = None
         self.init_firewall(defer_refresh_firewall)
 
     def prepare_devices_filter(self, device_ids):
@@ -53,22 +63,103 @@ class DVSSecurityGroupRpc(securitygroups_rpc.SecurityGroupAgentRpc):
         LOG.info(_LI("Remove device filter for %r"), device_ids)
         self.firewall.remove_port_filter(device_ids)
 
-    def _refresh_ports(self):
-        device_ids = self._devices_to_update
-        self._devices_to_update = self._devices_to_update - device_ids
-        if not device_ids:
-            return
+    def restore_devices_filter(self, device_ids):
+        """Filter the devices again from the firewall state snapshot.
+
+        Returns the restored devices, None when the firewall keeps no
+        snapshot. Their rules are refreshed in the background.
+        """
+        restore_port_filter = getattr(self.firewall, 'restore_port_filter',
+                                      None)
+        if not restore_port_filter:
+            return None
+        restored = restore_port_filter(device_ids)
+        if restored:
+            self.refresh_firewall(restored)
+        return restored
+
+    def reset_devices_filter(self, device_ids):
+        """Apply the rules of the devices again on their next refresh."""
+        reset_port_filter = getattr(self.firewall, 'reset_port_filter', None)
+        if reset_port_filter and device_ids:
+            reset_port_filter(device_ids)
+
+    def _refresh_ports(self, device_ids):
         if self.use_enhanced_rpc:
             devices_info = self.plugin_rpc.security_group_info_for_devices(
-                self.context, device_ids)
+                self.context, list(device_ids))
             devices = update_rules(devices_info)
         else:
             devices = self.plugin_rpc.security_group_rules_for_devices(
-                self.context, device_ids)
+                self.context, list(device_ids))
         self.firewall.update_port_filter(devices.values())
 
     def refresh_firewall(self, device_ids=None):
+        """Refresh the filters of the devices, of all devices by default.
+
+        Refreshes requested close together are merged and run by a single
+        thread, once no request came for firewall_refresh_quiet_period or
+        the first one waited for firewall_refresh_max_delay.
+        """
         LOG.info(_LI("Refresh firewall rules"))
-        self._devices_to_update |= device_ids
-        if device_ids:
-            Timer(2, self._refresh_ports).start()
+        if device_ids is None:
+            device_ids = set(self.firewall.ports)
+        if not device_ids:
+            return
+        with self._refresh_lock:
+            now = time.time()
+            if not self._devices_to_update:
+                self._first_refresh_request = now
+            self._last_refresh_request = now
+            self._devices_to_update |= set(device_ids)
+            self._refresh_lock.notify_all()
+            if self._refresher is None:
+                self._refresher = threading.Thread(
+                    target=self._refresh_loop, name='dvs-firewall-refresh')
+                self._refresher.daemon = True
+                self._refresher.start()
+
+    def _get_refresh_deadline(self):
+        """Must be called with _refresh_lock held."""
+        return min(
+            self._last_refresh_request +
+            CONF.DVS.firewall_refresh_quiet_period,
+            self._first_refresh_request +
+            CONF.DVS.firewall_refresh_max_delay)
+
+    def _wait_for_refresh(self):
+        """Return the devices to refresh once their refresh is due."""
+        with self._refresh_lock:
+            while True:
+                if not self._devices_to_update:
+                    self._refresh_lock.wait()
+                    continue
+                timeout = self._get_refresh_deadline() - time.time()
+                if timeout <= 0:
+                    break
+                self._refresh_lock.wait(timeout)
+            device_ids = self._devices_to_update
+            self._devices_to_update = set()
+            return device_ids
+
+    def _refresh_devices(self, device_ids):
+        """Refresh the devices, one bounded chunk per RPC."""
+        device_ids = sorted(device_ids)
+        chunk_size = CONF.DVS.firewall_refresh_chunk_size
+        for i in range(0, len(device_ids), chunk_size):
+            chunk = device_ids[i:i + chunk_size]
+            try:
+                self._refresh_ports(chunk)
+            except Exception:
+                LOG.exception(_LE("Unable to refresh the filters of devices "
+                                  "%s, retrying."), chunk)
+                with self._refresh_lock:
+                    if not self._devices_to_update:
+                        self._first_refresh_request = time.time()
+                    self._last_refresh_request = time.time()
+                    self._devices_to_update.update(device_ids[i:])
+                return
+
+    def _refresh_loop(self):
+        while True:
+            self._refresh_devices(self._wait_for_refresh())
@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 from multiprocessing import Process
 from multiprocessing import Queue
 import signal
@@ -25,9 +26,10 @@ from neutron.agent import firewall
 from oslo_log import log as logging
 from oslo_vmware import exceptions as vmware_exceptions
 
-from networking_vsphere._i18n import _LI
+from networking_vsphere._i18n import _LE, _LI
 from networking_vsphere.common import exceptions
 from networking_vsphere.common import vmware_conf as config
+from networking_vsphere.utils import dvs_state_store
 from networking_vsphere.utils import dvs_util
 from networking_vsphere.utils import security_group_utils as sg_util
 
@@ -36,6 +38,18 @@ LOG = logging.getLogger(__name__)
 
 CONF = config.CONF
 CLEANUP_REMOVE_TASKS_TIMEDELTA = 60
+INITIAL_BATCH_SIZE = 5
+# Weight of the last task in the average task latency of a DVS.
+LATENCY_SMOOTHING = 0.3
+# Seconds between checks of the queues fed by the agent process.
+QUEUE_POLL_INTERVAL = 0.1
+# Seconds the idle updater waits for new tasks before checking the pending
+# removals again.
+IDLE_WAIT_INTERVAL = 1
+# Seconds between two logs of the queue stats while there is activity.
+STATS_LOG_INTERVAL = 60
+# Failed tasks a port update or removal is put back into the queue after.
+TASK_RETRIES = 5
 
 
 def firewall_main(list_queues, remove_queue):
@@ -49,20 +63,33 @@ class DVSFirewallUpdater(object):
     def __init__(self, list_queues, remove_queue):
         self.pq = PortQueue(list_queues, remove_queue)
         self.run_daemon_loop = True
-        self.pq.port_updater_loop()
+        self.pq.start()
 
     def updater_loop(self):
         while self.run_daemon_loop:
             try:
+                self.pq.log_stats()
                 dvs, r_ports = self.pq.get_remove_tasks()
                 if dvs and r_ports:
-                    remover(dvs, r_ports)
+                    try:
+                        remover(dvs, r_ports)
+                    except Exception:
+                        self.pq.requeue_remove_tasks(dvs, r_ports)
+                        raise
 
                 dvs, ports = self.pq.get_update_tasks()
                 if dvs and ports:
-                    updater(dvs, ports)
+                    start = time.time()
+                    try:
+                        updater(dvs, ports)
+                    except Exception:
+                        self.pq.record_failure(dvs)
+                        self.pq.requeue_update_tasks(dvs, ports)
+                        raise
+                    self.pq.record_update(dvs, len(ports),
+                                          time.time() - start)
                 else:
-                    time.sleep(1)
+                    self.pq.wait_for_tasks(IDLE_WAIT_INTERVAL)
             except (vmware_exceptions.VMwareDriverException,
                     exceptions.VMWareDVSException) as e:
                 LOG.debug("Exception was handled in firewall updater: %s. "
@@ -74,87 +101,287 @@ class DVSFirewallUpdater(object):
 
 
 class PortQueue(object):
+    """Pending port updates and removals of the firewall updater.
+
+    Updates are kept per DVS in arrival order and keyed by port id, a newer
+    update of a port replaces the pending one in place. A removal drops the
+    pending update of its port, updates of the port arriving within
+    CLEANUP_REMOVE_TASKS_TIMEDELTA seconds are ignored.
+
+    The DVSs with pending updates are served round robin. The number of
+    ports handed out per DVS follows the latency of its previous tasks.
+    The ports of a failed task are put back at the end of the queue, up to
+    TASK_RETRIES times.
+    """
+
     def __init__(self, list_queues, remove_queue):
         self.list_queues = list_queues
         self.remove_queue = remove_queue
         self.removed = {}
+        # dvs -> OrderedDict of port id -> port
         self.update_store = {}
         self.remove_store = {}
+        # DVSs with pending updates, in serving order.
+        self._ready = collections.deque()
+        # dvs -> batch_size and average latency of its update tasks
+        self._stats = {}
+        self._stats_logged = time.time()
+        self._updates_since_log = 0
+        self._lock = threading.Lock()
+        self._new_tasks = threading.Event()
         self.networking_map = dvs_util.create_network_map_from_config(
-            CONF.ML2_VMWARE)
-
-    # Todo: add roundrobin for active DVS. SlOPS
-    def get_update_tasks(self, number=5):
-        for dvs, tasks in six.iteritems(self.update_store):
-            if tasks:
-                ret = tasks[:number]
-                self.update_store[dvs] = tasks[number:]
+            CONF.ML2_VMWARE, task_tracker=CONF.DVS.use_task_tracker)
+        self.routing_table = dvs_util.DVSRoutingTable(
+            self.networking_map.values())
+        if CONF.DVS.use_state_snapshot:
+            state_store = dvs_state_store.StateStore(
+                CONF.DVS.state_snapshot_path)
+            for dvs in self.networking_map.values():
+                dvs.load_applied_rules(state_store)
+
+    def start(self):
+        feeder = threading.Thread(target=self.port_updater_loop,
+                                  name='firewall-port-queue')
+        feeder.daemon = True
+        feeder.start()
+
+    def wait_for_tasks(self, timeout):
+        """Block until tasks are queued or the timeout expires."""
+        with self._lock:
+            if any(six.itervalues(self.update_store)):
+                return
+        self._new_tasks.wait(timeout)
+        self._new_tasks.clear()
+
+    def get_update_tasks(self, number=None):
+        with self._lock:
+            while self._ready:
+                dvs = self._ready.popleft()
+                tasks = self.update_store.get(dvs)
+                if not tasks:
+                    continue
+                if number is None:
+                    number = self._get_stats(dvs)['batch_size']
+                ret = []
+                while tasks and len(ret) < number:
+                    ret.append(tasks.popitem(last=False)[1])
+                if tasks:
+                    self._ready.append(dvs)
                 return dvs, ret
         return None, []
 
+    @staticmethod
+    def _count_retry(task):
+        """Return whether the task of a failed batch is to be retried."""
+        task['retries'] = task.get('retries', 0) + 1
+        if task['retries'] > TASK_RETRIES:
+            LOG.error(_LE("Giving up the firewall task of port %(id)s after "
+                          "%(count)s failures."),
+                      {'id': task['id'], 'count': TASK_RETRIES})
+            return False
+        return True
+
+    def requeue_update_tasks(self, dvs, ports):
+        """Put back the port updates of a failed task.
+
+        Ports removed or with a newer pending update are left out, the
+        newer update keeps a reset_rules flag of the failed one.
+        """
+        with self._lock:
+            stored_tasks = self.update_store.setdefault(
+                dvs, collections.OrderedDict())
+            for port in ports:
+                if port['id'] in self.removed:
+                    continue
+                stored = stored_tasks.get(port['id'])
+                if stored is not None:
+                    if port.get('reset_rules'):
+                        stored['reset_rules'] = True
+                elif self._count_retry(port):
+                    stored_tasks[port['id']] = port
+            if stored_tasks and dvs not in self._ready:
+                self._ready.append(dvs)
+        self._new_tasks.set()
+
+    def requeue_remove_tasks(self, dvs, ports):
+        """Put back the port removals of a failed task."""
+        with self._lock:
+            stored_tasks = self.remove_store.setdefault(dvs, [])
+            pending = set(task['id'] for task in stored_tasks)
+            stored_tasks.extend(port for port in ports
+                                if port['id'] not in pending and
+                                self._count_retry(port))
+
+    def _get_stats(self, dvs):
+        """Must be called with _lock held."""
+        return self._stats.setdefault(
+            dvs, {'batch_size': INITIAL_BATCH_SIZE, 'latency': None})
+
+    def record_update(self, dvs, count, elapsed):
+        """Adapt the batch size of a DVS to the latency of its task.
+
+        The size aims at tasks of firewall_batch_target_latency seconds. It
+        grows at most twofold per task, and only after full batches. Only
+        successful tasks are recorded, see record_failure.
+        """
+        with self._lock:
+            self._updates_since_log += count
+            stats = self._get_stats(dvs)
+            if stats['latency'] is None:
+                stats['latency'] = elapsed
+            else:
+                stats['latency'] += LATENCY_SMOOTHING * (
+                    elapsed - stats['latency'])
+            target = CONF.DVS.firewall_batch_target_latency
+            if elapsed > target or count >= stats['batch_size']:
+                size = int(count * target / max(elapsed, 0.001))
+                stats['batch_size'] = max(1, min(
+                    size, 2 * stats['batch_size'],
+                    CONF.DVS.firewall_batch_size_cap))
+        LOG.debug("Updated %(count)s ports of DVS %(dvs)s in %(time).2f "
+                  "seconds, queue stats: %(stats)s",
+                  {'count': count, 'dvs': dvs.dvs_name, 'time': elapsed,
+                   'stats': self.get_stats().get(dvs.dvs_name)})
+
+    def record_failure(self, dvs):
+        """Halve the batch size of a DVS after a failed task.
+
+        A failed task says nothing of the latency of the next ones, and may
+        have failed for being too large.
+        """
+        with self._lock:
+            stats = self._get_stats(dvs)
+            stats['batch_size'] = max(1, stats['batch_size'] // 2)
+        LOG.debug("Update of DVS %(dvs)s failed, batch size lowered to "
+                  "%(size)s.", {'dvs': dvs.dvs_name,
+                                'size': stats['batch_size']})
+
+    def log_stats(self):
+        """Log the queue stats every STATS_LOG_INTERVAL seconds.
+
+        Nothing is logged while the queues stay empty and idle.
+        """
+        now = time.time()
+        interval = now - self._stats_logged
+        if interval < STATS_LOG_INTERVAL:
+            return
+        with self._lock:
+            updates, self._updates_since_log = self._updates_since_log, 0
+        self._stats_logged = now
+        stats = self.get_stats()
+        if updates or any(dvs_stats['update_queue_depth'] or
+                          dvs_stats['remove_queue_depth']
+                          for dvs_stats in six.itervalues(stats)):
+            LOG.info(_LI("Firewall updated %(count)s ports in the last "
+                         "%(interval)d seconds, queue stats per DVS: "
+                         "%(stats)s"),
+                     {'count': updates, 'interval': interval,
+                      'stats': stats})
+
+    def get_stats(self):
+        """Return the queue depths and task latency per DVS name."""
+        with self._lock:
+            dvss = set(self.update_store) | set(self.remove_store)
+            return dict((dvs.dvs_name, {
+                'update_queue_depth': len(self.update_store.get(dvs, ())),
+                'remove_queue_depth': len(self.remove_store.get(dvs, ())),
+                'batch_size': self._get_stats(dvs)['batch_size'],
+                'latency': self._get_stats(dvs)['latency']})
+                for dvs in dvss)
+
     def get_remove_tasks(self):
-        ret = []
-        for dvs, tasks in six.iteritems(self.remove_store):
-            for task in tasks:
-                key = task.get('binding:vif_details', {}).get('dvs_port_key')
-                if dvs.check_free(key):
-                    ret.append(task)
-                    self.remove_store[dvs].remove(task)
+        with self._lock:
+            remove_store = [(dvs, list(tasks)) for dvs, tasks
+                            in six.iteritems(self.remove_store) if tasks]
+        for dvs, tasks in remove_store:
+            # One lookup of the connected ports for all pending removals.
+            port_keys = set(self._get_port_key(task) for task in tasks)
+            port_keys.discard(None)
+            connected_keys = dvs.get_connected_port_keys(port_keys)
+            ret = [task for task in tasks
+                   if self._get_port_key(task) not in connected_keys]
             if ret:
+                returned = set(id(task) for task in ret)
+                with self._lock:
+                    self.remove_store[dvs] = [
+                        task for task in self.remove_store[dvs]
+                        if id(task) not in returned]
                 return dvs, ret
         return None, []
 
+    @staticmethod
+    def _get_port_key(port):
+        return port.get('binding:vif_details', {}).get('dvs_port_key')
+
     def _get_update_tasks(self):
+        count = 0
         for queue in self.list_queues:
             while not queue.empty():
                 request = queue.get()
                 for port in request:
+                    if port['id'] in self.removed:
+                        continue
                     dvs = self.get_dvs(port)
                     if dvs:
-                        stored_tasks = self.update_store.get(dvs, [])
-                        index = next((i for i, p in enumerate(stored_tasks)
-                                      if p['id'] == port['id']), None)
-                        if index is not None:
-                            stored_tasks[index] = port
-                        else:
-                            stored_tasks.append(port)
-                        self.update_store[dvs] = stored_tasks
+                        with self._lock:
+                            stored_tasks = self.update_store.setdefault(
+                                dvs, collections.OrderedDict())
+                            stored = stored_tasks.get(port['id'])
+                            if stored and stored.get('reset_rules'):
+                                port['reset_rules'] = True
+                            stored_tasks[port['id']] = port
+                            if dvs not in self._ready:
+                                self._ready.append(dvs)
+                        count += 1
+        return count
 
     def _get_remove_tasks(self):
+        count = 0
         while not self.remove_queue.empty():
             port = self.remove_queue.get()
             dvs = self.get_dvs(port)
             if dvs:
-                self.remove_store.setdefault(dvs, []).append(port)
+                with self._lock:
+                    self.remove_store.setdefault(dvs, []).append(port)
+                    for stored_tasks in six.itervalues(self.update_store):
+                        stored_tasks.pop(port['id'], None)
                 self.removed[port['id']] = time.time()
+                count += 1
+        return count
 
     def _cleanup_removed(self):
         current_time = time.time()
-        for port_id, remove_time in self.removed.items():
+        for port_id, remove_time in list(self.removed.items()):
             if current_time - remove_time > CLEANUP_REMOVE_TASKS_TIMEDELTA:
                 del self.removed[port_id]
 
     def get_dvs(self, port):
         dvs_uuid = port.get('binding:vif_details', {}).get('dvs_id')
         if dvs_uuid:
-            dvs = dvs_util.get_dvs_by_uuid(
-                self.networking_map.values(), dvs_uuid)
+            dvs = self.routing_table.get_dvs_by_uuid(dvs_uuid)
         else:
             port_network = port['network_id']
             port_network_name = port.get('binding:vif_details', {}).get(
                 'dvs_port_group_name')
-            dvs = dvs_util.get_dvs_by_network(
-                self.networking_map.values(), port_network, port_network_name)
+            dvs = self.routing_table.get_dvs_by_network(
+                port_network, port_network_name)
         return dvs
 
     def port_updater_loop(self):
-        self._get_update_tasks()
-        self._get_remove_tasks()
-        for dvs in self.update_store:
-            self.update_store[dvs] = [item for item in self.update_store[dvs]
-                                      if item['id'] not in self.removed]
-        self._cleanup_removed()
-        threading.Timer(1, self.port_updater_loop).start()
+        # The multiprocessing queues can not be waited on by a green
+        # thread without blocking the process, they are checked often
+        # instead and the updater is woken up as soon as tasks are queued.
+        while True:
+            try:
+                # Removals first, updates queued before them are dropped.
+                queued = self._get_remove_tasks()
+                queued += self._get_update_tasks()
+                if queued:
+                    self._new_tasks.set()
+                self._cleanup_removed()
+            except Exception:
+                LOG.exception(_LE("Unable to queue firewall port tasks."))
+            time.sleep(QUEUE_POLL_INTERVAL)
 
 
 @dvs_util.wrap_retry
@@ -163,15 +390,16 @@ def updater(dvs, port_list):
 
 
 def remover(dvs, ports_list):
-    for port in ports_list:
-        if dvs:
-            dvs.release_port(port)
+    if dvs:
+        dvs.release_ports(ports_list)
 
 
 class DVSFirewallDriver(firewall.FirewallDriver):
     """DVS Firewall Driver. """
     def __init__(self):
         self.dvs_ports = {}
+        # Devices whose rules are applied again even if they did not change.
+        self._reset_devices = set()
         self._defer_apply = False
         self.list_queues = []
         for x in six.moves.range(10):
@@ -181,19 +409,25 @@ class DVSFirewallDriver(firewall.FirewallDriver):
             target=firewall_main, args=(self.list_queues, self.remove_queue))
         self.fw_process.start()
         self.networking_map = dvs_util.create_network_map_from_config(
-            CONF.ML2_VMWARE)
+            CONF.ML2_VMWARE, port_index=CONF.DVS.use_port_index,
+            task_tracker=CONF.DVS.use_task_tracker)
+        self.routing_table = dvs_util.DVSRoutingTable(
+            self.networking_map.values())
+        self.state_store = None
+        if CONF.DVS.use_state_snapshot:
+            self.state_store = dvs_state_store.StateStore(
+                CONF.DVS.state_snapshot_path)
 
     def _get_port_dvs(self, port):
         dvs_uuid = port.get('binding:vif_details', {}).get('dvs_id')
         if dvs_uuid:
-            dvs = dvs_util.get_dvs_by_uuid(
-                self.networking_map.values(), dvs_uuid)
+            dvs = self.routing_table.get_dvs_by_uuid(dvs_uuid)
         else:
             port_network = port['network_id']
             port_network_name = port.get('binding:vif_details', {}).get(
                 'dvs_port_group_name')
-            dvs = dvs_util.get_dvs_by_network(
-                self.networking_map.values(), port_network, port_network_name)
+            dvs = self.routing_table.get_dvs_by_network(
+                port_network, port_network_name)
         return dvs
 
     def stop_all(self):
@@ -222,6 +456,11 @@ class DVSFirewallDriver(firewall.FirewallDriver):
                 if port_dvs:
                     try:
                         port_info = port_dvs.get_port_info(port)
+                        if port['id'] != port_info.config.name:
+                            # The port may have been booked by the agent
+                            # since the port index of the firewall saw it.
+                            port_info = port_dvs.get_port_info(
+                                port, refresh=True)
                         if port['id'] == port_info.config.name:
                             self.dvs_ports[port_device] = port
                             ports_for_update.append(port)
@@ -234,15 +473,61 @@ class DVSFirewallDriver(firewall.FirewallDriver):
             else:
                 self.dvs_ports[port_device] = port
                 ports_for_update.append(port)
+        if self.state_store:
+            self.state_store.set_ports(
+                [self._get_snapshot_port(port) for port in ports_for_update])
         self._apply_sg_rules_for_port(ports_for_update)
 
     def remove_port_filter(self, ports):
         LOG.info(_LI("Remove ports with rules"))
+        removed = []
         for p_id in ports:
             port = self.dvs_ports.get(p_id)
             if port:
                 self.remove_queue.put(port)
                 self.dvs_ports.pop(p_id, None)
+                removed.append(p_id)
+        if self.state_store and removed:
+            self.state_store.remove_ports(removed)
+
+    def restore_port_filter(self, devices):
+        """Filter the devices again from the state snapshot.
+
+        Returns the restored devices, None without a snapshot. The stored
+        devices not given are dropped from the snapshot, they are set up
+        again once they show up.
+        """
+        if not self.state_store:
+            return None
+        restored = set()
+        dropped = []
+        for device, port in six.iteritems(self.state_store.get_ports()):
+            if device in devices:
+                self.dvs_ports[device] = port
+                restored.add(device)
+            else:
+                dropped.append(device)
+        if dropped:
+            self.state_store.remove_ports(dropped)
+        LOG.info(_LI("Restored filters of %(restored)d devices from the "
+                     "state snapshot, dropped %(dropped)d."),
+                 {'restored': len(restored), 'dropped': len(dropped)})
+        return restored
+
+    def reset_port_filter(self, devices):
+        """Apply the rules of the devices again on their next update.
+
+        For ports whose configuration was reset on the DVS, like on
+        disconnect, while their rules did not change.
+        """
+        self._reset_devices.update(devices)
+
+    @staticmethod
+    def _get_snapshot_port(port):
+        return {'id': port['id'],
+                'device': port['device'],
+                'network_id': port['network_id'],
+                'binding:vif_details': port.get('binding:vif_details', {})}
 
     @property
     def ports(self):
@@ -255,9 +540,13 @@ class DVSFirewallDriver(firewall.FirewallDriver):
                 {u'ethertype': u'IPv6', u'direction': u'ingress',
                  u'source_ip_prefix': u'::/0', u'protocol': u'ipv6-icmp'})
             port = sg_util.filter_port_sg_rules_by_ethertype(port)
-            queue.put([{'id': port['id'], 'network_id': port['network_id'],
-                        'security_group_rules': port['security_group_rules'],
-                        'binding:vif_details': port['binding:vif_details']}])
+            request = {'id': port['id'], 'network_id': port['network_id'],
+                       'security_group_rules': port['security_group_rules'],
+                       'binding:vif_details': port['binding:vif_details']}
+            if port['device'] in self._reset_devices:
+                self._reset_devices.discard(port['device'])
+                request['reset_rules'] = True
+            queue.put([request])
 
     def _get_free_queue(self):
         shortest_queue = self.list_queues[0]
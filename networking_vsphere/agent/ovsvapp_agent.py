@@ -155,6 +155,8 @@ class OVSvAppAgent(agent.Agent, ovs_agent.OVSNeutronAgent):
         self.firewall_driver = CONF.SECURITYGROUP.ovsvapp_firewall_driver
         self.agent_uuid_stamp = uuid.uuid4().int & UINT64_BITMASK
         self.ovsvapp_agent_restarted = False
+        self.sec_br_flows = []
+        self.stale_flows_cleanup_time = None
         if not self.check_ovsvapp_agent_restart():
             self.setup_integration_br()
             LOG.info(_LI("Integration bridge successfully setup."))
@@ -176,6 +178,8 @@ class OVSvAppAgent(agent.Agent, ovs_agent.OVSNeutronAgent):
         self.sg_agent = sgagent.OVSvAppSecurityGroupAgent(self.context,
                                                           self.ovsvapp_sg_rpc,
                                                           defer_apply)
+        if self.sec_br_flows:
+            self.recover_port_flows()
         if self.monitor_log:
             self.monitor_log.info(_LI("ovs: ok"))
 
@@ -305,8 +309,47 @@ class OVSvAppAgent(agent.Agent, ovs_agent.OVSNeutronAgent):
                           "Security enabled on this agent. "
                           "Terminating the agent!"))
             raise SystemExit(1)
+        # Flows of the ports and of their shared rule sets are kept,
+        # remember them so that the firewall only sends the difference once
+        # the ports are found again.
+        for table in (ovsvapp_const.SG_DEFAULT_TABLE_ID,
+                      ovsvapp_const.SG_EGRESS_TABLE_ID,
+                      ovsvapp_const.SG_INGRESS_RULES_TABLE_ID,
+                      ovsvapp_const.SG_EGRESS_RULES_TABLE_ID):
+            flows = self.sec_br.dump_flows_for_table(table)
+            if flows:
+                self.sec_br_flows.extend(
+                    item for item in flows.splitlines()
+                    if 'cookie=' in item)
         LOG.info(_LI("Security bridge successfully recovered."))
 
+    def recover_port_flows(self):
+        """Hand the recovered security bridge flows to the firewall."""
+        firewall = self.sg_agent.firewall
+        if hasattr(firewall, 'recover_port_flows'):
+            firewall.recover_port_flows(self.sec_br_flows)
+            self.stale_flows_cleanup_time = (
+                time.time() + CONF.SECURITYGROUP.stale_flows_cleanup_delay)
+        self.sec_br_flows = []
+
+    def _remove_stale_recovered_flows(self):
+        """Remove the recovered flows no port claimed since the restart.
+
+        Waits until no firewall update is pending, so that the ports found
+        again since the restart have all been applied.
+        """
+        if (self.refresh_firewall_required or self.devices_to_filter or
+                self.sg_agent.firewall_refresh_needed() or
+                self.threadpool.running() or
+                self.sg_agent.t_pool.running()):
+            return
+        self.stale_flows_cleanup_time = None
+        try:
+            self.sg_agent.firewall.remove_stale_recovered_flows()
+        except Exception:
+            LOG.exception(_LE("Unable to remove the stale flows of the "
+                              "security bridge."))
+
     def recover_tunnel_bridge(self):
         """Recover the tunnel bridge."""
         self.patch_tun_ofport = self.int_br.get_port_ofport(
@@ -778,6 +821,9 @@ class OVSvAppAgent(agent.Agent, ovs_agent.OVSNeutronAgent):
         # Check if there are any pending port bindings to be made.
         if self.ports_to_bind:
             self._update_port_bindings()
+        if (self.stale_flows_cleanup_time and
+                time.time() >= self.stale_flows_cleanup_time):
+            self._remove_stale_recovered_flows()
 
     def check_for_updates(self):
         while self.run_check_for_updates:
@@ -103,6 +103,13 @@ class OVSvAppSecurityGroupAgent(sg_rpc.SecurityGroupAgentRpc):
     def expand_sg_rules(self, ports_info):
         ips = ports_info.get('member_ips')
         ports = ports_info.get('ports')
+        # A firewall rendering remote groups as conjunctive flows gets one
+        # rule carrying all member addresses instead of one rule per member.
+        use_conjunction = getattr(self.firewall, 'use_conjunction', False)
+        # Ports sharing rule tables need the same rules for the same groups,
+        # so their own addresses stay in the remote group members. Traffic
+        # of a port to itself never reaches the security bridge anyway.
+        shared_rules = getattr(self.firewall, 'use_shared_rule_tables', False)
         for port in ports.values():
             updated_rule = []
             for rule in port.get('sg_normal_rules'):
@@ -116,16 +123,23 @@ class OVSvAppSecurityGroupAgent(sg_rpc.SecurityGroupAgentRpc):
 
                 port['security_group_source_groups'].append(remote_group_id)
                 base_rule = rule
+                remote_ips = []
                 for ip in ips[remote_group_id]:
-                    if ip in port.get('fixed_ips', []):
+                    if not shared_rules and ip in port.get('fixed_ips', []):
                         continue
-                    ip_rule = base_rule.copy()
                     version = netaddr.IPNetwork(ip).version
                     ethertype = 'IPv%s' % version
                     if base_rule['ethertype'] != ethertype:
                         continue
-                    ip_rule[direction_ip_prefix] = str(
-                        netaddr.IPNetwork(ip).cidr)
+                    remote_ips.append(str(netaddr.IPNetwork(ip).cidr))
+                if use_conjunction:
+                    ip_rule = base_rule.copy()
+                    ip_rule['remote_ip_prefixes'] = remote_ips
+                    updated_rule.append(ip_rule)
+                    continue
+                for remote_ip in remote_ips:
+                    ip_rule = base_rule.copy()
+                    ip_rule[direction_ip_prefix] = remote_ip
                     updated_rule.append(ip_rule)
             port['sg_provider_rules'] = port['security_group_rules']
             port['security_group_rules'] = updated_rule
@@ -143,15 +157,25 @@ class OVSvAppSecurityGroupAgent(sg_rpc.SecurityGroupAgentRpc):
         LOG.debug("Successfully serviced security_group_info_for_esx_devices "
                   "RPC for %s.", dev_ids)
         ports = sg_info.get('ports')
+        port_list = []
         for port_id in ports:
             if port_id in dev_ids:
                 port_info = {'member_ips': sg_info.get('member_ips'),
                              'ports': {port_id: ports[port_id]}}
                 port_sg_rules = self.expand_sg_rules(port_info)
+                port_list.append(port_sg_rules[port_id])
+        # A firewall able to apply several ports at once gets the whole
+        # batch, so that it is committed to the bridge in one go.
+        if update and hasattr(self.firewall, 'update_port_filters'):
+            self.firewall.update_port_filters(port_list)
+        elif not update and hasattr(self.firewall, 'prepare_port_filters'):
+            self.firewall.prepare_port_filters(port_list)
+        else:
+            for port in port_list:
                 if update:
-                    self.firewall.update_port_filter(port_sg_rules[port_id])
+                    self.firewall.update_port_filter(port)
                 else:
-                    self.firewall.prepare_port_filter(port_sg_rules[port_id])
+                    self.firewall.prepare_port_filter(port)
 
     def _process_port_set(self, devices, update=False):
         dev_list = list(devices)
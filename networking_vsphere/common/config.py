@@ -125,7 +125,24 @@ SECURITYGROUP_OPTS = [
                default='networking_vsphere.drivers.ovs_firewall.'
                        'OVSFirewallDriver',
                help='DriverManager implementation for '
-                    'OVS based Firewall.')
+                    'OVS based Firewall.'),
+    cfg.BoolOpt('use_conjunction',
+                default=False,
+                help='Use OpenFlow conjunctive matches for remote security '
+                     'group rules, so that flows grow with rules plus '
+                     'members instead of rules times members. Requires '
+                     'Open vSwitch 2.4 or later.'),
+    cfg.BoolOpt('use_shared_rule_tables',
+                default=False,
+                help='Install the rule flows once per unique set of security '
+                     'group rules in shared tables, and only a classifier '
+                     'flow per port, instead of a copy of the rule flows '
+                     'for every port.'),
+    cfg.IntOpt('stale_flows_cleanup_delay',
+               default=300,
+               help='Seconds after an agent restart before the security '
+                    'bridge flows which no port claimed again are removed. '
+                    'The removal also waits for pending firewall updates.')
 ]
 
 
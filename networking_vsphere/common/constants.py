@@ -63,6 +63,9 @@ SG_RULES_PRI = 10
 SG_TP_PRI = 20
 SG_TCP_FLAG_PRI = 25
 SG_DROP_HIGH_PRI = 50
+# Conjunctive flows sit just above the rule they were built from, so that
+# an incomplete conjunction falls back to the ordinary rule flows.
+SG_CONJ_PRI_OFFSET = 1
 
 SG_DEFAULT_TABLE_ID = 0
 SG_EGRESS_TABLE_ID = 1
@@ -71,6 +74,9 @@ SG_TCP_TABLE_ID = 2
 SG_UDP_TABLE_ID = 2
 SG_ICMP_TABLE_ID = 2
 SG_LEARN_TABLE_ID = 5
+# Rule flows shared by all ports with the same security group rules.
+SG_INGRESS_RULES_TABLE_ID = 6
+SG_EGRESS_RULES_TABLE_ID = 7
 SG_CANARY_TABLE_ID = 23
 
 ICMP_ECHO_REQ = 8
@@ -72,6 +72,10 @@ class VMNotFound(ResourceNotFound):
     message = _('Virtual machine not found')
 
 
+class PortBookingFailed(VMWareDVSException):
+    message = _('Booking of port %(port_name)s did not complete: %(reason)s')
+
+
 class NoDVSForPhysicalNetwork(VMWareDVSException):
     message = _('No dvs mapped for physical network: %(physical_network)s')
 
@@ -107,12 +107,90 @@ dvs_opts = [
                help=_("Initial ports size for networks on DVS.")),
     cfg.FloatOpt('cache_pool_interval',
                  default=0.1,
+                 deprecated_for_removal=True,
                  help=_("The interval of task polling for "
-                        "DVS cache in seconds.")),
+                        "DVS cache in seconds. Unused, waiters on DVS "
+                        "cache are woken up on network status changes.")),
     cfg.IntOpt('cache_free_ports_size',
                default=20,
                help=_("The number of free ports of network to store in "
-                      "DVS cache."))
+                      "DVS cache.")),
+    cfg.IntOpt('free_ports_low_water_mark',
+               default=0,
+               help=_("The number of verified unbound ports kept ready per "
+                      "network in DVS cache. Below it, the ports are "
+                      "replenished in the background up to "
+                      "cache_free_ports_size, growing the network ahead of "
+                      "need. 0, the default, disables background "
+                      "replenishment.")),
+    cfg.FloatOpt('free_ports_replenish_interval',
+                 default=10.0,
+                 help=_("The interval in seconds the free ports of networks "
+                        "in DVS cache are checked for replenishment.")),
+    cfg.BoolOpt('use_port_index',
+                default=False,
+                help=_("Look up DVS ports in a local index kept current from "
+                       "vCenter updates instead of fetching them from "
+                       "vCenter.")),
+    cfg.IntOpt('port_index_resync_interval',
+               default=600,
+               help=_("The interval in seconds the local index of DVS ports "
+                      "is fully fetched again.")),
+    cfg.BoolOpt('use_task_tracker',
+                default=False,
+                help=_("Track the state of all vCenter tasks of the agent "
+                       "with one property collector update stream instead "
+                       "of polling each task.")),
+    cfg.FloatOpt('book_port_batch_window',
+                 default=0.05,
+                 help=_("The time in seconds port bind requests are "
+                        "collected to book their DVS ports together. "
+                        "0 books every port on its own.")),
+    cfg.IntOpt('book_port_batch_size',
+               default=50,
+               help=_("The maximum number of ports booked with a single "
+                      "reconfigure task.")),
+    cfg.IntOpt('firewall_batch_size_cap',
+               default=100,
+               help=_("The maximum number of ports the firewall updater "
+                      "reconfigures with a single task.")),
+    cfg.FloatOpt('firewall_batch_target_latency',
+                 default=5.0,
+                 help=_("The duration in seconds the firewall updater aims "
+                        "at for a reconfigure task. The number of ports per "
+                        "task of each DVS is adapted to it, up to "
+                        "firewall_batch_size_cap.")),
+    cfg.FloatOpt('firewall_refresh_quiet_period',
+                 default=2.0,
+                 help=_("The time in seconds without new firewall refresh "
+                        "requests after which the requested devices are "
+                        "refreshed together.")),
+    cfg.FloatOpt('firewall_refresh_max_delay',
+                 default=10.0,
+                 help=_("The maximum time in seconds a firewall refresh "
+                        "request waits for requests to stop.")),
+    cfg.IntOpt('firewall_refresh_chunk_size',
+               default=100,
+               help=_("The maximum number of devices of a single firewall "
+                      "refresh RPC.")),
+    cfg.BoolOpt('use_state_snapshot',
+                default=False,
+                help=_("Keep the filtered ports and the rules applied to "
+                       "DVS ports in a local snapshot, so that a restarted "
+                       "agent only sets up what changed.")),
+    cfg.StrOpt('state_snapshot_path',
+               default='$state_path/dvs-agent-state.sqlite',
+               help=_("The SQLite database of the agent state snapshot.")),
+    cfg.BoolOpt('use_port_monitor',
+                default=False,
+                help=_("Follow the ports connected to and disconnected from "
+                       "the DVSs with vCenter updates instead of finding "
+                       "them by fetching all ports.")),
+    cfg.IntOpt('port_full_sync_interval',
+               default=600,
+               help=_("The interval in seconds all connected ports are "
+                      "fetched to find the ones missed by the port "
+                      "monitor. 0 disables it."))
 ]
 
 cfg.CONF.register_opts(dvs_opts, "DVS")
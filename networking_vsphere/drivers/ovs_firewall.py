@@ -13,18 +13,23 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import hashlib
 import itertools
+import json
+import re
+import uuid
 
 import netaddr
 from oslo_config import cfg
 from oslo_log import log
 
-from neutron.agent.common import ovs_lib
 from neutron.agent import firewall
 from neutron.common import constants
 
-from networking_vsphere._i18n import _LE, _LW
+from networking_vsphere._i18n import _LE, _LI, _LW
 from networking_vsphere.common import constants as ovsvapp_const
+from networking_vsphere.utils import ovs_bridge_util as ovsvapp_br
 
 LOG = log.getLogger(__name__)
 
@@ -43,6 +48,10 @@ ETHERTYPE = {constants.IPv4: "ip",
 INGRESS_DIRECTION = 'ingress'
 EGRESS_DIRECTION = 'egress'
 
+# Match field carrying the remote address of a rule, per direction.
+REMOTE_IP_FIELD = {INGRESS_DIRECTION: 'nw_src',
+                   EGRESS_DIRECTION: 'nw_dst'}
+
 sg_conf = cfg.CONF.SECURITYGROUP
 
 PORT_KEYS = ['security_group_source_groups',
@@ -52,6 +61,109 @@ PORT_KEYS = ['security_group_source_groups',
              'security_groups',
              'lvid']
 
+MIN_TP_PORT = 0
+MAX_TP_PORT = 0xffff
+
+# Flow cookies carry the port in the upper bits and a flow hash in the lower
+# bits, so that single flows can be deleted by their cookie while all flows
+# of a port can still be deleted with the port cookie mask. Both parts are
+# stable across agent restarts: the port part comes from the port UUID, the
+# top bit tells provider rule flows apart and the next one is always set, so
+# that recovery can tell them from the random default cookie of the bridge.
+FLOW_INDEX_BITS = 24
+FLOW_INDEX_MASK = (1 << FLOW_INDEX_BITS) - 1
+PORT_COOKIE_MASK = 0xffffffffffffffff & ~FLOW_INDEX_MASK
+PORT_ID_BITS = 38
+PORT_COOKIE_FLAG = 1 << 62
+PROVIDER_COOKIE_FLAG = 1 << 63
+
+# Key of a flow recovered from a dump of the bridge after a restart.
+RECOVERED_FLOW_KEY = "recovered=0x%x"
+COOKIE_RE = re.compile(r"cookie=(0x[0-9a-fA-F]+)")
+CONJ_ID_RE = re.compile(r"conj_id=(\d+)|conjunction\((\d+),")
+# Flows of ports all match on their VLAN, and flows of shared rule sets on
+# their set register, unlike the base flows which carry the default cookie
+# of the bridge.
+PORT_FLOW_RE = re.compile(r"\b(dl_vlan|reg0)=")
+SG_SET_FLOW_RE = re.compile(r"\breg0=(0x[0-9a-fA-F]+|\d+)")
+CONJ_ID_MASK = 0xffffffff
+
+# Register carrying the rule set of a port into the shared rule tables.
+SG_SET_REG = 'reg0'
+SG_SET_REG_FIELD = 'NXM_NX_REG0[]'
+SG_SET_ID_MASK = 0xffffffff
+SG_RULES_TABLE = {INGRESS_DIRECTION: ovsvapp_const.SG_INGRESS_RULES_TABLE_ID,
+                  EGRESS_DIRECTION: ovsvapp_const.SG_EGRESS_RULES_TABLE_ID}
+
+
+def get_port_range_masks(port_min, port_max):
+    """Compile a TCP/UDP port range into value/mask matches.
+
+    Splits [port_min, port_max] into the smallest set of aligned power
+    of two blocks, so that a range needs at most 2 * 16 - 2 flows instead
+    of one flow per port. Single ports are returned as integers and
+    blocks as "0x<value>/0x<mask>" strings usable for tp_src/tp_dst.
+    """
+    if port_max is None:
+        port_max = port_min
+    port_min = max(int(port_min), MIN_TP_PORT)
+    port_max = min(int(port_max), MAX_TP_PORT)
+    matches = []
+    while port_min <= port_max:
+        # Largest block aligned on port_min that still fits in the range.
+        size = (port_min & -port_min) if port_min else MAX_TP_PORT + 1
+        while port_min + size - 1 > port_max:
+            size >>= 1
+        if size == 1:
+            matches.append(port_min)
+        else:
+            matches.append("0x%04x/0x%04x" %
+                           (port_min, MAX_TP_PORT & ~(size - 1)))
+        port_min += size
+    return matches
+
+
+def get_flow_key(flow):
+    """Identify a flow by everything but its cookie."""
+    return ",".join("%s=%s" % (key, flow[key]) for key in sorted(flow)
+                    if key != 'cookie')
+
+
+def get_flow_cookie(cookie, flow_key):
+    """Stable cookie of a single flow of a port."""
+    flow_hash = int(hashlib.md5(flow_key.encode('utf-8')).hexdigest(), 16)
+    return int(cookie, 16) | (flow_hash & FLOW_INDEX_MASK)
+
+
+class PortFlows(object):
+    """Bridge stand-in which records the flows generated for a port."""
+
+    def __init__(self):
+        self.flows = collections.OrderedDict()
+
+    def add_flow(self, **kwargs):
+        self.flows[get_flow_key(kwargs)] = kwargs
+
+
+class PendingFlows(object):
+    """Bridge stand-in which holds flow changes until they are replayed."""
+
+    def __init__(self):
+        self.changes = []
+
+    def add_flow(self, **kwargs):
+        self.changes.append(('add_flow', kwargs))
+
+    def mod_flow(self, **kwargs):
+        self.changes.append(('mod_flow', kwargs))
+
+    def delete_flows(self, **kwargs):
+        self.changes.append(('delete_flows', kwargs))
+
+    def replay(self, sec_br):
+        for method, kwargs in self.changes:
+            getattr(sec_br, method)(**kwargs)
+
 
 class OVSFirewallDriver(firewall.FirewallDriver):
     """Driver which enforces security groups through OVS flows."""
@@ -59,13 +171,36 @@ class OVSFirewallDriver(firewall.FirewallDriver):
     def __init__(self):
         self.filtered_ports = {}
         self.provider_port_cache = set()
+        self.use_conjunction = sg_conf.use_conjunction
+        # Conjunction ids are global to the bridge, track them per port or
+        # rule set. Ids handed out while generating flows are only recorded
+        # as installed, or released, once the bridge has been applied.
+        self._port_conj_ids = {}
+        self._conj_id_owners = {}
+        self._conj_allocation = {}
+        # Installed flows per cookie, mapping flow key to flow cookie.
+        self.installed_flows = {}
+        # Cookies and conjunction ids found on the bridge after a restart,
+        # until the ports they belong to are applied again, and the
+        # cookies of the recovered shared rule sets by set id.
+        self.recovered_cookies = set()
+        self.recovered_conj_ids = {}
+        self.recovered_sg_sets = {}
+        self.use_shared_rule_tables = sg_conf.use_shared_rule_tables
+        # Shared rule sets: rules key to set id, set id to rules key and
+        # member ports, and port to set id.
+        self.sg_set_ids = {}
+        self.sg_set_keys = {}
+        self.sg_set_ports = {}
+        self.port_sg_sets = {}
+        self.flow_counters = {'added': 0, 'removed': 0, 'unchanged': 0}
         if sg_conf.security_bridge_mapping is None:
             LOG.warning(_LW("Security bridge mapping not configured."))
             return
         secbr_list = (sg_conf.security_bridge_mapping).split(':')
         secbr_name = secbr_list[0]
         secbr_phyname = secbr_list[1]
-        self.sg_br = ovs_lib.OVSBridge(secbr_name)
+        self.sg_br = ovsvapp_br.OVSvAppSecurityBridge(secbr_name)
         self.phy_ofport = self.sg_br.get_port_ofport(secbr_phyname)
         self.patch_ofport = self.sg_br.get_port_ofport(
             ovsvapp_const.SEC_TO_INT_PATCH)
@@ -266,6 +401,12 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                                ovsvapp_const.SG_CANARY_TABLE_ID, "drop")
             self._add_ovs_flow(sec_br, ovsvapp_const.SG_DROPALL_PRI,
                                ovsvapp_const.SG_LEARN_TABLE_ID, "drop")
+            # Traffic not allowed by a shared rule set goes on as it would
+            # from tables 0 and 1.
+            for table_id in SG_RULES_TABLE.values():
+                self._add_ovs_flow(sec_br, ovsvapp_const.SG_DROPALL_PRI,
+                                   table_id, "resubmit(,%s)" %
+                                   ovsvapp_const.SG_LEARN_TABLE_ID)
             # Allow all ARP, parity with iptables.
             self._add_ovs_flow(sec_br, ovsvapp_const.SG_RULES_PRI,
                                ovsvapp_const.SG_DEFAULT_TABLE_ID,
@@ -368,17 +509,26 @@ class OVSFirewallDriver(firewall.FirewallDriver):
             return ['ipv6']
 
     def _add_flows_to_sec_br(self, sec_br, port, flow, direction):
-        if direction == EGRESS_DIRECTION:
+        if SG_SET_REG in flow:
+            # Shared rule set flows carry their table and no port match.
+            LOG.debug("OVSF adding flow: %s", flow)
+            sec_br.add_flow(**flow)
+        elif direction == EGRESS_DIRECTION:
             for ip in port['fixed_ips']:
-                sec_br.add_flow(priority=ovsvapp_const.SG_DEFAULT_PRI,
-                                table=ovsvapp_const.SG_EGRESS_TABLE_ID,
-                                dl_src=flow['dl_src'],
-                                dl_vlan=flow['dl_vlan'],
-                                proto=flow['proto'],
-                                nw_src=ip,
-                                in_port=self.phy_ofport,
-                                actions="resubmit(,%s)"
-                                % ovsvapp_const.SG_LEARN_TABLE_ID)
+                ip_flow = dict(priority=ovsvapp_const.SG_DEFAULT_PRI,
+                               table=ovsvapp_const.SG_EGRESS_TABLE_ID,
+                               dl_src=flow['dl_src'],
+                               dl_vlan=flow['dl_vlan'],
+                               proto=flow['proto'],
+                               nw_src=ip,
+                               in_port=self.phy_ofport,
+                               actions="resubmit(,%s)"
+                               % ovsvapp_const.SG_LEARN_TABLE_ID)
+                # With the cookie of the port, not the default cookie of
+                # the base flows, so that it goes with the port.
+                if 'cookie' in flow:
+                    ip_flow['cookie'] = flow['cookie']
+                sec_br.add_flow(**ip_flow)
                 flow['nw_src'] = ip
                 flow['table'] = ovsvapp_const.SG_EGRESS_TABLE_ID
                 LOG.debug("OVSF adding flow: %s", flow)
@@ -388,28 +538,30 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                 LOG.debug("OVSF adding flow: %s", flow)
                 sec_br.add_flow(**flow)
 
+    def _get_port_range_matches(self, port_min, port_max):
+        if ((port_min is None and port_max is None) or
+                (port_min == 1 and port_max == MAX_TP_PORT)):
+            # No match on the transport port.
+            return [None]
+        return get_port_range_masks(port_min, port_max)
+
     def _add_flow_with_range(self, sec_br, port, flow, direction,
                              dest_port_min=None, dest_port_max=None,
                              src_port_min=None, src_port_max=None):
-        if ((dest_port_min is None and dest_port_max is None) or
-                (dest_port_min == 1 and dest_port_max == 65535)):
-            dest_port_min = -1
-            dest_port_max = -1
-        if ((src_port_min is None and src_port_max is None) or
-                (src_port_min == 1 and src_port_max == 65535)):
-            src_port_min = -1
-            src_port_max = -1
-
-        for dest_port, src_port in itertools.product(
-                range(dest_port_min, dest_port_max + 1),
-                range(src_port_min, src_port_max + 1)):
-            if dest_port >= 0:
+        dest_matches = self._get_port_range_matches(dest_port_min,
+                                                    dest_port_max)
+        src_matches = self._get_port_range_matches(src_port_min,
+                                                   src_port_max)
+        for dest_port, src_port in itertools.product(dest_matches,
+                                                     src_matches):
+            if dest_port is not None:
                 flow["tp_dst"] = dest_port
-            if src_port >= 0:
+            if src_port is not None:
                 flow["tp_src"] = src_port
             self._add_flows_to_sec_br(sec_br, port, flow, direction)
 
-    def _add_flows(self, sec_br, port, cookie, for_provider=False):
+    def _add_flows(self, sec_br, port, cookie, for_provider=False,
+                   sg_set_id=None):
         egress_action = 'normal'
         ingress_action = 'output:%s' % self.phy_ofport
 
@@ -418,12 +570,27 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         else:
             rules = port["sg_provider_rules"]
 
-        vlan = self._get_port_vlan(port['id'])
-        if not vlan:
-            LOG.error(_LE('Missing VLAN for port: %s.'), port['id'])
-            return
+        if sg_set_id is None:
+            vlan = self._get_port_vlan(port['id'])
+            if not vlan:
+                LOG.error(_LE('Missing VLAN for port: %s.'), port['id'])
+                return
+            conj_owner = port['id']
+        else:
+            vlan = None
+            conj_owner = self._get_sg_set_name(sg_set_id)
+        conj_flows = {'ids': {}, 'rules': {}, 'members': {}}
         for rule in rules:
             direction = rule.get('direction')
+            remote_ips = rule.get('remote_ip_prefixes')
+            if remote_ips is not None and len(remote_ips) < 2:
+                # Nothing to gain from a conjunction for a single member.
+                if not remote_ips:
+                    continue
+                rule = dict(rule)
+                rule[ovsvapp_const.DIRECTION_IP_PREFIX[direction]] = (
+                    remote_ips[0])
+                remote_ips = None
             proto = rule.get('protocol')
             dest_port_min = rule.get('port_range_min')
             dest_port_max = rule.get('port_range_max')
@@ -434,7 +601,8 @@ class OVSFirewallDriver(firewall.FirewallDriver):
             dest_ip_prefix = rule.get('dest_ip_prefix')
             flow = dict(priority=ovsvapp_const.SG_RULES_PRI)
             flow["cookie"] = cookie
-            flow["dl_vlan"] = vlan
+            if vlan:
+                flow["dl_vlan"] = vlan
             # Fill the src and dest IPs match params.
             src_ip_prefixlen = self._get_net_prefix_len(src_ip_prefix)
             if src_ip_prefixlen > 0:
@@ -449,7 +617,11 @@ class OVSFirewallDriver(firewall.FirewallDriver):
             if len(protocols) > 1:
                 flow["nw_proto"] = protocols[1]
             # set source and destination params and action for the flow.
-            if direction == INGRESS_DIRECTION:
+            if sg_set_id is not None:
+                flow.update(self._get_sg_set_match(sg_set_id, direction))
+                action = (ingress_action if direction == INGRESS_DIRECTION
+                          else egress_action)
+            elif direction == INGRESS_DIRECTION:
                 flow["dl_dst"] = port["mac_address"]
                 flow["in_port"] = self.patch_ofport
                 action = ingress_action
@@ -460,19 +632,15 @@ class OVSFirewallDriver(firewall.FirewallDriver):
             tcp_udp = set([constants.PROTO_NAME_TCP,
                            constants.PROTO_NAME_UDP])
             table_id = None
+            port_range = None
             if protocol in tcp_udp:
                 flow["priority"] = ovsvapp_const.SG_TP_PRI
                 if protocol == constants.PROTO_NAME_TCP:
                     table_id = ovsvapp_const.SG_TCP_TABLE_ID
                 else:
                     table_id = ovsvapp_const.SG_UDP_TABLE_ID
-                flow["actions"] = ("resubmit(,%s),%s" % (table_id, action))
-                self._add_flow_with_range(sec_br, port, flow, direction,
-                                          dest_port_min, dest_port_max,
-                                          src_port_min, src_port_max)
-                # Since we added the required flows in the above method
-                # we just proceed to the next sg rule.
-                continue
+                port_range = (dest_port_min, dest_port_max,
+                              src_port_min, src_port_max)
             elif protocol == constants.PROTO_NAME_ICMP:
                 flow["priority"] = ovsvapp_const.SG_TP_PRI
                 if dest_port_min is not None:
@@ -484,52 +652,510 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                 table_id = ovsvapp_const.SG_IP_TABLE_ID
 
             flow["actions"] = ("resubmit(,%s),%s" % (table_id, action))
-            self._add_flows_to_sec_br(sec_br, port, flow, direction)
+            if remote_ips and not self._add_conjunction(
+                    conj_owner, flow, direction, ethertype, remote_ips,
+                    port_range, conj_flows):
+                # Rule flows already added for an earlier remote group.
+                continue
+            if port_range:
+                self._add_flow_with_range(sec_br, port, flow, direction,
+                                          *port_range)
+            else:
+                self._add_flows_to_sec_br(sec_br, port, flow, direction)
+        if conj_flows['rules']:
+            self._add_conjunction_flows(sec_br, port, cookie, vlan,
+                                        conj_flows, sg_set_id)
 
-    def prepare_port_filter(self, port):
-        """Method to add OVS rules for a newly created VM port."""
-        LOG.debug("OVSF Preparing port %s filter.", port['id'])
+    def _alloc_conj_id(self, port_id, signature):
+        """Conjunction id of a rule of a port.
+
+        Derived from the port and the rule, so that an unchanged
+        conjunction keeps its id, and so its flows, across refreshes and
+        agent restarts. Ids of other ports, or found on the bridge under
+        the cookie of another port, are skipped.
+        """
+        conj_ids = self._conj_allocation.setdefault(port_id, [])
+        key = "%s|%s" % (port_id, signature)
+        conj_id = (int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) &
+                   CONJ_ID_MASK)
+        port_cookie = int(self.get_cookie(port_id), 16)
+        while (not conj_id or conj_id in conj_ids or
+               self._conj_id_owners.get(conj_id, port_id) != port_id or
+               self.recovered_conj_ids.get(conj_id,
+                                           port_cookie) != port_cookie):
+            conj_id = (conj_id + 1) & CONJ_ID_MASK
+        self._conj_id_owners[conj_id] = port_id
+        conj_ids.append(conj_id)
+        return conj_id
+
+    def _free_conj_ids(self, port_id, conj_ids):
+        for conj_id in conj_ids:
+            if self._conj_id_owners.get(conj_id) == port_id:
+                del self._conj_id_owners[conj_id]
+
+    def _take_conj_allocation(self):
+        allocation, self._conj_allocation = self._conj_allocation, {}
+        return allocation
+
+    def _commit_conj_ids(self, allocation):
+        """Record the ids allocated for flows now on the bridge."""
+        for port_id, conj_ids in allocation.items():
+            self._free_conj_ids(port_id, set(
+                self._port_conj_ids.get(port_id, [])) - set(conj_ids))
+            if conj_ids:
+                self._port_conj_ids[port_id] = conj_ids
+            else:
+                self._port_conj_ids.pop(port_id, None)
+
+    def _abort_conj_ids(self, allocation):
+        """Give back the ids allocated for flows which were not applied."""
+        for port_id, conj_ids in allocation.items():
+            self._free_conj_ids(port_id, set(conj_ids) - set(
+                self._port_conj_ids.get(port_id, [])))
+
+    def _release_conj_ids(self, port_ids):
+        """Release the ids of ports whose flows left the bridge."""
+        for port_id in port_ids:
+            self._free_conj_ids(port_id, self._port_conj_ids.pop(port_id, []))
+
+    def _add_conjunction(self, port_id, flow, direction, ethertype,
+                         remote_ips, port_range, conj_flows):
+        """Turn a remote group rule flow into a conjunction dimension.
+
+        The rule match without the remote address becomes dimension 1 of
+        the conjunction, while the remote group member addresses, shared
+        by all rules of the port, make up dimension 2. Rules which only
+        differ in their remote group share one conjunction id.
+
+        Returns False if the rule flows of the conjunction were already
+        generated by an earlier rule.
+        """
+        signature = "%s|%s|%s" % (direction, port_range,
+                                  get_flow_key(flow))
+        priority = flow["priority"] + ovsvapp_const.SG_CONJ_PRI_OFFSET
+        conj_id = conj_flows['ids'].get(signature)
+        new_conj = conj_id is None
+        if new_conj:
+            conj_id = self._alloc_conj_id(port_id, signature)
+            conj_flows['ids'][signature] = conj_id
+            conj_flows['rules'][conj_id] = (direction, priority,
+                                            flow["actions"])
+        proto = ETHERTYPE.get(ethertype)
+        for ip in remote_ips:
+            key = (direction, priority, proto, ip)
+            conj_flows['members'].setdefault(key, set()).add(conj_id)
+        flow["priority"] = priority
+        flow["actions"] = "conjunction(%s,1/2)" % conj_id
+        return new_conj
+
+    def _get_port_match(self, port, vlan, direction, sg_set_id=None):
+        if sg_set_id is not None:
+            return self._get_sg_set_match(sg_set_id, direction)
+        if direction == INGRESS_DIRECTION:
+            return dict(table=ovsvapp_const.SG_DEFAULT_TABLE_ID,
+                        in_port=self.patch_ofport,
+                        dl_dst=port["mac_address"],
+                        dl_vlan=vlan)
+        return dict(table=ovsvapp_const.SG_EGRESS_TABLE_ID,
+                    in_port=self.phy_ofport,
+                    dl_src=port["mac_address"],
+                    dl_vlan=vlan)
+
+    def _add_conjunction_flows(self, sec_br, port, cookie, vlan, conj_flows,
+                               sg_set_id=None):
+        """Add the member address and conj_id flows of the conjunctions."""
+        for conj_id, (direction, priority, actions) in (
+                conj_flows['rules'].items()):
+            flow = self._get_port_match(port, vlan, direction, sg_set_id)
+            sec_br.add_flow(priority=priority, cookie=cookie,
+                            conj_id=conj_id, actions=actions, **flow)
+        for (direction, priority, proto, ip), conj_ids in (
+                conj_flows['members'].items()):
+            flow = self._get_port_match(port, vlan, direction, sg_set_id)
+            flow[REMOTE_IP_FIELD[direction]] = ip
+            actions = ",".join("conjunction(%s,2/2)" % conj_id
+                               for conj_id in sorted(conj_ids))
+            sec_br.add_flow(priority=priority, cookie=cookie, proto=proto,
+                            actions=actions, **flow)
+
+    def _get_sg_set_name(self, sg_set_id):
+        return "sg-set-%08x" % sg_set_id
+
+    def _get_sg_set_match(self, sg_set_id, direction):
+        return {'table': SG_RULES_TABLE[direction], SG_SET_REG: sg_set_id}
+
+    def _get_sg_set_id(self, rules):
+        """Id of the shared rule set made of the given rules.
+
+        Derived from the rules, so that a rule set keeps its id, and so
+        its flows, across agent restarts.
+        """
+        key = "\n".join(sorted(json.dumps(rule, sort_keys=True)
+                               for rule in rules))
+        sg_set_id = self.sg_set_ids.get(key)
+        if sg_set_id is None:
+            sg_set_id = (int(hashlib.md5(key.encode('utf-8')).hexdigest(),
+                             16) & SG_SET_ID_MASK)
+            while not sg_set_id or sg_set_id in self.sg_set_keys:
+                sg_set_id = (sg_set_id + 1) & SG_SET_ID_MASK
+            self.sg_set_ids[key] = sg_set_id
+            self.sg_set_keys[sg_set_id] = key
+        return sg_set_id
+
+    def _add_classifier_flows(self, sec_br, port, cookie, sg_set_id):
+        """Send the traffic of a port through its shared rule set."""
+        vlan = self._get_port_vlan(port['id'])
+        if not vlan:
+            LOG.error(_LE('Missing VLAN for port: %s.'), port['id'])
+            return
+        load = "load:%s->%s" % (sg_set_id, SG_SET_REG_FIELD)
+        sec_br.add_flow(priority=ovsvapp_const.SG_LOW_PRI,
+                        table=ovsvapp_const.SG_DEFAULT_TABLE_ID,
+                        cookie=cookie,
+                        in_port=self.patch_ofport,
+                        dl_dst=port["mac_address"],
+                        dl_vlan=vlan,
+                        actions="%s,resubmit(,%s)" %
+                        (load, SG_RULES_TABLE[INGRESS_DIRECTION]))
+        for ip in port['fixed_ips']:
+            flow = dict(priority=ovsvapp_const.SG_LOW_PRI,
+                        table=ovsvapp_const.SG_EGRESS_TABLE_ID,
+                        cookie=cookie,
+                        in_port=self.phy_ofport,
+                        dl_src=port["mac_address"],
+                        dl_vlan=vlan,
+                        actions="%s,resubmit(,%s)" %
+                        (load, SG_RULES_TABLE[EGRESS_DIRECTION]))
+            if netaddr.IPNetwork(ip).version == 4:
+                flow.update(proto="ip", nw_src=ip)
+            else:
+                flow.update(proto="ipv6", ipv6_src=ip)
+            sec_br.add_flow(**flow)
+
+    def _get_port_flows(self, port, cookie, for_provider=False,
+                        sg_set_id=None):
+        """Generate the flows of a port without applying them."""
+        port_flows = PortFlows()
+        if not for_provider:
+            self._setup_aap_flows(port_flows, port)
+        if sg_set_id is None:
+            self._add_flows(port_flows, port, cookie, for_provider)
+        else:
+            self._add_classifier_flows(port_flows, port, cookie, sg_set_id)
+        return port_flows.flows
+
+    def _apply_sg_set_flows(self, sec_br, port, states, installing=()):
+        """Make sure the shared rule set of a port is installed.
+
+        :param installing: ids of the rule sets installed by the same
+                           commit.
+        :returns: the rule set id and the added, removed and unchanged
+                  flow counts.
+        """
+        sg_set_id = self._get_sg_set_id(port['security_group_rules'])
+        counts = (0, 0, 0)
+        if not self.sg_set_ports.get(sg_set_id) and (
+                sg_set_id not in installing):
+            # First member of the rule set, reconcile it with whatever was
+            # installed or recovered for it.
+            name = self._get_sg_set_name(sg_set_id)
+            cookie = self.get_cookie(name)
+            self._conj_allocation.setdefault(name, [])
+            set_flows = PortFlows()
+            self._add_flows(set_flows, port, cookie, sg_set_id=sg_set_id)
+            states[cookie], counts = self._apply_flow_delta(
+                sec_br, cookie, set_flows.flows,
+                self.installed_flows.get(cookie, {}))
+        return sg_set_id, counts
+
+    def _delete_sg_set_flows(self, sec_br, sg_set_id):
+        cookie = self.get_cookie(self._get_sg_set_name(sg_set_id))
+        sec_br.delete_flows(cookie="%s/0x%x" % (cookie, PORT_COOKIE_MASK))
+
+    def _set_port_sg_set(self, port_id, sg_set_id):
+        """Record the rule set of a port once its flows are applied.
+
+        :returns: the id of the previous rule set of the port if it was
+                  left without members, else None.
+        """
+        old_set_id = self.port_sg_sets.get(port_id)
+        self.port_sg_sets[port_id] = sg_set_id
+        self.sg_set_ports.setdefault(sg_set_id, set()).add(port_id)
+        if old_set_id not in (None, sg_set_id) and self._release_sg_set(
+                old_set_id, port_id):
+            return old_set_id
+
+    def _release_sg_set(self, sg_set_id, port_id):
+        """Drop a port from a rule set.
+
+        :returns: True if the port was the last member, in which case the
+                  rule set is forgotten and its flows should be deleted.
+                  Its conjunction ids are released once they are.
+        """
+        members = self.sg_set_ports.get(sg_set_id, set())
+        members.discard(port_id)
+        if members:
+            return False
+        name = self._get_sg_set_name(sg_set_id)
+        self.sg_set_ports.pop(sg_set_id, None)
+        self.sg_set_ids.pop(self.sg_set_keys.pop(sg_set_id, None), None)
+        self.installed_flows.pop(self.get_cookie(name), None)
+        return True
+
+    def _remove_port_sg_set(self, sec_br, port_id):
+        """Drop a port from its rule set, deleting the set if unused.
+
+        :returns: the name of the deleted rule set, else None.
+        """
+        sg_set_id = self.port_sg_sets.pop(port_id, None)
+        if sg_set_id is not None and self._release_sg_set(sg_set_id,
+                                                          port_id):
+            self._delete_sg_set_flows(sec_br, sg_set_id)
+            return self._get_sg_set_name(sg_set_id)
+
+    def _apply_flow_delta(self, sec_br, cookie, flows, installed):
+        """Send only the difference between installed and desired flows.
+
+        :param flows: desired flows keyed by flow key.
+        :param installed: currently installed flow cookies keyed by flow
+                          key, or by RECOVERED_FLOW_KEY for recovered flows.
+        :returns: the new installed state and the added, removed and
+                  unchanged flow counts.
+        """
+        state = {}
+        for key, flow in flows.items():
+            state[key] = (get_flow_cookie(cookie, key)
+                          if 'cookie' in flow else None)
+        desired_cookies = set(state.values())
+        deleted = set()
+        for key, flow_cookie in installed.items():
+            if key in state or flow_cookie is None:
+                continue
+            if (key == RECOVERED_FLOW_KEY % flow_cookie and
+                    flow_cookie in desired_cookies):
+                continue
+            deleted.add(flow_cookie)
+        for flow_cookie in sorted(deleted):
+            sec_br.delete_flows(cookie="0x%x/-1" % flow_cookie)
+        added = 0
+        for key, flow in flows.items():
+            flow_cookie = state[key]
+            if flow_cookie not in deleted and (
+                    key in installed or flow_cookie is not None and
+                    RECOVERED_FLOW_KEY % flow_cookie in installed):
+                continue
+            # Flows without cookie are shared and only removed with the
+            # port, flows which share a deleted cookie are added back.
+            if flow_cookie is not None:
+                flow['cookie'] = "0x%x" % flow_cookie
+            sec_br.add_flow(**flow)
+            added += 1
+        return state, (added, len(deleted), len(flows) - added)
+
+    def _apply_port_flows(self, sec_br, port, states, with_provider=False,
+                          sg_set_id=None):
+        """Reconcile the flows of a port with its current rules.
+
+        The new installed states are collected in states, to be stored once
+        the deferred bridge has been applied.
+        """
         port_cookie = self.get_cookie(port['id'])
-        port_provider_cookie = self.get_cookie('pr' + port['id'])
+        # Using port id as cookie for normal rules.
+        flows = self._get_port_flows(port, port_cookie, sg_set_id=sg_set_id)
+        states[port_cookie], counts = self._apply_flow_delta(
+            sec_br, port_cookie, flows,
+            self.installed_flows.get(port_cookie, {}))
+        if with_provider:
+            # Using provider cookie for provider rules.
+            port_provider_cookie = self.get_cookie(port['id'], True)
+            flows = self._get_port_flows(port, port_provider_cookie, True)
+            states[port_provider_cookie], provider_counts = (
+                self._apply_flow_delta(
+                    sec_br, port_provider_cookie, flows,
+                    self.installed_flows.get(port_provider_cookie, {})))
+            counts = tuple(sum(count) for count in
+                           zip(counts, provider_counts))
+        vlan = self._get_port_vlan(port['id'])
+        if counts[1] and vlan:
+            # Connections allowed by removed rules must not survive in the
+            # learned flows.
+            self._remove_learned_flows(sec_br, port, vlan)
+        return counts
+
+    def _update_flow_counters(self, port_id, counts):
+        added, removed, unchanged = counts
+        self.flow_counters['added'] += added
+        self.flow_counters['removed'] += removed
+        self.flow_counters['unchanged'] += unchanged
+        LOG.debug("OVSF port %(port)s flows added: %(added)s, removed: "
+                  "%(removed)s, unchanged: %(unchanged)s.",
+                  {'port': port_id, 'added': added, 'removed': removed,
+                   'unchanged': unchanged})
+
+    def _apply_port_filter(self, sec_br, port, installing=()):
+        """Send the flow changes of a port to a deferred bridge.
+
+        :returns: what to commit, or abort, once the bridge has been
+                  applied.
+        """
+        self._conj_allocation = {port['id']: []}
+        states = {}
+        sg_set_id = None
+        counts = (0, 0, 0)
+        try:
+            if self.use_shared_rule_tables:
+                sg_set_id, counts = self._apply_sg_set_flows(
+                    sec_br, port, states, installing)
+            with_provider = port['id'] not in self.provider_port_cache
+            port_counts = self._apply_port_flows(sec_br, port, states,
+                                                 with_provider, sg_set_id)
+        except Exception:
+            self._abort_conj_ids(self._take_conj_allocation())
+            raise
+        return (states, sg_set_id, with_provider, tuple(
+            sum(count) for count in zip(counts, port_counts)),
+            self._take_conj_allocation())
+
+    def _commit_port_filter(self, port, pending):
+        """Record the flows of a port as installed.
+
+        :returns: the id of a rule set left without members, else None.
+        """
+        states, sg_set_id, with_provider, counts, allocation = pending
+        self.installed_flows.update(states)
+        self.recovered_cookies.difference_update(states)
+        self._commit_conj_ids(allocation)
+        if with_provider:
+            self.provider_port_cache.add(port['id'])
+        unused_set_id = None
+        if sg_set_id is not None:
+            unused_set_id = self._set_port_sg_set(port['id'], sg_set_id)
+        self._update_flow_counters(port['id'], counts)
+        self.filtered_ports[port['id']] = self._get_compact_port(port)
+        return unused_set_id
+
+    def _abort_port_filter(self, pending):
+        self._abort_conj_ids(pending[4])
+
+    def _delete_sg_sets(self, sg_set_ids):
+        # Only once no classifier flow points at them any more.
+        sg_set_ids = [sg_set_id for sg_set_id in sg_set_ids
+                      if sg_set_id is not None]
+        if sg_set_ids:
+            with self.sg_br.deferred() as deferred_br:
+                for sg_set_id in sg_set_ids:
+                    self._delete_sg_set_flows(deferred_br, sg_set_id)
+            self._release_conj_ids([self._get_sg_set_name(sg_set_id)
+                                    for sg_set_id in sg_set_ids])
+
+    def _refresh_port_flows(self, port):
+        """Apply the flows of a port and commit the new installed state."""
+        pending = None
         try:
             with self.sg_br.deferred(full_ordered=True, order=(
                 'del', 'mod', 'add')) as deferred_br:
-                self._setup_aap_flows(deferred_br, port)
-                if port['id'] not in self.provider_port_cache:
-                    # Using provider string as cookie for normal rules.
-                    self._add_flows(deferred_br, port,
-                                    port_provider_cookie, True)
-                    self.provider_port_cache.add(port['id'])
-                # Using port id as cookie for normal rules.
-                self._add_flows(deferred_br, port, port_cookie)
-            self.filtered_ports[port['id']] = self._get_compact_port(port)
+                pending = self._apply_port_filter(deferred_br, port)
+        except Exception:
+            if pending is not None:
+                self._abort_port_filter(pending)
+            raise
+        self._delete_sg_sets([self._commit_port_filter(port, pending)])
+
+    def _refresh_port_filters(self, ports):
+        """Apply the flows of several ports as a single commit.
+
+        A port whose flows cannot be generated is left out, without
+        affecting the others.
+        """
+        committed = []
+        installing = set()
+        try:
+            with self.sg_br.deferred(full_ordered=True, order=(
+                'del', 'mod', 'add')) as deferred_br:
+                for port in ports:
+                    pending_flows = PendingFlows()
+                    try:
+                        pending = self._apply_port_filter(
+                            pending_flows, port, installing)
+                    except Exception:
+                        LOG.exception(_LE("Unable to apply flows for %s."),
+                                      port['id'])
+                        continue
+                    pending_flows.replay(deferred_br)
+                    if pending[1] is not None:
+                        installing.add(pending[1])
+                    committed.append((port, pending))
+        except Exception:
+            LOG.exception(_LE("Unable to apply flows for %s ports."),
+                          len(ports))
+            for port, pending in committed:
+                self._abort_port_filter(pending)
+            return
+        self._delete_sg_sets([self._commit_port_filter(port, pending)
+                              for port, pending in committed])
+
+    def prepare_port_filters(self, ports):
+        """Add OVS rules for several newly created VM ports at once."""
+        LOG.debug("OVSF Preparing %s port filters.", len(ports))
+        self._refresh_port_filters(ports)
+
+    def update_port_filters(self, ports):
+        """Update OVS rules for several existing VM ports at once."""
+        LOG.debug("OVSF Updating %s port filters.", len(ports))
+        filtered = []
+        for port in ports:
+            if port['id'] not in self.filtered_ports:
+                LOG.warning(_LW("Attempted to update port filter which is "
+                                "not filtered %s."), port['id'])
+                continue
+            filtered.append(port)
+        self._refresh_port_filters(filtered)
+
+    def prepare_port_filter(self, port):
+        """Method to add OVS rules for a newly created VM port."""
+        LOG.debug("OVSF Preparing port %s filter.", port['id'])
+        try:
+            self._refresh_port_flows(port)
         except Exception:
             LOG.exception(_LE("Unable to add flows for %s."), port['id'])
 
+    def _remove_learned_flows(self, sec_br, port, vlan):
+        sec_br.delete_flows(table=ovsvapp_const.SG_LEARN_TABLE_ID,
+                            dl_src=port['mac_address'],
+                            vlan_tci="0x%04x/0x0fff" % vlan)
+        sec_br.delete_flows(table=ovsvapp_const.SG_LEARN_TABLE_ID,
+                            dl_dst=port['mac_address'],
+                            vlan_tci="0x%04x/0x0fff" % vlan)
+        sec_br.delete_flows(table=ovsvapp_const.SG_DEFAULT_TABLE_ID,
+                            dl_src=port['mac_address'],
+                            vlan_tci="0x%04x/0x0fff" % vlan)
+
     def _remove_flows(self, sec_br, port_id, del_provider_rules=False):
-        """Remove all flows for a port."""
+        """Remove all flows for a port.
+
+        :returns: the ports and rule sets whose conjunction ids can be
+                  released once the bridge has been applied.
+        """
         LOG.debug("OVSF Removing flows start for port: %s.", port_id)
+        removed = [port_id]
         try:
-            sec_br.delete_flows(cookie="%s/-1" %
-                                self.get_cookie(port_id))
+            port_cookie = self.get_cookie(port_id)
+            self.installed_flows.pop(port_cookie, None)
+            sec_br.delete_flows(cookie="%s/0x%x" %
+                                (port_cookie, PORT_COOKIE_MASK))
             if del_provider_rules:
-                sec_br.delete_flows(cookie="%s/-1" %
-                                    self.get_cookie('pr' + port_id))
+                port_provider_cookie = self.get_cookie(port_id, True)
+                self.installed_flows.pop(port_provider_cookie, None)
+                sec_br.delete_flows(cookie="%s/0x%x" %
+                                    (port_provider_cookie, PORT_COOKIE_MASK))
+            removed.append(self._remove_port_sg_set(sec_br, port_id))
             port = self.filtered_ports.get(port_id)
             vlan = self._get_port_vlan(port_id)
             if 'mac_address' not in port or not vlan:
                 LOG.debug("Invalid mac address or vlan for port "
                           "%s. Returning from _remove_flows.", port_id)
-                return
-            sec_br.delete_flows(table=ovsvapp_const.SG_LEARN_TABLE_ID,
-                                dl_src=port['mac_address'],
-                                vlan_tci="0x%04x/0x0fff" % vlan)
-            sec_br.delete_flows(table=ovsvapp_const.SG_LEARN_TABLE_ID,
-                                dl_dst=port['mac_address'],
-                                vlan_tci="0x%04x/0x0fff" % vlan)
-            sec_br.delete_flows(table=ovsvapp_const.SG_DEFAULT_TABLE_ID,
-                                dl_src=port['mac_address'],
-                                vlan_tci="0x%04x/0x0fff" % vlan)
+                return removed
+            self._remove_learned_flows(sec_br, port, vlan)
             if del_provider_rules:
                 sec_br.delete_flows(table=ovsvapp_const.SG_DEFAULT_TABLE_ID,
                                     dl_dst=port['mac_address'],
@@ -539,12 +1165,14 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                                     vlan_tci="0x%04x/0x0fff" % vlan)
         except Exception:
             LOG.exception(_LE("Unable to remove flows %s."), port['id'])
+        return removed
 
     def clean_port_filters(self, ports, remove_port=False):
         """Method to remove OVS rules for an existing VM port."""
         LOG.debug("OVSF Cleaning filters for  %s ports.", len(ports))
         if not ports:
             return
+        removed = []
         with self.sg_br.deferred() as deferred_sec_br:
             for port_id in ports:
                 try:
@@ -553,37 +1181,31 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                                   "which is not in filtered %s.", port_id)
                         continue
                     if not remove_port:
-                        self._remove_flows(deferred_sec_br, port_id)
+                        removed.extend(self._remove_flows(deferred_sec_br,
+                                                          port_id))
                     else:
-                        self._remove_flows(deferred_sec_br, port_id, True)
+                        removed.extend(self._remove_flows(deferred_sec_br,
+                                                          port_id, True))
                         self.provider_port_cache.remove(port_id)
                         self.filtered_ports.pop(port_id, None)
                 except Exception:
                     LOG.exception(_LE("Unable to delete flows for"
                                       " %s."), port_id)
+        self._release_conj_ids([name for name in removed if name])
 
     def update_port_filter(self, port):
-        """Method to update OVS rules for an existing VM port."""
+        """Method to update OVS rules for an existing VM port.
+
+        Only the difference between the installed flows of the port and
+        the flows generated from its current rules is sent to the bridge.
+        """
         LOG.debug("OVSF Updating port: %s filter.", port['id'])
         if port['id'] not in self.filtered_ports:
             LOG.warning(_LW("Attempted to update port filter which is not "
                             "filtered %s."), port['id'])
             return
-        port_cookie = self.get_cookie(port['id'])
-        port_provider_cookie = self.get_cookie('pr' + port['id'])
         try:
-            with self.sg_br.deferred(full_ordered=True, order=(
-                'del', 'mod', 'add')) as deferred_br:
-                if port['id'] not in self.provider_port_cache:
-                    self._remove_flows(deferred_br, port['id'], True)
-                    self._add_flows(deferred_br, port,
-                                    port_provider_cookie, True)
-                    self.provider_port_cache.add(port['id'])
-                else:
-                    self._remove_flows(deferred_br, port['id'])
-                self._setup_aap_flows(deferred_br, port)
-                self._add_flows(deferred_br, port, port_cookie)
-            self.filtered_ports[port['id']] = self._get_compact_port(port)
+            self._refresh_port_flows(port)
         except Exception:
             LOG.exception(_LE("Unable to update flows for %s."), port['id'])
 
@@ -595,19 +1217,129 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         if self._defer_apply:
             self._defer_apply = False
 
-    def get_cookie(self, port_id):
-        return ("0x%x" % (hash(port_id) & 0xffffffffffffffff))
+    def get_cookie(self, port_id, provider=False):
+        """Cookie of the normal or provider rule flows of a port.
+
+        Derived from the port UUID, so that it survives agent restarts.
+        """
+        try:
+            port_bits = uuid.UUID(port_id).int
+        except ValueError:
+            port_bits = int(hashlib.md5(port_id.encode('utf-8')).hexdigest(),
+                            16)
+        cookie = ((port_bits >> (128 - PORT_ID_BITS)) << FLOW_INDEX_BITS |
+                  PORT_COOKIE_FLAG)
+        if provider:
+            cookie |= PROVIDER_COOKIE_FLAG
+        return "0x%x" % cookie
+
+    def recover_port_flows(self, flows):
+        """Rebuild the installed flow state from a dump of the bridge.
+
+        Used after an agent restart, so that the ports found again only
+        get the difference between their existing and current flows.
+
+        The conjunction ids found are kept for the port they belong to.
+        Shared rule sets are found by the set register their flows match
+        on, a set gets the difference only when its first member is
+        applied. Cookies which no port or rule set claims, like the cookies
+        of ports deleted while the agent was down, are left to
+        remove_stale_recovered_flows.
+
+        Only cookies with the port cookie flag are recovered, and never one
+        which base flows share: the base flows are not installed again on
+        restart and would be removed with it.
+
+        :param flows: flow lines as dumped by ovs-ofctl.
+        """
+        port_flows = []
+        base_cookies = set()
+        for flow in flows:
+            match = COOKIE_RE.search(flow)
+            if not match:
+                continue
+            flow_cookie = int(match.group(1), 16)
+            if (flow_cookie & PORT_COOKIE_FLAG and
+                    PORT_FLOW_RE.search(flow)):
+                port_flows.append((flow, flow_cookie))
+            else:
+                base_cookies.add(flow_cookie & PORT_COOKIE_MASK)
+        recovered = 0
+        for flow, flow_cookie in port_flows:
+            port_cookie = flow_cookie & PORT_COOKIE_MASK
+            if port_cookie in base_cookies:
+                continue
+            cookie = "0x%x" % port_cookie
+            installed = self.installed_flows.setdefault(cookie, {})
+            installed[RECOVERED_FLOW_KEY % flow_cookie] = flow_cookie
+            self.recovered_cookies.add(cookie)
+            set_match = SG_SET_FLOW_RE.search(flow)
+            if set_match:
+                sg_set_id = int(set_match.group(1), 0)
+                self.recovered_sg_sets[sg_set_id] = cookie
+            for conj_match in CONJ_ID_RE.finditer(flow):
+                conj_id = int(conj_match.group(1) or conj_match.group(2))
+                self.recovered_conj_ids[conj_id] = (
+                    port_cookie & ~PROVIDER_COOKIE_FLAG)
+            recovered += 1
+        LOG.info(_LI("OVSF recovered %(flows)s flows of %(cookies)s port "
+                     "cookies, with %(sets)s shared rule sets."),
+                 {'flows': recovered, 'cookies': len(self.recovered_cookies),
+                  'sets': len(self.recovered_sg_sets)})
+
+    def remove_stale_recovered_flows(self):
+        """Remove the recovered flows which no port claimed.
+
+        Meant to be called once the ports found after a restart have all
+        been applied again. Flows of filtered ports, and of the rule sets
+        which have members, are kept even if they could not be applied.
+        Recovered rule sets left without members are removed.
+        """
+        stale_cookies = self.recovered_cookies
+        recovered_sg_sets = self.recovered_sg_sets
+        self.recovered_cookies = set()
+        self.recovered_conj_ids = {}
+        self.recovered_sg_sets = {}
+        for port_id in self.filtered_ports:
+            stale_cookies.discard(self.get_cookie(port_id))
+            stale_cookies.discard(self.get_cookie(port_id, True))
+        for sg_set_id, members in self.sg_set_ports.items():
+            if members:
+                stale_cookies.discard(
+                    self.get_cookie(self._get_sg_set_name(sg_set_id)))
+        if not stale_cookies:
+            return
+        LOG.info(_LI("OVSF removing the recovered flows of %(cookies)s "
+                     "cookies no port claimed, with %(sets)s shared rule "
+                     "sets."),
+                 {'cookies': len(stale_cookies),
+                  'sets': len([cookie for cookie in
+                               recovered_sg_sets.values()
+                               if cookie in stale_cookies])})
+        with self.sg_br.deferred() as deferred_sec_br:
+            for cookie in sorted(stale_cookies):
+                self.installed_flows.pop(cookie, None)
+                deferred_sec_br.delete_flows(cookie="%s/0x%x" %
+                                             (cookie, PORT_COOKIE_MASK))
 
     def remove_stale_port_flows(self, port_id, mac_address, vlan):
         """Remove all flows for a port."""
 
         LOG.debug("OVSF Removing flows for stale port: %s.", port_id)
+        removed = [port_id]
+        port_cookie = self.get_cookie(port_id)
+        port_provider_cookie = self.get_cookie(port_id, True)
+        self.installed_flows.pop(port_cookie, None)
+        self.installed_flows.pop(port_provider_cookie, None)
         with self.sg_br.deferred() as deferred_sec_br:
             try:
-                deferred_sec_br.delete_flows(cookie="%s/-1" %
-                                             self.get_cookie(port_id))
-                deferred_sec_br.delete_flows(cookie="%s/-1" %
-                                             self.get_cookie('pr' + port_id))
+                deferred_sec_br.delete_flows(cookie="%s/0x%x" %
+                                             (port_cookie, PORT_COOKIE_MASK))
+                deferred_sec_br.delete_flows(cookie="%s/0x%x" %
+                                             (port_provider_cookie,
+                                              PORT_COOKIE_MASK))
+                removed.append(self._remove_port_sg_set(deferred_sec_br,
+                                                        port_id))
                 deferred_sec_br.delete_flows(
                     table=ovsvapp_const.SG_LEARN_TABLE_ID,
                     dl_src=mac_address,
@@ -631,3 +1363,4 @@ class OVSFirewallDriver(firewall.FirewallDriver):
             except Exception:
                 LOG.exception(_LE("OVSF unable to remove flows for port: "
                                   "%s."), port_id)
+        self._release_conj_ids([name for name in removed if name])
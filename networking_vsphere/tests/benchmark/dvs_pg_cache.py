@@ -0,0 +1,108 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Port group lookup benchmark for the DVSControllerWithCache cache.
+
+Compares the time to find the cache entry of a port group by its key with
+the scan over all cached port groups that was used before the pg_key index,
+and the cost of keeping the index current on create and delete.
+
+Usage: python -m networking_vsphere.tests.benchmark.dvs_pg_cache [count]
+"""
+
+import random
+import sys
+import threading
+import time
+
+import mock
+import six
+
+from networking_vsphere.utils import dvs_util
+
+PORT_GROUPS = 5000
+LOOKUPS = 2000
+ITERATIONS = 5
+
+
+def _make_controller(count):
+    controller = dvs_util.DVSControllerWithCache.__new__(
+        dvs_util.DVSControllerWithCache)
+    controller.dvs_name = 'dvs'
+    controller._pg_cache_lock = threading.Condition()
+    controller._pg_cache = {}
+    controller._pg_names_by_key = {}
+    with controller._pg_cache_lock:
+        for i in range(count):
+            controller._set_pg_status(
+                'dvs-net-%s' % i, dvs_util.READY_PG_STATUS,
+                item=mock.Mock(value='dvportgroup-%s' % i),
+                pg_key='dvportgroup-%s' % i)
+    return controller
+
+
+def _scan(controller, pg_key):
+    return next((name for name, pg in six.iteritems(controller._pg_cache)
+                 if pg.get('pg_key') == pg_key), None)
+
+
+def _best_time(func, *args):
+    best = None
+    for _i in range(ITERATIONS):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _lookups(lookup, controller, pg_keys):
+    for pg_key in pg_keys:
+        lookup(controller, pg_key)
+
+
+def _churn(controller, count):
+    with controller._pg_cache_lock:
+        for i in range(count):
+            name = 'dvs-churn-%s' % i
+            controller._set_pg_status(name, dvs_util.CREATING_PG_STATUS,
+                                      item=None, pg_key=None)
+            controller._set_pg_status(name, dvs_util.READY_PG_STATUS,
+                                      item=None, pg_key='churn-%s' % i)
+            controller._pop_pg(name)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else PORT_GROUPS
+    controller = _make_controller(count)
+    rand = random.Random(42)
+    pg_keys = ['dvportgroup-%s' % rand.randrange(count)
+               for _i in range(LOOKUPS)]
+
+    scan_time = _best_time(_lookups, _scan, controller, pg_keys)
+    index_time = _best_time(
+        _lookups, dvs_util.DVSControllerWithCache._get_pg_name_by_key,
+        controller, pg_keys)
+    churn_time = _best_time(_churn, controller, LOOKUPS)
+
+    print("%d port groups, %d lookups" % (count, LOOKUPS))
+    print("%-24s %12s" % ('operation', 'us per call'))
+    print("%-24s %12.2f" % ('scan lookup', scan_time * 1e6 / LOOKUPS))
+    print("%-24s %12.2f" % ('index lookup', index_time * 1e6 / LOOKUPS))
+    print("%-24s %12.2f" % ('create+delete', churn_time * 1e6 / LOOKUPS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Port config spec build benchmark for the DVS security group rules.
+
+Compares the time to build the port config specs of a batch of ports with
+the per call rule memo that was used before the compiled rule caches, for
+a first batch (cold caches) and for the following ones (warm caches).
+
+Usage: python -m networking_vsphere.tests.benchmark.dvs_port_rules [count]
+"""
+
+import copy
+import sys
+import time
+
+from networking_vsphere.utils import security_group_utils as sg_util
+
+PORTS = 1000
+RULE_SETS = 20
+RULES_PER_SET = 12
+ITERATIONS = 5
+
+
+class FakeSpec(object):
+    """Plain object standing for a suds object of the vSphere API."""
+
+    def __init__(self, spec_type):
+        self.spec_type = spec_type
+
+
+class FakeFactory(object):
+
+    def create(self, spec_type):
+        return FakeSpec(spec_type)
+
+
+def _make_ports(count):
+    rule_sets = []
+    for i in range(RULE_SETS):
+        rules = []
+        for j in range(RULES_PER_SET):
+            rules.append({'direction': 'ingress' if j % 2 else 'egress',
+                          'ethertype': 'IPv4',
+                          'protocol': 'tcp',
+                          'port_range_min': 1000 + j,
+                          'port_range_max': 1000 + j,
+                          'source_ip_prefix': '10.%d.%d.0/24' % (i, j)})
+        rules.append({'direction': 'ingress', 'ethertype': 'IPv6',
+                      'source_ip_prefix': '::/0', 'protocol': 'ipv6-icmp'})
+        rule_sets.append(rules)
+    return [{'id': 'port-%s' % i,
+             'binding:vif_details': {'dvs_port_key': str(i)},
+             'security_group_rules': list(rule_sets[i % RULE_SETS])}
+            for i in range(count)]
+
+
+def _legacy_port_configuration(builder, port_key, sg_rules, hashed_rules):
+    rules = []
+    seq = 0
+    reverse_seq = len(sg_rules) * 10
+    for rule_info in sg_rules:
+        rule_hash = ','.join('%s:%s' % (k, rule_info[k])
+                             for k in sorted(rule_info)
+                             if k in sg_util.HASHED_RULE_INFO_KEYS)
+        if rule_hash in hashed_rules:
+            rule, reverse_rule = hashed_rules[rule_hash]
+            built_rule = copy.copy(rule)
+            built_reverse_rule = copy.copy(reverse_rule)
+            built_rule.description = str(seq) + '. regular'
+            built_rule.sequence = seq
+            built_reverse_rule.description = '%s. reversed %s' % (
+                str(reverse_seq), built_rule.description)
+            built_reverse_rule.sequence = reverse_seq
+        else:
+            rule = sg_util._create_rule(builder, rule_info, name='regular')
+            built_rule = rule.build(seq)
+            cidr_revert = not sg_util._rule_excepted(rule)
+            reverse_rule = rule.reverse(cidr_revert)
+            built_reverse_rule = reverse_rule.build(reverse_seq)
+            hashed_rules[rule_hash] = (built_rule, built_reverse_rule)
+        rules.extend([built_rule, built_reverse_rule])
+        seq += 10
+        reverse_seq += 10
+
+    seq = len(rules) * 10
+    rules.append(sg_util.DropAllRule(builder, 'IPv4', None,
+                                     name='drop all').build(seq))
+    seq += 10
+    rules.append(sg_util.DropAllRule(builder, 'IPv6', None,
+                                     name='drop all').build(seq))
+
+    setting = builder.port_setting()
+    setting.filterPolicy = builder.filter_policy(rules)
+    spec = builder.port_config_spec(setting=setting)
+    spec.key = port_key
+    return spec
+
+
+def _legacy_batch(builder, ports):
+    hashed_rules = {}
+    return [_legacy_port_configuration(
+        builder, port['binding:vif_details']['dvs_port_key'],
+        port['security_group_rules'], hashed_rules) for port in ports]
+
+
+def _cached_batch(builder, ports):
+    return [sg_util.port_configuration(
+        builder, port['binding:vif_details']['dvs_port_key'],
+        port['security_group_rules']) for port in ports]
+
+
+def _cold_cached_batch(builder, ports):
+    sg_util._built_rules.clear()
+    sg_util._filter_policies.clear()
+    return _cached_batch(builder, ports)
+
+
+def _best_time(func, *args):
+    best = None
+    for _i in range(ITERATIONS):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else PORTS
+    builder = sg_util.PortConfigSpecBuilder(FakeFactory())
+    ports = _make_ports(count)
+
+    legacy_time = _best_time(_legacy_batch, builder, ports)
+    cold_time = _best_time(_cold_cached_batch, builder, ports)
+    warm_time = _best_time(_cached_batch, builder, ports)
+
+    print("%d ports, %d rule sets of %d rules" % (
+        count, RULE_SETS, RULES_PER_SET + 1))
+    print("%-24s %12s" % ('batch', 'ms per batch'))
+    print("%-24s %12.2f" % ('per call memo', legacy_time * 1e3))
+    print("%-24s %12.2f" % ('cached, cold', cold_time * 1e3))
+    print("%-24s %12.2f" % ('cached, warm', warm_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Copyright (c) 2016 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Fake bridges used by the benchmarks, so that they run without OVS."""
+
+from neutron.agent.common import ovs_lib
+
+STAT_KEYS = ('commits', 'flows_added', 'flows_modified', 'flows_deleted',
+             'flow_bytes')
+
+ACTION_STATS = {'add': 'flows_added',
+                'mod': 'flows_modified',
+                'del': 'flows_deleted'}
+
+
+class RecordingBridge(object):
+    """Security bridge replacement recording the flow changes it gets.
+
+    Every flow is rendered to the text ovs-ofctl would be given, so that
+    its size can be measured. Each applied deferred bridge counts as one
+    commit.
+    """
+
+    def __init__(self, br_name='br-sec'):
+        self.br_name = br_name
+        self.reset()
+
+    def reset(self):
+        self.stats = dict.fromkeys(STAT_KEYS, 0)
+
+    def _record(self, action, flow):
+        self.stats[ACTION_STATS[action]] += 1
+        self.stats['flow_bytes'] += len(
+            ovs_lib._build_flow_expr_str(dict(flow), action)) + 1
+
+    def add_flow(self, **kwargs):
+        self._record('add', kwargs)
+
+    def mod_flow(self, **kwargs):
+        self._record('mod', kwargs)
+
+    def delete_flows(self, **kwargs):
+        self._record('del', kwargs)
+
+    def dump_flows_for_table(self, table):
+        return ""
+
+    def deferred(self, **kwargs):
+        return RecordingDeferredBridge(self)
+
+
+class RecordingDeferredBridge(object):
+    """Deferred bridge handing its flow changes over as one commit."""
+
+    def __init__(self, br):
+        self.br = br
+        self.action_flow_tuples = []
+
+    def add_flow(self, **kwargs):
+        self.action_flow_tuples.append(('add', kwargs))
+
+    def mod_flow(self, **kwargs):
+        self.action_flow_tuples.append(('mod', kwargs))
+
+    def delete_flows(self, **kwargs):
+        self.action_flow_tuples.append(('del', kwargs))
+
+    def apply_flows(self):
+        if not self.action_flow_tuples:
+            return
+        self.br.stats['commits'] += 1
+        for action, flow in self.action_flow_tuples:
+            self.br._record(action, flow)
+        self.action_flow_tuples = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.apply_flows()
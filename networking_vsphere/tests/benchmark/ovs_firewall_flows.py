@@ -0,0 +1,345 @@
+# Copyright (c) 2016 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Flow generation benchmark for OVSFirewallDriver.
+
+Feeds synthetic ports through prepare_port_filter, update_port_filter and
+clean_port_filters (or their batch variants) against a recording bridge,
+so that no Open vSwitch is needed. The ports belong to security groups with
+a realistic mix of rules: single ports and port ranges, remote groups,
+IPv4 and IPv6, and some of them have allowed address pairs. Remote groups
+are expanded the way the agent does before handing ports to the driver.
+
+For every firewall mode, API and phase, the throughput and the flow changes
+sent to the bridge are reported. The results can also be written as JSON
+to track regressions between runs.
+
+Usage: python -m networking_vsphere.tests.benchmark.ovs_firewall_flows
+       [--ports N] [--groups N] [--iterations N] [--seed N]
+       [--json FILE|-]
+"""
+
+import argparse
+import copy
+import json
+import platform
+import random
+import sys
+import time
+import uuid
+
+from oslo_config import cfg
+
+from networking_vsphere.agent import ovsvapp_sg_agent
+from networking_vsphere.common import config as ovsvapp_config
+from networking_vsphere.common import constants as ovsvapp_const
+from networking_vsphere.drivers import ovs_firewall as ovs_fw
+from networking_vsphere.tests.benchmark import fakes
+
+DEFAULT_PORTS = 200
+DEFAULT_GROUPS = 10
+DEFAULT_ITERATIONS = 3
+DEFAULT_SEED = 42
+NETWORKS = 4
+AAP_EVERY = 5
+
+MODES = {
+    'default': {'use_conjunction': False,
+                'use_shared_rule_tables': False},
+    'conjunction': {'use_conjunction': True,
+                    'use_shared_rule_tables': False},
+    'shared_rule_tables': {'use_conjunction': True,
+                           'use_shared_rule_tables': True},
+}
+
+APIS = ('port', 'batch')
+
+PHASES = ('prepare', 'update_noop', 'update_rule', 'update_member', 'clean')
+
+
+def _rule(direction, ethertype, protocol=None, port_min=None, port_max=None,
+          prefix=None, remote_group_id=None):
+    rule = {'direction': direction,
+            'ethertype': ethertype,
+            'protocol': protocol,
+            'port_range_min': port_min,
+            'port_range_max': port_max,
+            'remote_group_id': remote_group_id}
+    if prefix:
+        rule[ovsvapp_const.DIRECTION_IP_PREFIX[direction]] = prefix
+    return rule
+
+
+def _group_rules(rand, group_id, group_ids):
+    """Rules of a security group, as sent by the server."""
+    range_min = rand.choice((1024, 5000, 8000, 9000))
+    other_group_id = rand.choice(group_ids)
+    rules = [
+        _rule('ingress', 'IPv4', 'tcp', 22, 22, '10.0.0.0/8'),
+        _rule('ingress', 'IPv4', 'tcp', 80, 80),
+        _rule('ingress', 'IPv4', 'tcp', 443, 443),
+        _rule('ingress', 'IPv4', 'tcp', range_min, range_min + 999,
+              '192.168.0.0/16'),
+        _rule('ingress', 'IPv4', 'udp', 32768, 60999),
+        _rule('ingress', 'IPv4', 'icmp'),
+        _rule('ingress', 'IPv4', 'tcp', 5432, 5432,
+              remote_group_id=other_group_id),
+        _rule('ingress', 'IPv4', remote_group_id=group_id),
+        _rule('ingress', 'IPv6', 'tcp', 443, 443, 'fd00::/8'),
+        _rule('ingress', 'IPv6', 'icmp'),
+        _rule('ingress', 'IPv6', 'tcp', range_min, range_min + 99,
+              remote_group_id=group_id),
+        _rule('egress', 'IPv4'),
+        _rule('egress', 'IPv6'),
+    ]
+    for rule in rules:
+        rule['security_group_id'] = group_id
+    return rules
+
+
+def _provider_rules(port):
+    """DHCP rules the server adds for every port."""
+    network = port['lvid'] - 100
+    return [
+        {'direction': 'ingress', 'ethertype': 'IPv4', 'protocol': 'udp',
+         'port_range_min': 68, 'port_range_max': 68,
+         'source_port_range_min': 67, 'source_port_range_max': 67,
+         'source_ip_prefix': '10.%d.0.2/32' % network},
+        {'direction': 'ingress', 'ethertype': 'IPv6', 'protocol': 'udp',
+         'port_range_min': 546, 'port_range_max': 546,
+         'source_port_range_min': 547, 'source_port_range_max': 547,
+         'source_ip_prefix': 'fe80::/64'},
+    ]
+
+
+class Topology(object):
+    """Synthetic ports and security groups, generated from a seed."""
+
+    def __init__(self, port_count, group_count, seed):
+        rand = random.Random(seed)
+        self.group_ids = [str(uuid.UUID(int=rand.getrandbits(128)))
+                          for _i in range(group_count)]
+        self.group_rules = dict(
+            (group_id, _group_rules(rand, group_id, self.group_ids))
+            for group_id in self.group_ids)
+        self.member_ips = dict((group_id, [])
+                               for group_id in self.group_ids)
+        self.ports = []
+        for index in range(port_count):
+            network = index % NETWORKS
+            host = index // NETWORKS + 10
+            port = {'id': str(uuid.UUID(int=rand.getrandbits(128))),
+                    'mac_address': 'fa:16:3e:%02x:%02x:%02x' % (
+                        network, host >> 8 & 0xff, host & 0xff),
+                    'network_id': 'net-%d' % network,
+                    'lvid': 100 + network,
+                    'fixed_ips': ['10.%d.%d.%d' % (
+                        network, host >> 8 & 0xff, host & 0xff)],
+                    'security_groups': rand.sample(
+                        self.group_ids, min(rand.choice((1, 1, 2)),
+                                            group_count))}
+            if index % 2 == 0:
+                port['fixed_ips'].append('fd00:%x::%x' % (network, host))
+            if index % AAP_EVERY == 0:
+                port['allowed_address_pairs'] = [
+                    {'ip_address': '10.%d.250.%d' % (network, host & 0xff),
+                     'mac_address': port['mac_address']}]
+            for group_id in port['security_groups']:
+                self.member_ips[group_id].extend(port['fixed_ips'])
+            self.ports.append(port)
+
+    def add_rule(self, group_id):
+        self.group_rules[group_id].append(
+            _rule('ingress', 'IPv4', 'tcp', 9443, 9443, '172.16.0.0/12'))
+        self.group_rules[group_id][-1]['security_group_id'] = group_id
+
+    def add_member(self, group_id, ip):
+        self.member_ips[group_id].append(ip)
+
+    def members(self, group_id):
+        return [port for port in self.ports
+                if group_id in port['security_groups']]
+
+    def users(self, group_id):
+        """Ports having a rule with the group as remote group."""
+        users = []
+        for port in self.ports:
+            for member_of in port['security_groups']:
+                if any(rule['remote_group_id'] == group_id
+                       for rule in self.group_rules[member_of]):
+                    users.append(port)
+                    break
+        return users
+
+    def port_info(self, port):
+        """Port as returned by security_group_info_for_esx_devices."""
+        port_info = copy.deepcopy(port)
+        port_info['security_group_source_groups'] = []
+        port_info['security_group_rules'] = _provider_rules(port)
+        port_info['sg_normal_rules'] = []
+        for group_id in port['security_groups']:
+            port_info['sg_normal_rules'].extend(
+                copy.deepcopy(self.group_rules[group_id]))
+        return port_info
+
+
+def _make_driver(mode):
+    ovsvapp_config.register_options()
+    cfg.CONF.set_override('security_bridge_mapping', None, 'SECURITYGROUP')
+    driver = ovs_fw.OVSFirewallDriver()
+    for name, value in MODES[mode].items():
+        setattr(driver, name, value)
+    driver.sg_br = fakes.RecordingBridge()
+    driver.phy_ofport = 1
+    driver.patch_ofport = 2
+    return driver
+
+
+def _expand(driver, topology, ports):
+    """Expand remote groups the way the security group agent does."""
+    agent = ovsvapp_sg_agent.OVSvAppSecurityGroupAgent.__new__(
+        ovsvapp_sg_agent.OVSvAppSecurityGroupAgent)
+    agent.firewall = driver
+    expanded = []
+    for port in ports:
+        port_info = {'member_ips': topology.member_ips,
+                     'ports': {port['id']: topology.port_info(port)}}
+        expanded.append(agent.expand_sg_rules(port_info)[port['id']])
+    return expanded
+
+
+def _installed_flows(driver):
+    return sum(len(flows) for flows in driver.installed_flows.values())
+
+
+def _run_phase(driver, api, phase, ports):
+    if phase == 'prepare':
+        driver.add_ports_to_filter(ports)
+        if api == 'batch':
+            driver.prepare_port_filters(ports)
+        else:
+            for port in ports:
+                driver.prepare_port_filter(port)
+    elif phase == 'clean':
+        driver.clean_port_filters([port['id'] for port in ports], True)
+    elif api == 'batch':
+        driver.update_port_filters(ports)
+    else:
+        for port in ports:
+            driver.update_port_filter(port)
+
+
+def run(mode, api, port_count, group_count, seed):
+    """Run all phases once and return the measurements of each phase."""
+    topology = Topology(port_count, group_count, seed)
+    driver = _make_driver(mode)
+    sec_br = driver.sg_br
+    results = []
+    for phase in PHASES:
+        if phase == 'update_rule':
+            changed_group = topology.group_ids[0]
+            topology.add_rule(changed_group)
+            ports = topology.members(changed_group)
+        elif phase == 'update_member':
+            changed_group = topology.group_ids[-1]
+            topology.add_member(changed_group, '10.255.0.1')
+            ports = topology.users(changed_group)
+        else:
+            ports = topology.ports
+        ports = _expand(driver, topology, ports)
+        sec_br.reset()
+        start = time.time()
+        _run_phase(driver, api, phase, ports)
+        elapsed = time.time() - start
+        result = {'mode': mode,
+                  'api': api,
+                  'phase': phase,
+                  'ports': len(ports),
+                  'seconds': elapsed,
+                  'installed_flows': _installed_flows(driver)}
+        result.update(sec_br.stats)
+        results.append(result)
+    return results
+
+
+def benchmark(port_count, group_count, iterations, seed):
+    """Best time out of all iterations, for every mode, API and phase."""
+    results = []
+    for mode in sorted(MODES):
+        for api in APIS:
+            best = None
+            for _i in range(iterations):
+                current = run(mode, api, port_count, group_count, seed)
+                if best is None:
+                    best = current
+                    continue
+                for best_result, result in zip(best, current):
+                    best_result['seconds'] = min(best_result['seconds'],
+                                                 result['seconds'])
+            for result in best:
+                seconds = result['seconds']
+                ports = result['ports']
+                result['ports_per_second'] = (ports / seconds
+                                              if seconds else None)
+                result['flows_per_port'] = (
+                    float(result['flows_added']) / ports if ports else 0.0)
+            results.extend(best)
+    return results
+
+
+def _print_table(results):
+    print("%-18s %-5s %-13s %6s %9s %8s %8s %8s %10s %8s %9s" %
+          ('mode', 'api', 'phase', 'ports', 'ports/s', 'commits', 'added',
+           'deleted', 'bytes', 'flows/p', 'installed'))
+    for result in results:
+        print("%-18s %-5s %-13s %6d %9.0f %8d %8d %8d %10d %8.1f %9d" %
+              (result['mode'], result['api'], result['phase'],
+               result['ports'], result['ports_per_second'] or 0,
+               result['commits'], result['flows_added'],
+               result['flows_deleted'], result['flow_bytes'],
+               result['flows_per_port'], result['installed_flows']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Flow generation benchmark for OVSFirewallDriver.")
+    parser.add_argument('--ports', type=int, default=DEFAULT_PORTS)
+    parser.add_argument('--groups', type=int, default=DEFAULT_GROUPS)
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results as JSON to FILE, or to "
+                             "stdout instead of the table with '-'")
+    args = parser.parse_args(argv)
+    results = benchmark(args.ports, args.groups, args.iterations, args.seed)
+    if args.json:
+        report = {'benchmark': 'ovs_firewall_flows',
+                  'python': platform.python_version(),
+                  'parameters': {'ports': args.ports,
+                                 'groups': args.groups,
+                                 'iterations': args.iterations,
+                                 'seed': args.seed},
+                  'results': results}
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+            return
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+    _print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Copyright (c) 2016 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Flow count benchmark for port range compilation in OVSFirewallDriver.
+
+Compares the number of flows, the size of the flow text handed to
+ovs-ofctl and the generation time of the per port expansion that was used
+before port ranges were compiled into value/mask matches.
+
+Usage: python -m networking_vsphere.tests.benchmark.ovs_firewall_ranges
+"""
+
+import itertools
+import time
+
+from oslo_config import cfg
+
+from networking_vsphere.common import config as ovsvapp_config
+from networking_vsphere.drivers import ovs_firewall as ovs_fw
+from networking_vsphere.tests.benchmark import fakes
+
+ITERATIONS = 5
+
+TYPICAL_RULE_SETS = {
+    'ssh_http_https': [(22, 22, None, None), (80, 80, None, None),
+                       (443, 443, None, None)],
+    'ephemeral': [(32768, 60999, None, None)],
+    'tcp_1024_2048': [(1024, 2048, None, None)],
+    'app_cluster': [(5000, 5100, None, None), (8000, 8999, None, None),
+                    (9000, 9100, 1024, 2048)],
+    'dns_ntp_dhcp': [(53, 53, None, None), (123, 123, None, None),
+                     (67, 68, 67, 68)],
+}
+
+
+def _legacy_port_matches(port_min, port_max):
+    if ((port_min is None and port_max is None) or
+            (port_min == 1 and port_max == ovs_fw.MAX_TP_PORT)):
+        return [None]
+    return range(port_min, port_max + 1)
+
+
+class LegacyRangeDriver(ovs_fw.OVSFirewallDriver):
+    """Driver installing one flow per port of a range."""
+
+    def _add_flow_with_range(self, sec_br, port, flow, direction,
+                             dest_port_min=None, dest_port_max=None,
+                             src_port_min=None, src_port_max=None):
+        for dest_port, src_port in itertools.product(
+                _legacy_port_matches(dest_port_min, dest_port_max),
+                _legacy_port_matches(src_port_min, src_port_max)):
+            if dest_port is not None:
+                flow["tp_dst"] = dest_port
+            if src_port is not None:
+                flow["tp_src"] = src_port
+            self._add_flows_to_sec_br(sec_br, port, flow, direction)
+
+
+def _make_driver(driver_cls):
+    ovsvapp_config.register_options()
+    cfg.CONF.set_override('security_bridge_mapping', None, 'SECURITYGROUP')
+    driver = driver_cls()
+    driver.phy_ofport = 1
+    driver.patch_ofport = 2
+    driver.filtered_ports['port-1'] = {'lvid': 100}
+    return driver
+
+
+def _make_port(ranges):
+    rules = []
+    for dest_min, dest_max, src_min, src_max in ranges:
+        rules.append({'direction': 'ingress',
+                      'protocol': 'tcp',
+                      'ethertype': 'IPv4',
+                      'port_range_min': dest_min,
+                      'port_range_max': dest_max,
+                      'source_port_range_min': src_min,
+                      'source_port_range_max': src_max,
+                      'source_ip_prefix': '10.0.0.0/24'})
+    return {'id': 'port-1',
+            'mac_address': '00:11:22:33:44:55',
+            'lvid': 100,
+            'fixed_ips': ['10.0.0.5'],
+            'security_group_rules': rules}
+
+
+def _run(driver, port):
+    start = time.time()
+    for _i in range(ITERATIONS):
+        sec_br = fakes.RecordingBridge()
+        driver._add_flows(sec_br, port, '0x1')
+    elapsed = (time.time() - start) / ITERATIONS
+    return (sec_br.stats['flows_added'], sec_br.stats['flow_bytes'],
+            elapsed)
+
+
+def main():
+    legacy = _make_driver(LegacyRangeDriver)
+    compiled = _make_driver(ovs_fw.OVSFirewallDriver)
+    print("%-16s %10s %10s %12s %12s %10s %10s" %
+          ('rule set', 'old flows', 'new flows', 'old bytes',
+           'new bytes', 'old ms', 'new ms'))
+    for name, ranges in sorted(TYPICAL_RULE_SETS.items()):
+        port = _make_port(ranges)
+        old_flows, old_bytes, old_time = _run(legacy, port)
+        new_flows, new_bytes, new_time = _run(compiled, port)
+        print("%-16s %10d %10d %12d %12d %10.2f %10.2f" %
+              (name, old_flows, new_flows, old_bytes, new_bytes,
+               old_time * 1000, new_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Copyright 2016 Mirantis, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Security group info translation benchmark for the DVS agent.
+
+Compares the time rpc_translator.update_rules takes to turn the enhanced
+security group RPC response of many devices sharing a few security groups
+into rules per device with the expansion per device that was used before
+remote group rules were expanded once per response.
+
+Usage: python -m networking_vsphere.tests.benchmark.rpc_translator [count]
+"""
+
+import copy
+import sys
+import time
+
+import netaddr
+
+from networking_vsphere.utils import rpc_translator
+
+DEVICES = 1000
+SECURITY_GROUPS = 20
+GROUPS_PER_DEVICE = 3
+MEMBERS_PER_GROUP = 50
+ITERATIONS = 5
+
+
+def _make_devices_info(count):
+    security_groups = {}
+    sg_member_ips = {}
+    for i in range(SECURITY_GROUPS):
+        sg = 'sg-%s' % i
+        security_groups[sg] = [
+            {'direction': 'ingress', 'ethertype': 'IPv4', 'protocol': 'tcp',
+             'port_range_min': 22, 'port_range_max': 22,
+             'remote_group_id': sg, 'security_group_id': sg},
+            {'direction': 'ingress', 'ethertype': 'IPv6',
+             'remote_group_id': sg, 'security_group_id': sg},
+            {'direction': 'egress', 'ethertype': 'IPv4',
+             'security_group_id': sg}]
+        sg_member_ips[sg] = {
+            'IPv4': ['10.%d.0.%d' % (i, j) for j in range(MEMBERS_PER_GROUP)],
+            'IPv6': ['fd00:%x::%x' % (i, j)
+                     for j in range(MEMBERS_PER_GROUP)]}
+    devices = {}
+    for i in range(count):
+        sg = i % SECURITY_GROUPS
+        devices['port-%s' % i] = {
+            'fixed_ips': ['10.%d.0.%d' % (sg, i % MEMBERS_PER_GROUP)],
+            'security_groups': [
+                'sg-%s' % ((sg + j) % SECURITY_GROUPS)
+                for j in range(GROUPS_PER_DEVICE)],
+            'security_group_rules': []}
+    return {'devices': devices, 'security_groups': security_groups,
+            'sg_member_ips': sg_member_ips}
+
+
+def _legacy_update_rules(devices_rules_info):
+    sg_members = devices_rules_info['sg_member_ips']
+    devices = devices_rules_info['devices']
+    result = copy.copy(devices)
+    for device, device_info in devices.items():
+        device_ips = device_info['fixed_ips']
+        for sg in device_info['security_groups']:
+            for sg_rule in devices_rules_info['security_groups'][sg]:
+                if 'remote_group_id' in sg_rule:
+                    result[device]['security_group_rules'].extend(
+                        _legacy_build_rules_from_sg(sg_rule, sg_members,
+                                                    device_ips))
+                else:
+                    result[device]['security_group_rules'].append(sg_rule)
+    return result
+
+
+def _legacy_build_rules_from_sg(rule, sg_members, device_ips):
+    rules = []
+    for ip in sg_members[rule['remote_group_id']][rule['ethertype']]:
+        if ip not in device_ips:
+            r_builder = copy.copy(rule)
+            direction_ip_prefix = 'source_ip_prefix' \
+                if rule['direction'] == 'ingress' else 'dest_ip_prefix'
+            r_builder[direction_ip_prefix] = str(netaddr.IPNetwork(ip).cidr)
+            rules.append(r_builder)
+    return rules
+
+
+def _best_time(update_rules, count):
+    best = None
+    for _i in range(ITERATIONS):
+        # update_rules adds the rules to the devices of the response.
+        devices_info = _make_devices_info(count)
+        start = time.time()
+        update_rules(devices_info)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEVICES
+    legacy_time = _best_time(_legacy_update_rules, count)
+    expanded_time = _best_time(rpc_translator.update_rules, count)
+
+    print("%d devices, %d security groups of %d members" % (
+        count, SECURITY_GROUPS, MEMBERS_PER_GROUP))
+    print("%-24s %12s" % ('translation', 'ms per call'))
+    print("%-24s %12.2f" % ('per device', legacy_time * 1e3))
+    print("%-24s %12.2f" % ('per security group', expanded_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from neutron.tests import base
+
+from networking_vsphere.agent.firewalls import dvs_securitygroup_rpc
+
+CONF = dvs_securitygroup_rpc.CONF
+
+
+class DVSSecurityGroupRpcRefreshTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(DVSSecurityGroupRpcRefreshTestCase, self).setUp()
+        self.plugin_rpc = mock.Mock()
+        with mock.patch.object(dvs_securitygroup_rpc.DVSSecurityGroupRpc,
+                               'init_firewall'):
+            self.sg_rpc = dvs_securitygroup_rpc.DVSSecurityGroupRpc(
+                mock.Mock(), self.plugin_rpc)
+        self.sg_rpc.firewall = mock.Mock(ports={'dev-1': {}, 'dev-2': {}})
+        self.sg_rpc.use_enhanced_rpc = False
+        self.plugin_rpc.security_group_rules_for_devices.return_value = {}
+        thread_patch = mock.patch('threading.Thread')
+        self.thread_mock = thread_patch.start()
+        self.addCleanup(thread_patch.stop)
+        self.time = 100.0
+        time_patch = mock.patch('time.time', side_effect=lambda: self.time)
+        time_patch.start()
+        self.addCleanup(time_patch.stop)
+        for name, value in (('firewall_refresh_quiet_period', 2),
+                            ('firewall_refresh_max_delay', 5),
+                            ('firewall_refresh_chunk_size', 2)):
+            CONF.set_override(name, value, 'DVS')
+            self.addCleanup(CONF.clear_override, name, 'DVS')
+
+    def test_refresh_firewall_merges_requests(self):
+        self.sg_rpc.refresh_firewall(set(['dev-1']))
+        self.time += 1
+        self.sg_rpc.refresh_firewall(set(['dev-2', 'dev-3']))
+
+        self.thread_mock.assert_called_once_with(
+            target=self.sg_rpc._refresh_loop, name='dvs-firewall-refresh')
+        self.assertEqual(set(['dev-1', 'dev-2', 'dev-3']),
+                         self.sg_rpc._devices_to_update)
+        self.assertEqual(103.0, self.sg_rpc._get_refresh_deadline())
+
+    def test_refresh_firewall_max_delay(self):
+        self.sg_rpc.refresh_firewall(set(['dev-1']))
+        for _i in range(4):
+            self.time += 1.5
+            self.sg_rpc.refresh_firewall(set(['dev-2']))
+        self.assertEqual(105.0, self.sg_rpc._get_refresh_deadline())
+
+    def test_refresh_firewall_all_devices(self):
+        self.sg_rpc.refresh_firewall()
+        self.assertEqual(set(['dev-1', 'dev-2']),
+                         self.sg_rpc._devices_to_update)
+
+    def test_wait_for_refresh(self):
+        self.sg_rpc.refresh_firewall(set(['dev-1']))
+        self.time += 2
+        self.assertEqual(set(['dev-1']), self.sg_rpc._wait_for_refresh())
+        self.assertEqual(set(), self.sg_rpc._devices_to_update)
+
+    def test_refresh_devices_in_chunks(self):
+        self.sg_rpc._refresh_devices(set(['dev-1', 'dev-2', 'dev-3']))
+
+        self.assertEqual(
+            [mock.call(self.sg_rpc.context, ['dev-1', 'dev-2']),
+             mock.call(self.sg_rpc.context, ['dev-3'])],
+            self.plugin_rpc.security_group_rules_for_devices.call_args_list)
+        self.assertEqual(2,
+                         self.sg_rpc.firewall.update_port_filter.call_count)
+
+    def test_refresh_devices_failure(self):
+        self.plugin_rpc.security_group_rules_for_devices.side_effect = [
+            {}, Exception('error')]
+        self.sg_rpc._refresh_devices(
+            set(['dev-1', 'dev-2', 'dev-3', 'dev-4', 'dev-5']))
+
+        self.assertEqual(set(['dev-3', 'dev-4', 'dev-5']),
+                         self.sg_rpc._devices_to_update)
+        self.assertEqual(102.0, self.sg_rpc._get_refresh_deadline())
+
+    def test_restore_devices_filter(self):
+        self.sg_rpc.firewall.restore_port_filter.return_value = set(['dev-1'])
+        self.assertEqual(set(['dev-1']), self.sg_rpc.restore_devices_filter(
+            set(['dev-1', 'dev-3'])))
+        self.sg_rpc.firewall.restore_port_filter.assert_called_once_with(
+            set(['dev-1', 'dev-3']))
+        self.assertEqual(set(['dev-1']), self.sg_rpc._devices_to_update)
+
+    def test_restore_devices_filter_without_snapshot(self):
+        self.sg_rpc.firewall = object()
+        self.assertIsNone(self.sg_rpc.restore_devices_filter(set(['dev-1'])))
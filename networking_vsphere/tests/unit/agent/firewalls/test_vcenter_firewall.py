@@ -13,11 +13,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 import mock
+import six
+import time
 import uuid
 
 from neutron.tests import base
 
 from networking_vsphere.agent.firewalls import vcenter_firewall
+from networking_vsphere.utils import dvs_port_index
+from networking_vsphere.utils import dvs_util
+from networking_vsphere.utils import spec_builder
 
 FAKE_PREFIX = {'IPv4': '10.0.0.0/24',
                'IPv6': 'fe80::/48'}
@@ -34,13 +39,20 @@ FAKE_SG_RULE_IPV4_WITH_REMOTE = {'ethertype': 'IPv4', 'direction': 'ingress',
                                  'remote_group_id': '12345'}
 
 
+class FakeSpec(object):
+
+    def __init__(self, spec_type):
+        self.spec_type = spec_type
+
+
 class TestDVSFirewallDriver(base.BaseTestCase):
 
     @mock.patch('networking_vsphere.agent.firewalls.'
                 'vcenter_firewall.firewall_main')
     def setUp(self, firewall_staff_mock):
         super(TestDVSFirewallDriver, self).setUp()
-        self.dvs = mock.Mock()
+        self.dvs = mock.Mock(dvs_name='dvs')
+        self.dvs._get_port_group_names.return_value = []
         self.use_patch(
             'networking_vsphere.utils.dvs_util.create_network_map_from_config',
             return_value={'physnet1': self.dvs})
@@ -76,3 +88,362 @@ class TestDVSFirewallDriver(base.BaseTestCase):
 
     def test__apply_sg_rules_for_port(self):
         self.firewall._apply_sg_rules_for_port([self.port])
+
+    def test_reset_port_filter(self):
+        self.firewall.reset_port_filter([self.port['device']])
+        self.firewall._apply_sg_rules_for_port([self.port])
+        request = self.firewall.list_queues[0].get()
+        self.assertTrue(request[0]['reset_rules'])
+
+        # Only the next update of the port is flagged.
+        self.firewall._apply_sg_rules_for_port([self.port])
+        request = self.firewall.list_queues[0].get()
+        self.assertNotIn('reset_rules', request[0])
+
+    def _get_indexed_controller(self, connection):
+        with mock.patch.object(dvs_util.DVSController, '_get_dvs',
+                               return_value=(mock.Mock(), 'dvs_uuid',
+                                             mock.Mock())):
+            controller = dvs_util.DVSController('dvs', 'cluster', connection)
+        controller.builder = spec_builder.SpecBuilder(connection.factory)
+        controller._port_index = dvs_port_index.DVSPortIndex(
+            connection, controller._dvs, controller.builder)
+        controller._port_index.resync()
+        return controller
+
+    def test_port_filter_port_booked_by_other_controller(self):
+        # A vCenter holding a single free port.
+        ports = {'333': ''}
+
+        def fetch_port(key):
+            port_info = FakeSpec('DistributedVirtualPort')
+            port_info.key = key
+            port_info.config = FakeSpec('DVPortConfigInfo')
+            port_info.config.name = ports[key]
+            port_info.config.configVersion = '1'
+            return port_info
+
+        def invoke_api(module, method, *args, **kwargs):
+            if method == 'FetchDVPorts':
+                keys = getattr(kwargs['criteria'], 'portKey', None) or ports
+                return [fetch_port(key) for key in keys]
+            if method == 'ReconfigureDVPort_Task':
+                for spec in kwargs['port']:
+                    ports[spec.key] = spec.name
+
+        connection = mock.Mock()
+        connection.factory.create.side_effect = FakeSpec
+        connection.invoke_api.side_effect = invoke_api
+        agent_dvs = self._get_indexed_controller(connection)
+        firewall_dvs = self._get_indexed_controller(connection)
+
+        with mock.patch.object(agent_dvs,
+                               '_lookup_unbound_ports_or_increase_pg',
+                               return_value=[fetch_port('333')]):
+            agent_dvs._book_ports(mock.Mock(value='pg'), [self.port['id']])
+        self.firewall.dvs_ports = {}
+        self.firewall.routing_table = dvs_util.DVSRoutingTable(
+            [firewall_dvs])
+        self.port['binding:vif_details']['dvs_id'] = 'dvs_uuid'
+        with mock.patch.object(self.firewall,
+                               '_apply_sg_rules_for_port') as apply_rules:
+            self.firewall.update_port_filter([self.port])
+
+        apply_rules.assert_called_once_with([self.port])
+        self.assertIs(self.port, self.firewall.dvs_ports[self.port['device']])
+
+    def test__get_port_dvs(self):
+        self.assertIs(self.dvs, self.firewall._get_port_dvs(
+            {'binding:vif_details': {'dvs_id': self.dvs._dvs_uuid}}))
+
+        self.firewall.routing_table.add_port_group(self.dvs, 'dvsnet-1')
+        self.assertIs(self.dvs, self.firewall._get_port_dvs(
+            {'network_id': 'net-1', 'binding:vif_details': {}}))
+        self.assertIs(self.dvs, self.firewall._get_port_dvs(
+            {'network_id': 'net-1',
+             'binding:vif_details': {'dvs_port_group_name': 'dvsnet-1'}}))
+        self.assertFalse(self.dvs._get_pg_by_name.called)
+
+    def test_restore_port_filter(self):
+        self.assertIsNone(self.firewall.restore_port_filter(set(['dev-1'])))
+
+        self.firewall.state_store = mock.Mock()
+        port = {'id': 'port-1', 'device': 'dev-1', 'network_id': 'net-1',
+                'binding:vif_details': {'dvs_port_key': '10'}}
+        self.firewall.state_store.get_ports.return_value = {
+            'dev-1': port, 'dev-2': dict(port, device='dev-2')}
+        self.assertEqual(set(['dev-1']),
+                         self.firewall.restore_port_filter(set(['dev-1'])))
+        self.assertIs(port, self.firewall.dvs_ports['dev-1'])
+        self.assertNotIn('dev-2', self.firewall.dvs_ports)
+        self.firewall.state_store.remove_ports.assert_called_once_with(
+            ['dev-2'])
+
+    def test_port_filter_state_store(self):
+        self.firewall.state_store = mock.Mock()
+        self.firewall.update_port_filter([self.port])
+        self.firewall.state_store.set_ports.assert_called_once_with(
+            [{'id': self.port['id'], 'device': self.port['device'],
+              'network_id': self.port['network_id'],
+              'binding:vif_details': self.port['binding:vif_details']}])
+
+        self.firewall.remove_port_filter([self.port['device']])
+        self.firewall.state_store.remove_ports.assert_called_once_with(
+            [self.port['device']])
+
+
+class TestPortQueue(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestPortQueue, self).setUp()
+        self.dvs = mock.Mock(dvs_name='dvs')
+        self.dvs._get_port_group_names.return_value = []
+        patch = mock.patch(
+            'networking_vsphere.utils.dvs_util.create_network_map_from_config',
+            return_value={'physnet1': self.dvs})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.update_queue = six.moves.queue.Queue()
+        self.remove_queue = six.moves.queue.Queue()
+        self.pq = vcenter_firewall.PortQueue([self.update_queue],
+                                             self.remove_queue)
+
+    def _port(self, port_id, key, version=0):
+        return {'id': port_id, 'version': version,
+                'binding:vif_details': {'dvs_port_key': key,
+                                        'dvs_id': 'dvs_uuid'}}
+
+    def test_update_tasks_coalesced(self):
+        self.dvs._dvs_uuid = 'dvs_uuid'
+        self.pq.routing_table = vcenter_firewall.dvs_util.DVSRoutingTable(
+            [self.dvs])
+        self.update_queue.put([self._port('1', '10'), self._port('2', '20')])
+        self.update_queue.put([self._port('1', '10', version=1),
+                               self._port('3', '30')])
+        self.assertEqual(4, self.pq._get_update_tasks())
+
+        dvs, ports = self.pq.get_update_tasks(number=2)
+        self.assertIs(self.dvs, dvs)
+        self.assertEqual([('1', 1), ('2', 0)],
+                         [(p['id'], p['version']) for p in ports])
+        dvs, ports = self.pq.get_update_tasks(number=2)
+        self.assertEqual(['3'], [p['id'] for p in ports])
+        self.assertEqual((None, []), self.pq.get_update_tasks())
+
+    def test_update_tasks_coalesced_keep_reset(self):
+        self.dvs._dvs_uuid = 'dvs_uuid'
+        self.pq.routing_table = vcenter_firewall.dvs_util.DVSRoutingTable(
+            [self.dvs])
+        self.update_queue.put([dict(self._port('1', '10'), reset_rules=True)])
+        self.update_queue.put([self._port('1', '10', version=1)])
+        self.pq._get_update_tasks()
+
+        dvs, ports = self.pq.get_update_tasks()
+        self.assertEqual([('1', 1)], [(p['id'], p['version']) for p in ports])
+        self.assertTrue(ports[0]['reset_rules'])
+
+    def test_removal_cancels_update(self):
+        self.dvs._dvs_uuid = 'dvs_uuid'
+        self.pq.routing_table = vcenter_firewall.dvs_util.DVSRoutingTable(
+            [self.dvs])
+        self.update_queue.put([self._port('1', '10'), self._port('2', '20')])
+        self.pq._get_update_tasks()
+        self.remove_queue.put(self._port('1', '10'))
+        self.assertEqual(1, self.pq._get_remove_tasks())
+        self.update_queue.put([self._port('1', '10', version=1)])
+        self.pq._get_update_tasks()
+
+        dvs, ports = self.pq.get_update_tasks()
+        self.assertEqual(['2'], [p['id'] for p in ports])
+        self.assertEqual(['1'],
+                         [p['id'] for p in self.pq.remove_store[self.dvs]])
+
+    def test_wait_for_tasks(self):
+        self.pq._new_tasks.set()
+        self.pq.wait_for_tasks(10)
+        self.assertFalse(self.pq._new_tasks.is_set())
+
+        self.pq.update_store[self.dvs] = {'1': self._port('1', '10')}
+        with mock.patch.object(self.pq._new_tasks, 'wait') as wait_mock:
+            self.pq.wait_for_tasks(10)
+        self.assertFalse(wait_mock.called)
+
+    def test_get_remove_tasks(self):
+        ports = [self._port('1', '10'), self._port('2', '20'),
+                 self._port('3', '30'), {'id': '4'}]
+        self.pq.remove_store[self.dvs] = list(ports)
+        self.dvs.get_connected_port_keys.return_value = set(['20'])
+
+        self.assertEqual((self.dvs, [ports[0], ports[2], ports[3]]),
+                         self.pq.get_remove_tasks())
+        self.dvs.get_connected_port_keys.assert_called_once_with(
+            set(['10', '20', '30']))
+        self.assertEqual([ports[1]], self.pq.remove_store[self.dvs])
+
+    def test_get_remove_tasks_all_connected(self):
+        ports = [self._port('1', '10')]
+        self.pq.remove_store[self.dvs] = list(ports)
+        self.dvs.get_connected_port_keys.return_value = set(['10'])
+
+        self.assertEqual((None, []), self.pq.get_remove_tasks())
+        self.assertEqual(ports, self.pq.remove_store[self.dvs])
+
+    def test_remover(self):
+        ports = [self._port('1', '10')]
+        vcenter_firewall.remover(self.dvs, ports)
+        self.dvs.release_ports.assert_called_once_with(ports)
+
+    def _queue_updates(self, dvs, count):
+        with mock.patch.object(self.pq, 'get_dvs', return_value=dvs):
+            self.update_queue.put([self._port('%s-%s' % (dvs.dvs_name, i),
+                                              str(i)) for i in range(count)])
+            self.pq._get_update_tasks()
+
+    def test_get_update_tasks_round_robin(self):
+        dvs2 = mock.Mock(dvs_name='dvs2')
+        self._queue_updates(self.dvs, 12)
+        self._queue_updates(dvs2, 3)
+
+        served = []
+        while True:
+            dvs, ports = self.pq.get_update_tasks()
+            if not dvs:
+                break
+            served.append((dvs.dvs_name, len(ports)))
+        self.assertEqual([('dvs', 5), ('dvs2', 3), ('dvs', 5), ('dvs', 2)],
+                         served)
+
+    def test_record_update(self):
+        self._queue_updates(self.dvs, 7)
+        vcenter_firewall.CONF.set_override(
+            'firewall_batch_target_latency', 2.0, 'DVS')
+        vcenter_firewall.CONF.set_override(
+            'firewall_batch_size_cap', 16, 'DVS')
+        self.addCleanup(vcenter_firewall.CONF.clear_override,
+                        'firewall_batch_target_latency', 'DVS')
+        self.addCleanup(vcenter_firewall.CONF.clear_override,
+                        'firewall_batch_size_cap', 'DVS')
+
+        # Fast full batches grow up to twice the size, up to the cap.
+        self.pq.record_update(self.dvs, 5, 0.1)
+        self.assertEqual(10, self.pq._stats[self.dvs]['batch_size'])
+        self.pq.record_update(self.dvs, 10, 0.1)
+        self.assertEqual(16, self.pq._stats[self.dvs]['batch_size'])
+        # Partial batches do not grow it.
+        self.pq.record_update(self.dvs, 3, 0.1)
+        self.assertEqual(16, self.pq._stats[self.dvs]['batch_size'])
+        # Slow tasks shrink it to the size matching the target latency.
+        self.pq.record_update(self.dvs, 16, 8.0)
+        self.assertEqual(4, self.pq._stats[self.dvs]['batch_size'])
+
+        stats = self.pq.get_stats()['dvs']
+        self.assertEqual(7, stats['update_queue_depth'])
+        self.assertEqual(0, stats['remove_queue_depth'])
+        self.assertEqual(4, stats['batch_size'])
+        self.assertAlmostEqual(2.47, stats['latency'])
+
+    def test_record_failure(self):
+        self.pq.record_update(self.dvs, 5, 0.1)
+        self.assertEqual(10, self.pq._stats[self.dvs]['batch_size'])
+        self.pq.record_failure(self.dvs)
+        self.assertEqual(5, self.pq._stats[self.dvs]['batch_size'])
+        # The latency of the successful tasks is kept.
+        self.assertEqual(0.1, self.pq._stats[self.dvs]['latency'])
+        for i in range(5):
+            self.pq.record_failure(self.dvs)
+        self.assertEqual(1, self.pq._stats[self.dvs]['batch_size'])
+
+    def test_updater_loop_failure_not_recorded(self):
+        updater = vcenter_firewall.DVSFirewallUpdater.__new__(
+            vcenter_firewall.DVSFirewallUpdater)
+        updater.pq = mock.Mock()
+        updater.pq.get_remove_tasks.return_value = (None, [])
+        updater.pq.get_update_tasks.return_value = (
+            self.dvs, [self._port('1', '10')])
+        updater.run_daemon_loop = True
+
+        def fail(dvs, ports):
+            updater.run_daemon_loop = False
+            raise vcenter_firewall.exceptions.VMWareDVSException(
+                type='error', message='error', cause='error')
+        with mock.patch.object(vcenter_firewall, 'updater',
+                               side_effect=fail):
+            updater.updater_loop()
+        updater.pq.record_failure.assert_called_once_with(self.dvs)
+        self.assertFalse(updater.pq.record_update.called)
+        updater.pq.requeue_update_tasks.assert_called_once_with(
+            self.dvs, [self._port('1', '10')])
+
+    def test_requeue_update_tasks(self):
+        self._queue_updates(self.dvs, 3)
+        dvs, ports = self.pq.get_update_tasks(number=2)
+        # A newer update of the first port came meanwhile.
+        newer = self._port('dvs-0', '0', version=1)
+        with mock.patch.object(self.pq, 'get_dvs', return_value=self.dvs):
+            self.update_queue.put([newer])
+            self.pq._get_update_tasks()
+        ports[0]['reset_rules'] = True
+
+        self.pq.requeue_update_tasks(dvs, ports)
+        dvs, ports = self.pq.get_update_tasks()
+        self.assertEqual([('dvs-2', 0), ('dvs-0', 1), ('dvs-1', 0)],
+                         [(p['id'], p['version']) for p in ports])
+        self.assertTrue(ports[1]['reset_rules'])
+        self.assertEqual(1, ports[2]['retries'])
+
+    def test_requeue_update_tasks_gives_up(self):
+        self._queue_updates(self.dvs, 1)
+        for i in range(vcenter_firewall.TASK_RETRIES):
+            dvs, ports = self.pq.get_update_tasks()
+            self.pq.requeue_update_tasks(dvs, ports)
+        dvs, ports = self.pq.get_update_tasks()
+        self.assertEqual(['dvs-0'], [p['id'] for p in ports])
+        self.pq.requeue_update_tasks(dvs, ports)
+        self.assertEqual((None, []), self.pq.get_update_tasks())
+
+    def test_requeue_update_tasks_removed_port(self):
+        self._queue_updates(self.dvs, 1)
+        dvs, ports = self.pq.get_update_tasks()
+        self.pq.removed['dvs-0'] = time.time()
+        self.pq.requeue_update_tasks(dvs, ports)
+        self.assertEqual((None, []), self.pq.get_update_tasks())
+
+    def test_updater_loop_requeues_failed_removals(self):
+        updater = vcenter_firewall.DVSFirewallUpdater.__new__(
+            vcenter_firewall.DVSFirewallUpdater)
+        updater.pq = self.pq
+        ports = [self._port('1', '10'), self._port('2', '20')]
+        self.pq.remove_store[self.dvs] = list(ports)
+        self.dvs.get_connected_port_keys.return_value = set()
+        updater.run_daemon_loop = True
+
+        def fail(dvs, ports):
+            updater.run_daemon_loop = False
+            raise vcenter_firewall.exceptions.VMWareDVSException(
+                type='error', message='error', cause='error')
+        with mock.patch.object(vcenter_firewall, 'remover',
+                               side_effect=fail):
+            updater.updater_loop()
+        self.assertEqual(['1', '2'],
+                         [p['id'] for p in self.pq.remove_store[self.dvs]])
+
+        # Not twice when the removal is pending again.
+        self.pq.requeue_remove_tasks(self.dvs, [ports[0]])
+        self.assertEqual(2, len(self.pq.remove_store[self.dvs]))
+
+    def test_log_stats(self):
+        self._queue_updates(self.dvs, 2)
+        with mock.patch.object(vcenter_firewall.LOG, 'info') as info:
+            self.pq.log_stats()
+            self.assertFalse(info.called)
+            self.pq._stats_logged -= vcenter_firewall.STATS_LOG_INTERVAL
+            self.pq.log_stats()
+            self.assertEqual(1, info.call_count)
+            self.assertEqual(2, info.call_args[0][1]['stats']['dvs'][
+                'update_queue_depth'])
+
+            # Nothing to tell while the queues are empty and idle.
+            self.pq.get_update_tasks()
+            self.pq._stats_logged -= vcenter_firewall.STATS_LOG_INTERVAL
+            self.pq.log_stats()
+            self.assertEqual(1, info.call_count)
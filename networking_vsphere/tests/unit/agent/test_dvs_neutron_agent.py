@@ -131,6 +131,68 @@ class DVSAgentTestCase(base.BaseTestCase):
         self.assertTrue(is_valid_dvs.called)
         self.assertFalse(self.dvs.release_port.called)
 
+    def test_dvs_ports_changed(self):
+        self.agent.known_ports = set(['port-1', 'port-2'])
+        self.agent.deleted_ports = set()
+        self.agent.updated_ports = set()
+        self.agent.added_ports = set(['port-4'])
+        self.agent.sg_agent = mock.Mock()
+        self.agent._dvs_ports_changed(set(['port-1', 'port-3']),
+                                      set(['port-2', 'port-4']))
+
+        self.assertEqual(set(['port-3']), self.agent.added_ports)
+        # Reconnected and disconnected ports are synced again, only
+        # port_delete removes them.
+        self.assertEqual(set(['port-1', 'port-2']), self.agent.updated_ports)
+        self.assertEqual(set(), self.agent.deleted_ports)
+        self.assertEqual(set(['port-1', 'port-2']), self.agent.known_ports)
+        # Their configuration was reset on the DVS.
+        self.agent.sg_agent.reset_devices_filter.assert_called_once_with(
+            set(['port-1', 'port-2']))
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time', return_value=1000.0)
+    def test_rpc_loop_iteration(self, time_mock, sleep_mock):
+        def stop(seconds):
+            self.agent.run_daemon_loop = False
+
+        sleep_mock.side_effect = stop
+        self.agent.run_daemon_loop = True
+        self.agent.fullsync = False
+        self.agent.port_monitor = False
+        self.agent.polling_interval = 2
+        self.agent.iter_num = 0
+        self.agent.known_ports = set()
+        self.agent.deleted_ports = set()
+        self.agent.updated_ports = set()
+        self.agent.sg_agent = mock.Mock()
+        polling_manager = mock.Mock(is_polling_required=True)
+
+        self.agent.rpc_loop(polling_manager=polling_manager)
+
+        self.agent.sg_agent.setup_port_filters.assert_called_once_with(
+            set(), set())
+        polling_manager.polling_completed.assert_called_once_with()
+        sleep_mock.assert_called_once_with(2)
+        self.assertEqual(1, self.agent.iter_num)
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_sync_connected_ports(self, time_mock):
+        self.agent.port_monitor = True
+        self.agent.last_port_sync = 1000.0 - 600
+        self.agent.known_ports = set(['port-1'])
+        self.dvs._get_ports_ids.return_value = ['port-1', 'port-2']
+        self.assertTrue(self.agent._port_sync_required())
+
+        self.agent._sync_connected_ports()
+        self.assertEqual(set(['port-2']), self.agent.added_ports)
+        self.assertEqual(1000.0, self.agent.last_port_sync)
+        self.assertFalse(self.agent._port_sync_required())
+
+        self.agent.last_port_sync = 0
+        self.agent.port_monitor = False
+        self.assertFalse(self.agent._port_sync_required())
+
     def _create_ports(self, security_groups=None):
         ports = [
             self._create_port_dict(),
@@ -342,6 +342,7 @@ class TestOVSvAppAgent(base.TestCase):
                 mock.patch.object(mock_br,
                                   "delete_port") as mock_delete_port:
             mock_br.get_bridge_for_iface.return_value = 'br-sec'
+            mock_br.dump_flows_for_table.return_value = ""
             self.agent.recover_security_br()
             self.assertTrue(mock_logger_info.called)
             self.assertFalse(mock_delete_port.called)
@@ -352,6 +353,45 @@ class TestOVSvAppAgent(base.TestCase):
             self.assertTrue(mock_delete_port.called)
             self.assertTrue(mock_add_patch_port.called)
 
+    @mock.patch('neutron.agent.common.ovs_lib.OVSBridge')
+    def test_recover_security_br_flows(self, mock_ovs_bridge):
+        cfg.CONF.set_override('security_bridge_mapping',
+                              "br-sec:physnet1", 'SECURITYGROUP')
+        self.agent.int_br = mock.Mock()
+        self.agent.sec_br_flows = []
+        mock_br = mock_ovs_bridge.return_value
+        mock_br.get_bridge_for_iface.return_value = 'br-sec'
+        mock_br.get_port_ofport.return_value = 6
+        self.agent.int_br.get_port_ofport.return_value = 6
+        mock_br.dump_flows_for_table.side_effect = [
+            "NXST_FLOW reply (xid=0x4):\n cookie=0x1000001, table=0",
+            " cookie=0x1000002, table=1",
+            " cookie=0x2000001, table=6, reg0=0x2",
+            ""]
+        self.agent.recover_security_br()
+        self.assertEqual([" cookie=0x1000001, table=0",
+                          " cookie=0x1000002, table=1",
+                          " cookie=0x2000001, table=6, reg0=0x2"],
+                         self.agent.sec_br_flows)
+        mock_br.dump_flows_for_table.assert_has_calls(
+            [mock.call(ovsvapp_const.SG_DEFAULT_TABLE_ID),
+             mock.call(ovsvapp_const.SG_EGRESS_TABLE_ID),
+             mock.call(ovsvapp_const.SG_INGRESS_RULES_TABLE_ID),
+             mock.call(ovsvapp_const.SG_EGRESS_RULES_TABLE_ID)])
+
+    def test_recover_port_flows(self):
+        self.agent.sec_br_flows = [" cookie=0x1000001, table=0"]
+        self.agent.sg_agent = mock.Mock()
+        firewall = self.agent.sg_agent.firewall
+        with mock.patch.object(time, 'time', return_value=100):
+            self.agent.recover_port_flows()
+        firewall.recover_port_flows.assert_called_once_with(
+            [" cookie=0x1000001, table=0"])
+        self.assertEqual([], self.agent.sec_br_flows)
+        self.assertEqual(
+            100 + cfg.CONF.SECURITYGROUP.stale_flows_cleanup_delay,
+            self.agent.stale_flows_cleanup_time)
+
     @mock.patch('neutron.agent.ovsdb.api.'
                 'API.get')
     def test_recover_physical_bridges(self, mock_ovsdb_api):
@@ -1082,6 +1122,36 @@ class TestOVSvAppAgent(base.TestCase):
             self.assertTrue(mock_firewall_refresh.called)
             self.assertTrue(mock_update_port_bindings.called)
 
+    def _check_for_stale_flows(self, running):
+        self.agent.refresh_firewall_required = False
+        self.agent.ports_to_bind = None
+        self.agent.stale_flows_cleanup_time = 100
+        self.agent._pool = mock.Mock()
+        self.agent._pool.running.return_value = running
+        with mock.patch.object(self.agent, 'check_ovs_status',
+                               return_value=4), \
+                mock.patch.object(self.agent.sg_agent,
+                                  'firewall_refresh_needed',
+                                  return_value=False), \
+                mock.patch.object(self.agent.sg_agent, 't_pool'
+                                  ) as mock_t_pool, \
+                mock.patch.object(self.agent.sg_agent, 'firewall'
+                                  ) as mock_firewall, \
+                mock.patch.object(time, 'time', return_value=101):
+            mock_t_pool.running.return_value = 0
+            self.agent._check_for_updates()
+        return mock_firewall.remove_stale_recovered_flows
+
+    def test_check_for_updates_stale_flows(self):
+        mock_remove = self._check_for_stale_flows(0)
+        mock_remove.assert_called_once_with()
+        self.assertIsNone(self.agent.stale_flows_cleanup_time)
+
+    def test_check_for_updates_stale_flows_pending_updates(self):
+        mock_remove = self._check_for_stale_flows(1)
+        self.assertFalse(mock_remove.called)
+        self.assertEqual(100, self.agent.stale_flows_cleanup_time)
+
     def test_update_devices_up(self):
         self.agent.devices_up_list.append(FAKE_PORT_1)
         ret_value = {'devices_up': [FAKE_PORT_1],
@@ -117,6 +117,49 @@ class TestOVSvAppSecurityGroupAgent(base.TestCase):
             self.agent.add_devices_to_filter([])
             self.assertFalse(mock_add.called)
 
+    def _get_remote_group_ports_info(self):
+        rule = {'direction': 'ingress',
+                'protocol': 'tcp',
+                'port_range_min': 22,
+                'port_range_max': 22,
+                'ethertype': 'IPv4',
+                'remote_group_id': 'sg-1'}
+        port = {'id': '123',
+                'fixed_ips': ['10.0.0.1'],
+                'security_group_source_groups': [],
+                'security_group_rules': [],
+                'sg_normal_rules': [rule]}
+        return {'member_ips': {'sg-1': ['10.0.0.1', '10.0.0.2',
+                                        '10.0.0.3', 'fe80::1']},
+                'ports': {'123': port}}
+
+    def test_expand_sg_rules(self):
+        ports = self.agent.expand_sg_rules(
+            self._get_remote_group_ports_info())
+        rules = ports['123']['security_group_rules']
+        self.assertEqual(['10.0.0.2/32', '10.0.0.3/32'],
+                         [rule['source_ip_prefix'] for rule in rules])
+        self.assertEqual(['sg-1'],
+                         ports['123']['security_group_source_groups'])
+
+    def test_expand_sg_rules_with_conjunction(self):
+        self.agent.firewall.use_conjunction = True
+        ports = self.agent.expand_sg_rules(
+            self._get_remote_group_ports_info())
+        rules = ports['123']['security_group_rules']
+        self.assertEqual(1, len(rules))
+        self.assertNotIn('source_ip_prefix', rules[0])
+        self.assertEqual(['10.0.0.2/32', '10.0.0.3/32'],
+                         rules[0]['remote_ip_prefixes'])
+
+    def test_expand_sg_rules_with_shared_rule_tables(self):
+        self.agent.firewall.use_shared_rule_tables = True
+        ports = self.agent.expand_sg_rules(
+            self._get_remote_group_ports_info())
+        rules = ports['123']['security_group_rules']
+        self.assertEqual(['10.0.0.1/32', '10.0.0.2/32', '10.0.0.3/32'],
+                         [rule['source_ip_prefix'] for rule in rules])
+
     def test_ovsvapp_sg_update(self):
         ports = {"123": fake_port['security_group_rules']}
         self.agent.firewall.filtered_ports["123"] = fake_port
@@ -180,13 +223,14 @@ class TestOVSvAppSecurityGroupAgent(base.TestCase):
                                   return_value=ret_val
                                   ) as mock_expand_sg_rules, \
                 mock.patch.object(self.agent.firewall,
-                                  'prepare_port_filter') as mock_prep, \
+                                  'prepare_port_filters') as mock_prep, \
                 mock.patch.object(self.agent.firewall,
-                                  'update_port_filter') as mock_update:
+                                  'update_port_filters') as mock_update:
             self.agent._fetch_and_apply_rules(set(port_ids))
             self.assertEqual(1, mock_ovsvapp_sg_rpc.call_count)
             self.assertEqual(2, mock_expand_sg_rules.call_count)
-            self.assertEqual(2, mock_prep.call_count)
+            self.assertEqual(1, mock_prep.call_count)
+            self.assertEqual(2, len(mock_prep.call_args[0][0]))
             self.assertFalse(mock_update.called)
 
     def test_fetch_and_apply_rules_for_refresh(self):
@@ -201,15 +245,33 @@ class TestOVSvAppSecurityGroupAgent(base.TestCase):
                                   return_value=ret_val
                                   ) as mock_expand_sg_rules, \
                 mock.patch.object(self.agent.firewall,
-                                  'prepare_port_filter') as mock_prep, \
+                                  'prepare_port_filters') as mock_prep, \
                 mock.patch.object(self.agent.firewall,
-                                  'update_port_filter') as mock_update:
+                                  'update_port_filters') as mock_update:
             self.agent._fetch_and_apply_rules(set(port_ids), True)
             self.assertEqual(1, mock_ovsvapp_sg_rpc.call_count)
             self.assertEqual(2, mock_expand_sg_rules.call_count)
-            self.assertEqual(2, mock_update.call_count)
+            self.assertEqual(1, mock_update.call_count)
+            self.assertEqual(2, len(mock_update.call_args[0][0]))
             self.assertFalse(mock_prep.called)
 
+    def test_fetch_and_apply_rules_per_port(self):
+        port_ids = self._get_fake_portids(2)
+        ret_val = self._get_fake_ports(port_ids)
+        port_info = {'member_ips': mock.MagicMock(),
+                     'ports': ret_val}
+        self.agent.firewall = mock.Mock(spec=['prepare_port_filter',
+                                              'update_port_filter'])
+        with mock.patch.object(self.agent.ovsvapp_sg_rpc,
+                               'security_group_info_for_esx_devices',
+                               return_value=port_info), \
+                mock.patch.object(self.agent, 'expand_sg_rules',
+                                  return_value=ret_val):
+            self.agent._fetch_and_apply_rules(set(port_ids), True)
+            self.assertEqual(2,
+                             self.agent.firewall.update_port_filter.call_count)
+            self.assertFalse(self.agent.firewall.prepare_port_filter.called)
+
     def test_process_port_set(self):
         port_ids = self._get_fake_portids(25)
         with mock.patch.object(self.agent.t_pool, 'spawn_n') as mock_spawn:
@@ -14,6 +14,7 @@
 #    under the License.
 
 import copy
+import hashlib
 
 import mock
 from oslo_config import cfg
@@ -51,7 +52,51 @@ fake_res_port = {'security_group_source_groups': 'abc',
                  'lvid': "100",
                  'device': "123"}
 
-cookie = ("0x%x" % (hash("123") & 0xffffffffffffffff))
+cookie = ("0x%x" % ((int(hashlib.md5(b"123").hexdigest(), 16) >>
+                     (128 - ovs_fw.PORT_ID_BITS)) << ovs_fw.FLOW_INDEX_BITS |
+                    ovs_fw.PORT_COOKIE_FLAG))
+provider_cookie = ("0x%x" % (int(cookie, 16) | ovs_fw.PROVIDER_COOKIE_FLAG))
+
+
+def _port_matches(match, tp_port):
+    if isinstance(match, int):
+        return match == tp_port
+    value, mask = [int(part, 16) for part in match.split('/')]
+    return tp_port & mask == value
+
+
+class TestPortRangeMasks(base.TestCase):
+
+    def _assert_same_acceptance(self, port_min, port_max):
+        # Every port must be accepted exactly when the old per port
+        # expansion would have installed a flow for it.
+        masks = ovs_fw.get_port_range_masks(port_min, port_max)
+        expanded = set(range(port_min, port_max + 1))
+        for tp_port in range(ovs_fw.MAX_TP_PORT + 1):
+            accepted = any(_port_matches(match, tp_port)
+                           for match in masks)
+            self.assertEqual(tp_port in expanded, accepted)
+        return masks
+
+    def test_single_port(self):
+        self.assertEqual([22], ovs_fw.get_port_range_masks(22, 22))
+        self.assertEqual([22], ovs_fw.get_port_range_masks(22, None))
+
+    def test_aligned_range(self):
+        masks = self._assert_same_acceptance(1024, 2047)
+        self.assertEqual(["0x0400/0xfc00"], masks)
+
+    def test_unaligned_ranges(self):
+        for port_min, port_max in [(1024, 2048), (1, 100), (80, 443),
+                                   (3000, 3999), (32768, 65535),
+                                   (65535, 65535), (1, 65534)]:
+            masks = self._assert_same_acceptance(port_min, port_max)
+            self.assertTrue(len(masks) <= 30)
+
+    def test_range_is_minimal(self):
+        self.assertEqual(["0x0400/0xfc00", 2048],
+                         ovs_fw.get_port_range_masks(1024, 2048))
+        self.assertEqual(9, len(ovs_fw.get_port_range_masks(1, 100)))
 
 
 class TestOVSFirewallDriver(base.TestCase):
@@ -242,7 +287,8 @@ class TestOVSFirewallDriver(base.TestCase):
                                   ) as mock_add_flows_sec_br:
             self.ovs_firewall._add_flow_with_range(self.mock_br, port, flow,
                                                    direction, 1, 3, 1, 2)
-            self.assertEqual(6, mock_add_flows_sec_br.call_count)
+            # 1-3 compiles into 1 and 0x0002/0xfffe.
+            self.assertEqual(4, mock_add_flows_sec_br.call_count)
 
     def test_add_flow_with_range_all_ports(self):
         flow = {"priority": 1}
@@ -266,7 +312,20 @@ class TestOVSFirewallDriver(base.TestCase):
                                   ) as mock_add_flows_sec_br:
             self.ovs_firewall._add_flow_with_range(self.mock_br, port,
                                                    flow, direction, 1, 100)
-            self.assertEqual(100, mock_add_flows_sec_br.call_count)
+            self.assertEqual(9, mock_add_flows_sec_br.call_count)
+
+    def test_add_flow_with_range_masked_ports(self):
+        flow = {"priority": 1}
+        port = fake_port
+        direction = "fake_direction"
+        with mock.patch.object(self.ovs_firewall, '_add_flows_to_sec_br'
+                               ) as mock_add_flows_sec_br:
+            self.ovs_firewall._add_flow_with_range(self.mock_br, port,
+                                                   flow, direction,
+                                                   1024, 2047)
+            self.assertEqual(1, mock_add_flows_sec_br.call_count)
+            self.assertEqual("0x0400/0xfc00", flow["tp_dst"])
+            self.assertNotIn("tp_src", flow)
 
     def test_add_flows_to_sec_br_ingress_direction(self):
         flows = {}
@@ -296,6 +355,16 @@ class TestOVSFirewallDriver(base.TestCase):
             self.assertTrue(mock_add_flow.called)
             self.assertEqual(2, mock_add_flow.call_count)
 
+    def test_add_flows_to_sec_br_egress_ip_flows_cookie(self):
+        flow = {'dl_src': '01:02:03:04:05:06', 'proto': 'ip', 'dl_vlan': 25,
+                'cookie': cookie}
+        port = dict(fake_port, fixed_ips=[u'70.0.0.5'])
+        sec_br = mock.Mock()
+        self.ovs_firewall._add_flows_to_sec_br(sec_br, port, flow, "egress")
+        self.assertEqual([cookie, cookie],
+                         [call[1]['cookie']
+                          for call in sec_br.add_flow.call_args_list])
+
     def test_add_flows_to_sec_br_egress_direction_multiple_fixed_ips(self):
         flows = {}
         port = fake_port
@@ -357,6 +426,178 @@ class TestOVSFirewallDriver(base.TestCase):
             self.assertFalse(mock_add_range_flows.called)
             self.assertTrue(mock_add_flow.called)
 
+    def _get_remote_group_port(self, *remote_ips_list):
+        port = copy.deepcopy(fake_port)
+        port['security_group_rules'] = [
+            {"direction": "ingress",
+             "protocol": "tcp",
+             "port_range_min": 22,
+             "port_range_max": 22,
+             "ethertype": "IPv4",
+             "remote_group_id": "sg-%s" % i,
+             "remote_ip_prefixes": remote_ips}
+            for i, remote_ips in enumerate(remote_ips_list)]
+        return port
+
+    def test_add_flows_with_conjunction(self):
+        port = self._get_remote_group_port(['10.0.0.2/32', '10.0.0.3/32'],
+                                           ['10.0.0.3/32', '10.0.0.4/32'])
+        sec_br = mock.Mock()
+        with mock.patch.object(self.ovs_firewall, '_get_port_vlan',
+                               return_value=100):
+            self.ovs_firewall._add_flows(sec_br, port, cookie)
+        flows = [call[1] for call in sec_br.add_flow.call_args_list]
+        # Both rules share one conjunction: 1 rule flow, 1 conj_id flow
+        # and one flow per distinct member address.
+        self.assertEqual(5, len(flows))
+        conj_pri = (ovs_fw.ovsvapp_const.SG_TP_PRI +
+                    ovs_fw.ovsvapp_const.SG_CONJ_PRI_OFFSET)
+        self.assertTrue(all(flow['priority'] == conj_pri for flow in flows))
+        conj_flow = next(flow for flow in flows if 'conj_id' in flow)
+        conj_id = conj_flow['conj_id']
+        rule_flow = next(flow for flow in flows if 'tp_dst' in flow)
+        self.assertEqual("conjunction(%s,1/2)" % conj_id,
+                         rule_flow['actions'])
+        self.assertNotIn('nw_src', rule_flow)
+        self.assertEqual("resubmit(,%s),output:%s" %
+                         (ovs_fw.ovsvapp_const.SG_TCP_TABLE_ID,
+                          self.ovs_firewall.phy_ofport),
+                         conj_flow['actions'])
+        member_flows = dict((flow['nw_src'], flow['actions'])
+                            for flow in flows if 'nw_src' in flow)
+        self.assertEqual(dict((ip, "conjunction(%s,2/2)" % conj_id)
+                              for ip in ['10.0.0.2/32', '10.0.0.3/32',
+                                         '10.0.0.4/32']), member_flows)
+        self.assertEqual([conj_id],
+                         self.ovs_firewall._conj_allocation['123'])
+        # The id only depends on the port and the rule.
+        firewall = ovs_fw.OVSFirewallDriver.__new__(ovs_fw.OVSFirewallDriver)
+        firewall.__dict__.update(self.ovs_firewall.__dict__)
+        firewall._conj_allocation = {}
+        firewall._conj_id_owners = {}
+        sec_br.reset_mock()
+        with mock.patch.object(firewall, '_get_port_vlan',
+                               return_value=100):
+            firewall._add_flows(sec_br, port, cookie)
+        self.assertEqual([conj_id], firewall._conj_allocation['123'])
+
+    def test_alloc_conj_id_skips_used_ids(self):
+        conj_id = self.ovs_firewall._alloc_conj_id('123', 'rule')
+        self.ovs_firewall._abort_conj_ids(
+            self.ovs_firewall._take_conj_allocation())
+        self.assertEqual({}, self.ovs_firewall._conj_id_owners)
+        self.ovs_firewall._conj_id_owners[conj_id] = '456'
+        self.assertEqual(conj_id + 1,
+                         self.ovs_firewall._alloc_conj_id('123', 'rule'))
+
+    def test_alloc_conj_id_skips_recovered_ids(self):
+        conj_id = self.ovs_firewall._alloc_conj_id('123', 'rule')
+        self.ovs_firewall._abort_conj_ids(
+            self.ovs_firewall._take_conj_allocation())
+        # Found on the bridge with the flows of the same port.
+        self.ovs_firewall.recovered_conj_ids[conj_id] = int(cookie, 16)
+        self.assertEqual(conj_id,
+                         self.ovs_firewall._alloc_conj_id('123', 'rule'))
+        self.ovs_firewall._abort_conj_ids(
+            self.ovs_firewall._take_conj_allocation())
+        self.ovs_firewall.recovered_conj_ids[conj_id] = int(
+            self.ovs_firewall.get_cookie('456'), 16)
+        self.assertEqual(conj_id + 1,
+                         self.ovs_firewall._alloc_conj_id('123', 'rule'))
+
+    def test_add_flows_with_conjunction_single_member(self):
+        port = self._get_remote_group_port(['10.0.0.2/32'], [])
+        sec_br = mock.Mock()
+        with mock.patch.object(self.ovs_firewall, '_get_port_vlan',
+                               return_value=100):
+            self.ovs_firewall._add_flows(sec_br, port, cookie)
+        self.assertEqual(1, sec_br.add_flow.call_count)
+        flow = sec_br.add_flow.call_args[1]
+        self.assertEqual('10.0.0.2/32', flow['nw_src'])
+        self.assertEqual(ovs_fw.ovsvapp_const.SG_TP_PRI, flow['priority'])
+        self.assertNotIn('123', self.ovs_firewall._conj_allocation)
+
+    def test_clean_port_filters_releases_conj_ids(self):
+        self.ovs_firewall.filtered_ports["123"] = fake_res_port
+        self.ovs_firewall._port_conj_ids['123'] = [1, 2]
+        self.ovs_firewall._conj_id_owners = {1: '123', 2: '123'}
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br), \
+                mock.patch.object(self.ovs_firewall, '_get_port_vlan',
+                                  return_value=100):
+            self.ovs_firewall.clean_port_filters(["123"])
+        self.assertNotIn('123', self.ovs_firewall._port_conj_ids)
+        self.assertEqual({}, self.ovs_firewall._conj_id_owners)
+
+    def test_clean_port_filters_commit_failure_keeps_conj_ids(self):
+        self.ovs_firewall.filtered_ports["123"] = fake_res_port
+        self.ovs_firewall._port_conj_ids['123'] = [1, 2]
+        self.ovs_firewall._conj_id_owners = {1: '123', 2: '123'}
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        sec_br.__exit__.side_effect = RuntimeError()
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br), \
+                mock.patch.object(self.ovs_firewall, '_get_port_vlan',
+                                  return_value=100):
+            self.assertRaises(RuntimeError,
+                              self.ovs_firewall.clean_port_filters, ["123"])
+        # The conjunction flows may still be installed.
+        self.assertEqual([1, 2], self.ovs_firewall._port_conj_ids['123'])
+        self.assertEqual({1: '123', 2: '123'},
+                         self.ovs_firewall._conj_id_owners)
+
+    def test_update_port_filter_conj_ids(self):
+        self.ovs_firewall.provider_port_cache = set(['123'])
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        port = self._get_remote_group_port(['10.0.0.2/32', '10.0.0.3/32'])
+        port['fixed_ips'] = []
+        self.ovs_firewall.filtered_ports["123"] = (
+            self.ovs_firewall._get_compact_port(port))
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br), \
+                mock.patch.object(self.ovs_firewall, '_get_port_vlan',
+                                  return_value=100):
+            self.ovs_firewall.update_port_filter(port)
+            [tcp_id] = self.ovs_firewall._port_conj_ids['123']
+            # A second rule needs another conjunction, the first one keeps
+            # its id.
+            port['security_group_rules'].append(
+                dict(port['security_group_rules'][0], protocol='udp'))
+            self.ovs_firewall.update_port_filter(port)
+            tcp_id_2, udp_id = self.ovs_firewall._port_conj_ids['123']
+            self.assertEqual(tcp_id, tcp_id_2)
+            port['security_group_rules'].pop(0)
+            self.ovs_firewall.update_port_filter(port)
+        self.assertEqual([udp_id], self.ovs_firewall._port_conj_ids['123'])
+        self.assertEqual({udp_id: '123'}, self.ovs_firewall._conj_id_owners)
+
+    def test_update_port_filter_commit_failure_keeps_conj_ids(self):
+        self.ovs_firewall.provider_port_cache = set(['123'])
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        port = self._get_remote_group_port(['10.0.0.2/32', '10.0.0.3/32'])
+        port['fixed_ips'] = []
+        self.ovs_firewall.filtered_ports["123"] = (
+            self.ovs_firewall._get_compact_port(port))
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br), \
+                mock.patch.object(self.ovs_firewall, '_get_port_vlan',
+                                  return_value=100), \
+                mock.patch.object(self.LOG, 'exception'):
+            self.ovs_firewall.update_port_filter(port)
+            [tcp_id] = self.ovs_firewall._port_conj_ids['123']
+            port['security_group_rules'].append(
+                dict(port['security_group_rules'][0], protocol='udp'))
+            sec_br.__exit__.side_effect = RuntimeError()
+            self.ovs_firewall.update_port_filter(port)
+        self.assertEqual([tcp_id], self.ovs_firewall._port_conj_ids['123'])
+        # The id allocated for the flows which were not applied is free.
+        self.assertEqual({tcp_id: '123'}, self.ovs_firewall._conj_id_owners)
+
     def test_prepare_port_filter(self):
         self.ovs_firewall.provider_port_cache = set()
         with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
@@ -367,9 +608,10 @@ class TestOVSFirewallDriver(base.TestCase):
                                   ) as mock_add_flow_fn, \
                 mock.patch.object(self.mock_br, 'add_flow'):
             self.ovs_firewall.prepare_port_filter(fake_port)
-            mock_aap_flow_fn.assert_called_with(self.mock_br, fake_port)
-            mock_add_flow_fn.assert_called_with(self.mock_br, fake_port,
-                                                cookie)
+            mock_aap_flow_fn.assert_called_with(mock.ANY, fake_port)
+            mock_add_flow_fn.assert_has_calls(
+                [mock.call(mock.ANY, fake_port, cookie, False),
+                 mock.call(mock.ANY, fake_port, provider_cookie, True)])
             self.assertEqual(2, mock_add_flow_fn.call_count)
             ret_port = self.ovs_firewall.filtered_ports['123']
             self.assertEqual(fake_res_port, ret_port)
@@ -388,10 +630,301 @@ class TestOVSFirewallDriver(base.TestCase):
                 mock.patch.object(self.LOG, 'exception'
                                   ) as mock_exception_log:
             self.ovs_firewall.prepare_port_filter(fake_port)
-            mock_aap_flow_fn.assert_called_with(self.mock_br, fake_port)
+            mock_aap_flow_fn.assert_called_with(mock.ANY, fake_port)
             self.assertFalse(mock_add_flow_fn.called)
             self.assertTrue(mock_exception_log.called)
             self.assertEqual(set(), self.ovs_firewall.provider_port_cache)
+            self.assertEqual({}, self.ovs_firewall.installed_flows)
+
+    def test_get_port_flows(self):
+        port = copy.deepcopy(fake_port)
+        port['fixed_ips'] = ['10.0.0.5']
+        with mock.patch.object(self.ovs_firewall, '_get_port_vlan',
+                               return_value=100):
+            flows = self.ovs_firewall._get_port_flows(port, cookie)
+        # 2001-2009 compiles into 4 matches, source ports 67-68 into 2.
+        self.assertEqual(8, len(flows))
+        for key, flow in flows.items():
+            self.assertEqual(ovs_fw.get_flow_key(flow), key)
+            self.assertEqual(cookie, flow['cookie'])
+
+    def test_apply_flow_delta(self):
+        flow_a = {'cookie': cookie, 'priority': 10, 'actions': 'normal',
+                  'dl_dst': 'aa:bb:cc:dd:ee:ff', 'table': 0}
+        flow_b = dict(flow_a, dl_dst='aa:bb:cc:dd:ee:fe')
+        flow_c = dict(flow_a, dl_dst='aa:bb:cc:dd:ee:fd')
+        key_a = ovs_fw.get_flow_key(flow_a)
+        key_b = ovs_fw.get_flow_key(flow_b)
+        key_c = ovs_fw.get_flow_key(flow_c)
+        cookie_a = ovs_fw.get_flow_cookie(cookie, key_a)
+        cookie_b = ovs_fw.get_flow_cookie(cookie, key_b)
+        cookie_c = ovs_fw.get_flow_cookie(cookie, key_c)
+        installed = {key_a: cookie_a, key_b: cookie_b}
+        sec_br = mock.Mock()
+        state, counts = self.ovs_firewall._apply_flow_delta(
+            sec_br, cookie, {key_a: dict(flow_a), key_c: dict(flow_c)},
+            installed)
+        self.assertEqual((1, 1, 1), counts)
+        sec_br.delete_flows.assert_called_once_with(
+            cookie="0x%x/-1" % cookie_b)
+        sec_br.add_flow.assert_called_once_with(
+            **dict(flow_c, cookie="0x%x" % cookie_c))
+        self.assertEqual({key_a: cookie_a, key_c: cookie_c}, state)
+
+    def test_apply_flow_delta_unchanged(self):
+        flow = {'cookie': cookie, 'priority': 10, 'actions': 'normal',
+                'table': 0}
+        key = ovs_fw.get_flow_key(flow)
+        installed = {key: ovs_fw.get_flow_cookie(cookie, key)}
+        sec_br = mock.Mock()
+        state, counts = self.ovs_firewall._apply_flow_delta(
+            sec_br, cookie, {key: flow}, installed)
+        self.assertEqual((0, 0, 1), counts)
+        self.assertFalse(sec_br.add_flow.called)
+        self.assertFalse(sec_br.delete_flows.called)
+        self.assertEqual(installed, state)
+
+    def test_apply_flow_delta_recovered(self):
+        flow_a = {'cookie': cookie, 'priority': 10, 'actions': 'normal',
+                  'dl_dst': 'aa:bb:cc:dd:ee:ff', 'table': 0}
+        flow_b = dict(flow_a, dl_dst='aa:bb:cc:dd:ee:fe')
+        key_a = ovs_fw.get_flow_key(flow_a)
+        key_b = ovs_fw.get_flow_key(flow_b)
+        cookie_a = ovs_fw.get_flow_cookie(cookie, key_a)
+        cookie_b = ovs_fw.get_flow_cookie(cookie, key_b)
+        stale_cookie = int(cookie, 16)
+        installed = {ovs_fw.RECOVERED_FLOW_KEY % cookie_a: cookie_a,
+                     ovs_fw.RECOVERED_FLOW_KEY % stale_cookie: stale_cookie}
+        sec_br = mock.Mock()
+        state, counts = self.ovs_firewall._apply_flow_delta(
+            sec_br, cookie, {key_a: dict(flow_a), key_b: dict(flow_b)},
+            installed)
+        self.assertEqual((1, 1, 1), counts)
+        sec_br.delete_flows.assert_called_once_with(
+            cookie="0x%x/-1" % stale_cookie)
+        sec_br.add_flow.assert_called_once_with(
+            **dict(flow_b, cookie="0x%x" % cookie_b))
+        self.assertEqual({key_a: cookie_a, key_b: cookie_b}, state)
+
+    def test_get_cookie(self):
+        port_id = "8a7ab1d6-3c1f-4e3b-9a35-5b6c0b4e1d20"
+        port_cookie = int(self.ovs_firewall.get_cookie(port_id), 16)
+        # Top 38 bits of the port UUID above the flow index bits.
+        self.assertEqual(0x8a7ab1d63c >> 2 << ovs_fw.FLOW_INDEX_BITS |
+                         ovs_fw.PORT_COOKIE_FLAG, port_cookie)
+        self.assertEqual(
+            "0x%x" % (port_cookie | ovs_fw.PROVIDER_COOKIE_FLAG),
+            self.ovs_firewall.get_cookie(port_id, True))
+        self.assertEqual(cookie, self.ovs_firewall.get_cookie("123"))
+        self.assertEqual(provider_cookie,
+                         self.ovs_firewall.get_cookie("123", True))
+
+    def test_recover_port_flows(self):
+        flow_cookie = int(cookie, 16) | 5
+        conj_cookie = int(provider_cookie, 16) | 6
+        flows = [" cookie=0x0, duration=1.0s, table=0, priority=0 "
+                 "actions=drop",
+                 # Base flows carry the default cookie of the bridge.
+                 " cookie=0x7a3e5c1d2b4f6a80, duration=1.0s, table=0, "
+                 "priority=10,arp actions=NORMAL",
+                 " cookie=0x%x, duration=1.0s, table=0, priority=10, "
+                 "dl_vlan=100,dl_dst=00:11:22:33:44:55 actions=normal" %
+                 flow_cookie,
+                 " cookie=0x%x, duration=1.0s, table=0, priority=21, "
+                 "conj_id=1234,dl_vlan=100 actions=normal" % conj_cookie,
+                 "NXST_FLOW reply (xid=0x4):"]
+        self.ovs_firewall.recover_port_flows(flows)
+        self.assertEqual(
+            {cookie: {ovs_fw.RECOVERED_FLOW_KEY % flow_cookie: flow_cookie},
+             provider_cookie: {
+                 ovs_fw.RECOVERED_FLOW_KEY % conj_cookie: conj_cookie}},
+            self.ovs_firewall.installed_flows)
+        self.assertEqual(set([cookie, provider_cookie]),
+                         self.ovs_firewall.recovered_cookies)
+        self.assertEqual({1234: int(cookie, 16)},
+                         self.ovs_firewall.recovered_conj_ids)
+
+    def test_recover_port_flows_keeps_base_flows(self):
+        # The default cookie of the bridge before the restart, carried by
+        # the base flows and by the egress flows of older agents.
+        default_cookie = 0x7a3e5c1d2b4f6a80
+        egress_table = ovs_fw.ovsvapp_const.SG_EGRESS_TABLE_ID
+        flow_cookie = int(cookie, 16) | 5
+        flows = [" cookie=0x%x, duration=1.0s, table=0, priority=10,arp "
+                 "actions=NORMAL" % default_cookie,
+                 " cookie=0x%x, duration=1.0s, table=0, priority=0 "
+                 "actions=drop" % default_cookie,
+                 " cookie=0x%x, duration=1.0s, table=%s, priority=30, "
+                 "ip,in_port=2,dl_vlan=100,dl_src=00:11:22:33:44:55,"
+                 "nw_src=10.0.0.5 actions=resubmit(,4)" %
+                 (default_cookie, egress_table),
+                 " cookie=0x%x, duration=1.0s, table=0, priority=10, "
+                 "dl_vlan=100,dl_dst=00:11:22:33:44:55 actions=normal" %
+                 flow_cookie]
+        self.ovs_firewall.recover_port_flows(flows)
+        self.assertEqual(set([cookie]), self.ovs_firewall.recovered_cookies)
+        self.assertEqual(
+            {cookie: {ovs_fw.RECOVERED_FLOW_KEY % flow_cookie: flow_cookie}},
+            self.ovs_firewall.installed_flows)
+
+        # No port of the agent claims the default cookie, which stays.
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br):
+            self.ovs_firewall.remove_stale_recovered_flows()
+        sec_br.delete_flows.assert_called_once_with(
+            cookie="%s/0x%x" % (cookie, ovs_fw.PORT_COOKIE_MASK))
+
+    def test_remove_stale_recovered_flows(self):
+        stale_cookie = self.ovs_firewall.get_cookie("456")
+        self.ovs_firewall.filtered_ports["123"] = fake_res_port
+        self.ovs_firewall.recovered_cookies = set([cookie, provider_cookie,
+                                                   stale_cookie])
+        self.ovs_firewall.recovered_conj_ids = {1234: int(cookie, 16)}
+        self.ovs_firewall.installed_flows = {cookie: {}, stale_cookie: {}}
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br):
+            self.ovs_firewall.remove_stale_recovered_flows()
+        sec_br.delete_flows.assert_called_once_with(
+            cookie="%s/0x%x" % (stale_cookie, ovs_fw.PORT_COOKIE_MASK))
+        self.assertEqual({cookie: {}}, self.ovs_firewall.installed_flows)
+        self.assertEqual(set(), self.ovs_firewall.recovered_cookies)
+        self.assertEqual({}, self.ovs_firewall.recovered_conj_ids)
+
+    def test_recover_sg_set_flows(self):
+        set_cookie = self.ovs_firewall.get_cookie(
+            self.ovs_firewall._get_sg_set_name(0x2a))
+        flow_cookie = int(set_cookie, 16) | 3
+        table = ovs_fw.SG_RULES_TABLE[ovs_fw.INGRESS_DIRECTION]
+        flows = [" cookie=0x%x, duration=1.0s, table=%s, priority=20, "
+                 "tcp,reg0=0x2a,tp_dst=22 actions=normal" %
+                 (flow_cookie, table),
+                 " cookie=0x7a3e5c1d2b4f6a80, duration=1.0s, table=%s, "
+                 "priority=0 actions=drop" % table]
+        self.ovs_firewall.recover_port_flows(flows)
+        self.assertEqual(
+            {set_cookie: {
+                ovs_fw.RECOVERED_FLOW_KEY % flow_cookie: flow_cookie}},
+            self.ovs_firewall.installed_flows)
+        self.assertEqual({0x2a: set_cookie},
+                         self.ovs_firewall.recovered_sg_sets)
+
+    def test_remove_stale_recovered_flows_sg_sets(self):
+        used_cookie = self.ovs_firewall.get_cookie(
+            self.ovs_firewall._get_sg_set_name(1))
+        unused_cookie = self.ovs_firewall.get_cookie(
+            self.ovs_firewall._get_sg_set_name(2))
+        self.ovs_firewall.sg_set_ports = {1: set(['123'])}
+        self.ovs_firewall.recovered_sg_sets = {1: used_cookie,
+                                               2: unused_cookie}
+        self.ovs_firewall.recovered_cookies = set([used_cookie,
+                                                   unused_cookie])
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br):
+            self.ovs_firewall.remove_stale_recovered_flows()
+        sec_br.delete_flows.assert_called_once_with(
+            cookie="%s/0x%x" % (unused_cookie, ovs_fw.PORT_COOKIE_MASK))
+        self.assertEqual({}, self.ovs_firewall.recovered_sg_sets)
+
+    def test_update_port_filter_claims_recovered_cookie(self):
+        self.ovs_firewall.filtered_ports["123"] = fake_res_port
+        self.ovs_firewall.provider_port_cache = set(['123'])
+        self.ovs_firewall.recovered_cookies = set([cookie])
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=self.mock_br), \
+                mock.patch.object(self.ovs_firewall, '_get_port_flows',
+                                  return_value={}):
+            self.ovs_firewall.update_port_filter(fake_port)
+        self.assertEqual(set(), self.ovs_firewall.recovered_cookies)
+
+    def test_get_sg_set_id(self):
+        rule_1 = {"direction": "ingress", "protocol": "tcp",
+                  "port_range_min": 22, "port_range_max": 22}
+        rule_2 = {"direction": "egress", "ethertype": "IPv4"}
+        sg_set_id = self.ovs_firewall._get_sg_set_id([rule_1, rule_2])
+        self.assertEqual(sg_set_id,
+                         self.ovs_firewall._get_sg_set_id([rule_2, rule_1]))
+        self.assertNotEqual(sg_set_id,
+                            self.ovs_firewall._get_sg_set_id([rule_1]))
+        self.assertEqual(2, len(self.ovs_firewall.sg_set_keys))
+
+    def _prepare_shared_ports(self, sec_br, *port_ids):
+        self.ovs_firewall.use_shared_rule_tables = True
+        self.ovs_firewall.provider_port_cache = set()
+        sec_br.__enter__.return_value = sec_br
+        for i, port_id in enumerate(port_ids):
+            port = copy.deepcopy(fake_port)
+            port['id'] = port_id
+            port['mac_address'] = '00:11:22:33:44:%02x' % i
+            port['lvid'] = 100
+            port['fixed_ips'] = ['10.0.0.%s' % (i + 2)]
+            self.ovs_firewall.filtered_ports[port_id] = (
+                self.ovs_firewall._get_compact_port(port))
+            self.ovs_firewall.prepare_port_filter(port)
+
+    def test_prepare_port_filter_shared_rule_tables(self):
+        sec_br = mock.MagicMock()
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br):
+            self._prepare_shared_ports(sec_br, "123", "456")
+        flows = [call[1] for call in sec_br.add_flow.call_args_list]
+        rule_flows = [flow for flow in flows if ovs_fw.SG_SET_REG in flow]
+        # The rule flows are only installed for the first port.
+        self.assertEqual(8, len(rule_flows))
+        sg_set_id = rule_flows[0][ovs_fw.SG_SET_REG]
+        classifier_flows = [flow for flow in flows
+                            if 'load:%s->' % sg_set_id in flow['actions']]
+        self.assertEqual(4, len(classifier_flows))
+        self.assertEqual({sg_set_id: set(["123", "456"])},
+                         self.ovs_firewall.sg_set_ports)
+        self.assertEqual({"123": sg_set_id, "456": sg_set_id},
+                         self.ovs_firewall.port_sg_sets)
+
+    def test_update_port_filter_shared_rule_tables(self):
+        sec_br = mock.MagicMock()
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br):
+            self._prepare_shared_ports(sec_br, "123", "456")
+            old_set_id = self.ovs_firewall.port_sg_sets["123"]
+            old_set_cookie = self.ovs_firewall.get_cookie(
+                self.ovs_firewall._get_sg_set_name(old_set_id))
+            for port_id in ("123", "456"):
+                port = copy.deepcopy(fake_port)
+                port['id'] = port_id
+                port['lvid'] = 100
+                port['fixed_ips'] = ['10.0.0.2']
+                port['security_group_rules'] = []
+                sec_br.reset_mock()
+                self.ovs_firewall.update_port_filter(port)
+        # The old rule set went with its last member.
+        sec_br.delete_flows.assert_any_call(
+            cookie="%s/0x%x" % (old_set_cookie, ovs_fw.PORT_COOKIE_MASK))
+        self.assertNotIn(old_set_id, self.ovs_firewall.sg_set_ports)
+        self.assertNotIn(old_set_cookie, self.ovs_firewall.installed_flows)
+        self.assertEqual(1, len(self.ovs_firewall.sg_set_ports))
+
+    def test_remove_flows_shared_rule_tables(self):
+        sec_br = mock.MagicMock()
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br):
+            self._prepare_shared_ports(sec_br, "123", "456")
+        sg_set_id = self.ovs_firewall.port_sg_sets["123"]
+        set_cookie = "%s/0x%x" % (self.ovs_firewall.get_cookie(
+            self.ovs_firewall._get_sg_set_name(sg_set_id)),
+            ovs_fw.PORT_COOKIE_MASK)
+        sec_br.reset_mock()
+        self.ovs_firewall._remove_flows(sec_br, "123", True)
+        self.assertNotIn(mock.call(cookie=set_cookie),
+                         sec_br.delete_flows.call_args_list)
+        self.ovs_firewall._remove_flows(sec_br, "456", True)
+        sec_br.delete_flows.assert_any_call(cookie=set_cookie)
+        self.assertEqual({}, self.ovs_firewall.sg_set_ports)
+        self.assertEqual({}, self.ovs_firewall.port_sg_sets)
 
     def test_remove_only_tenant_flows(self):
         self.ovs_firewall.filtered_ports["123"] = fake_res_port
@@ -437,8 +970,8 @@ class TestOVSFirewallDriver(base.TestCase):
         self.ovs_firewall.filtered_ports["123"] = fake_res_port
         with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
                                return_value=self.mock_br), \
-                mock.patch.object(self.ovs_firewall, '_remove_flows'
-                                  ) as mock_rem_flow:
+                mock.patch.object(self.ovs_firewall, '_remove_flows',
+                                  return_value=[]) as mock_rem_flow:
             self.ovs_firewall.clean_port_filters(["123"])
             mock_rem_flow.assert_called_with(self.mock_br, "123")
             self.assertIn("123", self.ovs_firewall.filtered_ports)
@@ -448,8 +981,8 @@ class TestOVSFirewallDriver(base.TestCase):
         self.ovs_firewall.provider_port_cache = set(['123'])
         with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
                                return_value=self.mock_br), \
-                mock.patch.object(self.ovs_firewall, '_remove_flows'
-                                  ) as mock_rem_flow:
+                mock.patch.object(self.ovs_firewall, '_remove_flows',
+                                  return_value=[]) as mock_rem_flow:
             self.ovs_firewall.clean_port_filters(["123"], True)
             mock_rem_flow.assert_called_with(self.mock_br, "123", True)
             self.assertNotIn("123", self.ovs_firewall.filtered_ports)
@@ -474,22 +1007,55 @@ class TestOVSFirewallDriver(base.TestCase):
     def test_normal_update_port_filters(self):
         self.ovs_firewall.filtered_ports["123"] = fake_res_port
         self.ovs_firewall.provider_port_cache = set(['123'])
+        installed = {'fake=flow': ovs_fw.get_flow_cookie(cookie,
+                                                         'fake=flow')}
+        self.ovs_firewall.installed_flows[cookie] = installed
+        flows = {'fake=flow': {'cookie': cookie}}
         with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
                                return_value=self.mock_br), \
                 mock.patch.object(self.ovs_firewall, '_remove_flows'
                                   ) as mock_rem_flow, \
-                mock.patch.object(self.ovs_firewall, '_setup_aap_flows'
-                                  ) as mock_aap_flow_fn, \
-                mock.patch.object(self.ovs_firewall, '_add_flows'
-                                  ) as mock_add_flow_fn:
+                mock.patch.object(self.ovs_firewall, '_get_port_flows',
+                                  return_value=flows) as mock_get_flows, \
+                mock.patch.object(self.mock_br, 'add_flow'
+                                  ) as mock_add_flow, \
+                mock.patch.object(self.mock_br, 'delete_flows'
+                                  ) as mock_del_flows:
             self.ovs_firewall.update_port_filter(fake_port)
-            mock_rem_flow.assert_called_with(self.mock_br, "123")
-            mock_aap_flow_fn.assert_called_with(self.mock_br, fake_port)
-            mock_add_flow_fn.assert_called_with(self.mock_br, fake_port,
-                                                cookie)
-            self.assertEqual(1, mock_add_flow_fn.call_count)
+            self.assertFalse(mock_rem_flow.called)
+            mock_get_flows.assert_called_once_with(fake_port, cookie,
+                                                   sg_set_id=None)
+            self.assertFalse(mock_add_flow.called)
+            self.assertFalse(mock_del_flows.called)
+            self.assertEqual(installed,
+                             self.ovs_firewall.installed_flows[cookie])
+            self.assertEqual(1, self.ovs_firewall.flow_counters['unchanged'])
             self.assertIn("123", self.ovs_firewall.filtered_ports)
 
+    def test_update_port_filters_removed_rule(self):
+        self.ovs_firewall.filtered_ports["123"] = fake_res_port
+        self.ovs_firewall.provider_port_cache = set(['123'])
+        flow_cookie = ovs_fw.get_flow_cookie(cookie, 'fake=flow')
+        self.ovs_firewall.installed_flows[cookie] = {
+            'fake=flow': flow_cookie}
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=self.mock_br), \
+                mock.patch.object(self.ovs_firewall, '_get_port_flows',
+                                  return_value={}), \
+                mock.patch.object(self.ovs_firewall, '_get_port_vlan',
+                                  return_value=100), \
+                mock.patch.object(self.ovs_firewall, '_remove_learned_flows'
+                                  ) as mock_rem_learned, \
+                mock.patch.object(self.mock_br, 'delete_flows'
+                                  ) as mock_del_flows:
+            self.ovs_firewall.update_port_filter(fake_port)
+            mock_del_flows.assert_called_once_with(
+                cookie="0x%x/-1" % flow_cookie)
+            mock_rem_learned.assert_called_once_with(self.mock_br,
+                                                     fake_port, 100)
+            self.assertEqual({}, self.ovs_firewall.installed_flows[cookie])
+            self.assertEqual(1, self.ovs_firewall.flow_counters['removed'])
+
     def test_update_port_filters_for_provider_update(self):
         self.ovs_firewall.filtered_ports["123"] = fake_res_port
         self.ovs_firewall.provider_port_cache = set()
@@ -502,10 +1068,11 @@ class TestOVSFirewallDriver(base.TestCase):
                 mock.patch.object(self.ovs_firewall, '_add_flows'
                                   ) as mock_add_flow_fn:
             self.ovs_firewall.update_port_filter(fake_port)
-            mock_rem_flow.assert_called_with(self.mock_br, "123", True)
-            mock_aap_flow_fn.assert_called_with(self.mock_br, fake_port)
-            mock_add_flow_fn.assert_called_with(self.mock_br, fake_port,
-                                                cookie)
+            self.assertFalse(mock_rem_flow.called)
+            mock_aap_flow_fn.assert_called_with(mock.ANY, fake_port)
+            mock_add_flow_fn.assert_has_calls(
+                [mock.call(mock.ANY, fake_port, cookie, False),
+                 mock.call(mock.ANY, fake_port, provider_cookie, True)])
             self.assertEqual(2, mock_add_flow_fn.call_count)
             self.assertIn("123", self.ovs_firewall.filtered_ports)
             self.assertIn("123", self.ovs_firewall.provider_port_cache)
@@ -515,17 +1082,91 @@ class TestOVSFirewallDriver(base.TestCase):
         self.ovs_firewall.provider_port_cache = set(['123'])
         with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
                                return_value=self.mock_br), \
-                mock.patch.object(self.ovs_firewall, '_remove_flows',
-                                  side_effect=Exception()) as mock_rem_flow, \
-                mock.patch.object(self.ovs_firewall, '_add_flows'
-                                  ) as mock_add_flow_fn, \
+                mock.patch.object(self.ovs_firewall, '_get_port_flows',
+                                  side_effect=Exception()
+                                  ) as mock_get_flows, \
                 mock.patch.object(self.LOG, 'exception'
                                   ) as mock_exception_log:
             self.ovs_firewall.update_port_filter(fake_port)
-            mock_rem_flow.assert_called_with(self.mock_br, "123")
-            self.assertFalse(mock_add_flow_fn.called)
+            mock_get_flows.assert_called_with(fake_port, cookie,
+                                              sg_set_id=None)
             self.assertIn("123", self.ovs_firewall.filtered_ports)
+            self.assertNotIn(cookie, self.ovs_firewall.installed_flows)
+            self.assertTrue(mock_exception_log.called)
+
+    def _get_filtered_ports(self, *port_ids):
+        ports = []
+        for i, port_id in enumerate(port_ids):
+            port = copy.deepcopy(fake_port)
+            port['id'] = port_id
+            port['mac_address'] = '00:11:22:33:44:%02x' % i
+            port['lvid'] = 100
+            self.ovs_firewall.filtered_ports[port_id] = (
+                self.ovs_firewall._get_compact_port(port))
+            ports.append(port)
+        return ports
+
+    def test_update_port_filters(self):
+        ports = self._get_filtered_ports("123", "456")
+        self.ovs_firewall.provider_port_cache = set(["123", "456"])
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br) as mock_deferred:
+            self.ovs_firewall.update_port_filters(ports)
+            # Both ports go to the bridge in one commit.
+            self.assertEqual(1, mock_deferred.call_count)
+        self.assertEqual(16, sec_br.add_flow.call_count)
+        self.assertIn(cookie, self.ovs_firewall.installed_flows)
+        self.assertIn(self.ovs_firewall.get_cookie("456"),
+                      self.ovs_firewall.installed_flows)
+
+    def test_update_port_filters_port_failure(self):
+        ports = self._get_filtered_ports("123", "456")
+        self.ovs_firewall.provider_port_cache = set(["123", "456"])
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        get_port_flows = self.ovs_firewall._get_port_flows
+
+        def _get_port_flows(port, *args, **kwargs):
+            if port['id'] == "123":
+                raise Exception()
+            return get_port_flows(port, *args, **kwargs)
+
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br), \
+                mock.patch.object(self.ovs_firewall, '_get_port_flows',
+                                  side_effect=_get_port_flows), \
+                mock.patch.object(self.LOG, 'exception'
+                                  ) as mock_exception_log:
+            self.ovs_firewall.update_port_filters(ports)
+            self.assertEqual(1, mock_exception_log.call_count)
+        self.assertEqual(8, sec_br.add_flow.call_count)
+        self.assertNotIn(cookie, self.ovs_firewall.installed_flows)
+        self.assertIn(self.ovs_firewall.get_cookie("456"),
+                      self.ovs_firewall.installed_flows)
+
+    def test_prepare_port_filters_commit_failure(self):
+        ports = self._get_filtered_ports("123", "456")
+        sec_br = mock.MagicMock()
+        sec_br.__enter__.return_value = sec_br
+        sec_br.__exit__.side_effect = RuntimeError()
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred',
+                               return_value=sec_br), \
+                mock.patch.object(self.LOG, 'exception'
+                                  ) as mock_exception_log:
+            self.ovs_firewall.prepare_port_filters(ports)
             self.assertTrue(mock_exception_log.called)
+        self.assertEqual({}, self.ovs_firewall.installed_flows)
+        self.assertEqual(set(), self.ovs_firewall.provider_port_cache)
+
+    def test_update_port_filters_not_filtered(self):
+        with mock.patch.object(self.ovs_firewall,
+                               '_refresh_port_filters') as mock_refresh, \
+                mock.patch.object(self.LOG, 'warning') as mock_warning_log:
+            self.ovs_firewall.update_port_filters([fake_port])
+            mock_refresh.assert_called_once_with([])
+            self.assertTrue(mock_warning_log.called)
 
     def test_ovs_firewall_restart_with_canary_flow(self):
 
@@ -0,0 +1,110 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from neutron.tests import base
+
+from networking_vsphere.utils import dvs_port_index
+
+
+def _port_info(key, name=None, pg_key='pg-1'):
+    port_info = mock.Mock(key=key, portgroupKey=pg_key)
+    port_info.config.name = name
+    return port_info
+
+
+class DVSPortIndexTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(DVSPortIndexTestCase, self).setUp()
+        self.connection = mock.Mock()
+        self.dvs = mock.Mock()
+        self.builder = mock.Mock()
+        self.index = dvs_port_index.DVSPortIndex(self.connection, self.dvs,
+                                                 self.builder)
+        self.ports = [_port_info('1', 'port-a'),
+                      _port_info('2', 'port-b'),
+                      _port_info('3', pg_key='pg-2')]
+        self.connection.invoke_api.return_value = self.ports
+        self.index.resync()
+        self.connection.invoke_api.reset_mock()
+        self.builder.port_criteria.reset_mock()
+
+    def test_resync(self):
+        self.builder.port_criteria.assert_not_called()
+        self.assertEqual(set(self.ports), set(self.index.get_ports()))
+        self.assertIs(self.ports[0], self.index.get_by_key('1'))
+        self.assertIs(self.ports[1], self.index.get_by_name('port-b'))
+        self.assertFalse(self.connection.invoke_api.called)
+
+    def test_get_by_key_unknown_port(self):
+        self.connection.invoke_api.return_value = []
+        self.assertIsNone(self.index.get_by_key('4'))
+        self.builder.port_criteria.assert_called_once_with(port_key=['4'])
+        self.connection.invoke_api.assert_called_once_with(
+            self.connection.vim, 'FetchDVPorts', self.dvs,
+            criteria=self.builder.port_criteria.return_value)
+
+    def test_get_by_name_unknown_port(self):
+        self.assertIsNone(self.index.get_by_name('port-c'))
+        self.assertFalse(self.connection.invoke_api.called)
+
+    def test_invalidate_with_new_name(self):
+        booked = _port_info('3', 'port-c', pg_key='pg-2')
+        self.connection.invoke_api.return_value = [booked]
+        self.index.invalidate('3', 'port-c')
+
+        self.assertIs(booked, self.index.get_by_name('port-c'))
+        self.assertIs(booked, self.index.get_by_key('3'))
+        self.assertEqual(1, self.connection.invoke_api.call_count)
+
+    def test_get_by_name_renamed_port(self):
+        self.connection.invoke_api.return_value = [_port_info('1')]
+        self.index.invalidate('1')
+        self.assertIsNone(self.index.get_by_name('port-a'))
+
+    def test_remove(self):
+        self.index.remove('1')
+        self.assertIsNone(self.index.get_by_name('port-a'))
+        self.assertNotIn(self.ports[0], self.index.get_ports())
+
+    def test_update_port_group(self):
+        added = [_port_info('4'), _port_info('5')]
+        self.connection.invoke_api.return_value = added
+        self.index.update_port_group('pg-1', ['2', '4', '5'])
+
+        self.builder.port_criteria.assert_called_once_with(
+            port_key=mock.ANY)
+        self.assertEqual(
+            set(['4', '5']),
+            set(self.builder.port_criteria.call_args[1]['port_key']))
+        self.assertEqual(set(self.ports[1:] + added),
+                         set(self.index.get_ports()))
+        self.assertIsNone(self.index.get_by_name('port-a'))
+
+    def test_process_update_set(self):
+        change = mock.Mock()
+        change.name = 'portKeys'
+        change.val = mock.Mock(string=['1', '2'])
+        modified = mock.Mock(kind='modify', obj=mock.Mock(value='pg-1'),
+                             changeSet=[change])
+        removed = mock.Mock(kind='leave', obj=mock.Mock(value='pg-2'))
+        update_set = mock.Mock(
+            filterSet=[mock.Mock(objectSet=[modified, removed])])
+        self.index._process_update_set(update_set)
+
+        self.assertFalse(self.connection.invoke_api.called)
+        self.assertEqual(set(self.ports[:2]), set(self.index.get_ports()))
@@ -0,0 +1,90 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import uuid
+
+import mock
+
+from neutron.tests import base
+
+from networking_vsphere.utils import dvs_port_monitor
+
+PORT_1 = str(uuid.uuid4())
+PORT_2 = str(uuid.uuid4())
+PORT_3 = str(uuid.uuid4())
+
+
+def _port_info(name, pg_key='pg-1'):
+    port_info = mock.Mock(portgroupKey=pg_key)
+    port_info.config.name = name
+    return port_info
+
+
+class DVSPortMonitorTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(DVSPortMonitorTestCase, self).setUp()
+        self.connection = mock.Mock()
+        self.dvs = mock.Mock()
+        self.builder = mock.Mock()
+        self.callback = mock.Mock()
+        self.monitor = dvs_port_monitor.DVSPortMonitor(
+            self.connection, self.dvs, self.builder, self.callback)
+        self.connection.invoke_api.return_value = [
+            _port_info(PORT_1), _port_info(PORT_2, 'pg-2'),
+            _port_info('not a neutron port'), _port_info(None)]
+        self.monitor.resync()
+        self.callback.reset_mock()
+        self.builder.port_criteria.reset_mock()
+
+    def _get_update_set(self, *object_updates):
+        return mock.Mock(filterSet=[mock.Mock(objectSet=object_updates)])
+
+    def test_resync(self):
+        self.connection.invoke_api.return_value = [
+            _port_info(PORT_1), _port_info(PORT_3, 'pg-2')]
+        self.monitor.resync()
+
+        self.builder.port_criteria.assert_called_once_with(
+            port_group_key=None, connected=True)
+        self.connection.invoke_api.assert_called_with(
+            self.connection.vim, 'FetchDVPorts', self.dvs,
+            criteria=self.builder.port_criteria.return_value)
+        self.callback.assert_called_once_with(set([PORT_3]), set([PORT_2]))
+
+    def test_resync_without_changes(self):
+        self.monitor.resync()
+        self.assertFalse(self.callback.called)
+
+    def test_port_group_vm_changed(self):
+        self.connection.invoke_api.return_value = [
+            _port_info(PORT_3, 'pg-1')]
+        change = mock.Mock()
+        change.name = 'vm'
+        object_update = mock.Mock(kind='modify',
+                                  obj=mock.Mock(value='pg-1'),
+                                  changeSet=[change])
+        self.monitor._process_update_set(self._get_update_set(object_update))
+
+        self.builder.port_criteria.assert_called_once_with(
+            port_group_key='pg-1', connected=True)
+        self.callback.assert_called_once_with(set([PORT_3]), set([PORT_1]))
+
+    def test_port_group_removed(self):
+        object_update = mock.Mock(kind='leave', obj=mock.Mock(value='pg-2'))
+        self.monitor._process_update_set(self._get_update_set(object_update))
+
+        self.assertFalse(self.builder.port_criteria.called)
+        self.callback.assert_called_once_with(set(), set([PORT_2]))
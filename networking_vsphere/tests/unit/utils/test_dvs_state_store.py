@@ -0,0 +1,55 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+
+from neutron.tests import base
+
+from networking_vsphere.utils import dvs_state_store
+
+
+class StateStoreTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(StateStoreTestCase, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'state', 'dvs.sqlite')
+        self.store = dvs_state_store.StateStore(self.path)
+
+    def test_ports(self):
+        port = {'id': 'port-1', 'device': 'port-1', 'network_id': 'net-1',
+                'binding:vif_details': {'dvs_port_key': '10'}}
+        self.store.set_ports([port, dict(port, id='port-2',
+                                         device='port-2')])
+        self.store.remove_ports(['port-2'])
+
+        store = dvs_state_store.StateStore(self.path)
+        self.assertEqual({'port-1': port}, store.get_ports())
+
+    def test_applied_rules(self):
+        self.store.set_applied_rules('dvs-1', {'10': ('port-1', 'fp-1'),
+                                               '11': ('port-2', 'fp-2')})
+        self.store.set_applied_rules('dvs-2', {'10': ('port-3', 'fp-3')})
+        self.store.set_applied_rules('dvs-1', {'10': ('port-1', 'fp-4')})
+        self.store.forget_applied_rules('dvs-1', ['11'])
+
+        store = dvs_state_store.StateStore(self.path)
+        self.assertEqual({'10': ('port-1', 'fp-4')},
+                         store.get_applied_rules('dvs-1'))
+        store.forget_applied_rules('dvs-2')
+        self.assertEqual({}, self.store.get_applied_rules('dvs-2'))
@@ -0,0 +1,191 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from neutron.tests import base
+from oslo_vmware import exceptions as vmware_exceptions
+
+from networking_vsphere.utils import dvs_task_tracker
+from networking_vsphere.utils import vim_util
+
+
+class TaskTrackerTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(TaskTrackerTestCase, self).setUp()
+        self.connection = mock.Mock()
+        self.vim = self.connection.vim
+        self.tracker = dvs_task_tracker.TaskTracker(self.connection)
+        self.collector = mock.Mock()
+        self.filters = {}
+
+        def invoke_api(module, method, *args, **kwargs):
+            if method == 'create_property_collector':
+                return self.collector
+            if method == 'create_filter':
+                task = args[1].objectSet[0].obj
+                self.filters[task.value] = mock.Mock()
+                return self.filters[task.value]
+        self.connection.invoke_api.side_effect = invoke_api
+
+        self.task1 = mock.Mock(value='task-1')
+        self.task2 = mock.Mock(value='task-2')
+
+    def _get_update_set(self, task, state, **info):
+        task_info = mock.Mock(state=state, **info)
+        change = mock.Mock(val=task_info)
+        change.name = 'info'
+        object_update = mock.Mock(obj=task, changeSet=[change])
+        return mock.Mock(filterSet=[mock.Mock(objectSet=[object_update])])
+
+    def test_submit_before_collector(self):
+        future = self.tracker.submit(self.task1)
+
+        self.assertFalse(self.connection.invoke_api.called)
+        self.assertFalse(future.done())
+        self.assertTrue(self.tracker._pending.is_set())
+
+        self.tracker._reset_collector()
+        self.assertIs(self.collector, self.tracker._collector)
+        self.assertEqual(['task-1'], list(self.filters))
+        self.assertIs(self.filters['task-1'],
+                      self.tracker._tasks['task-1'][1])
+
+    def test_submit_creates_filter(self):
+        self.tracker._reset_collector()
+        self.tracker.submit(self.task1)
+        self.connection.invoke_api.assert_called_with(
+            vim_util, 'create_filter', self.vim, mock.ANY, self.collector)
+        self.assertIn('task-1', self.filters)
+
+    def test_submit_filter_failure(self):
+        self.tracker._reset_collector()
+        self.connection.invoke_api.side_effect = (
+            vmware_exceptions.VimException('error'))
+        self.assertRaises(vmware_exceptions.VimException,
+                          self.tracker.submit, self.task1)
+        self.assertEqual({}, self.tracker._tasks)
+
+    def test_task_success(self):
+        self.tracker._reset_collector()
+        future1 = self.tracker.submit(self.task1)
+        future2 = self.tracker.submit(self.task2)
+
+        update_set = self._get_update_set(self.task1, 'success')
+        self.tracker._process_update_set(update_set)
+        self.assertTrue(future1.done())
+        self.assertIs(update_set.filterSet[0].objectSet[0].changeSet[0].val,
+                      future1.result())
+        self.connection.invoke_api.assert_called_with(
+            self.vim, 'DestroyPropertyFilter', self.filters['task-1'])
+        self.assertTrue(self.tracker._pending.is_set())
+
+        self.tracker._process_update_set(
+            self._get_update_set(self.task2, 'running'))
+        self.assertFalse(future2.done())
+        self.tracker._process_update_set(
+            self._get_update_set(self.task2, 'success'))
+        self.assertTrue(future2.done())
+        self.assertFalse(self.tracker._pending.is_set())
+
+    def test_task_error(self):
+        future = self.tracker.submit(self.task1)
+        error = mock.Mock(localizedMessage='failed')
+        with mock.patch.object(vmware_exceptions, 'translate_fault',
+                               return_value=vmware_exceptions.VimException(
+                                   'failed')) as translate_mock:
+            self.tracker._process_update_set(
+                self._get_update_set(self.task1, 'error', error=error))
+        translate_mock.assert_called_once_with(error)
+        self.assertRaises(vmware_exceptions.VimException, future.result)
+
+    def test_reset_collector_task_not_found(self):
+        future1 = self.tracker.submit(self.task1)
+        future2 = self.tracker.submit(self.task2)
+        invoke_api = self.connection.invoke_api.side_effect
+
+        def create_filter(module, method, *args, **kwargs):
+            if (method == 'create_filter' and
+                    args[1].objectSet[0].obj is self.task1):
+                raise vmware_exceptions.ManagedObjectNotFoundException()
+            return invoke_api(module, method, *args, **kwargs)
+        self.connection.invoke_api.side_effect = create_filter
+
+        self.tracker._reset_collector()
+        self.assertRaises(vmware_exceptions.ManagedObjectNotFoundException,
+                          future1.result)
+        self.assertFalse(future2.done())
+        self.assertEqual(['task-2'], list(self.tracker._tasks))
+        self.assertIs(self.filters['task-2'],
+                      self.tracker._tasks['task-2'][1])
+
+    def test_submit_filter_after_completion(self):
+        self.tracker._reset_collector()
+        invoke_api = self.connection.invoke_api.side_effect
+
+        def create_filter(module, method, *args, **kwargs):
+            property_filter = invoke_api(module, method, *args, **kwargs)
+            if method == 'create_filter':
+                # Completed before the filter is recorded.
+                self.tracker._complete('task-1', mock.Mock(state='success'))
+            return property_filter
+        self.connection.invoke_api.side_effect = create_filter
+
+        future = self.tracker.submit(self.task1)
+        self.assertTrue(future.done())
+        self.assertEqual({}, self.tracker._tasks)
+        self.connection.invoke_api.assert_called_with(
+            self.vim, 'DestroyPropertyFilter', self.filters['task-1'])
+
+    def test_submit_filter_failure_after_reset(self):
+        self.tracker._reset_collector()
+        invoke_api = self.connection.invoke_api.side_effect
+
+        def create_filter(module, method, *args, **kwargs):
+            if method == 'create_filter' and args[2] is self.collector:
+                # Another collector replaced the one the filter was for.
+                self.tracker._collector = mock.Mock()
+                raise vmware_exceptions.VimException('error')
+            return invoke_api(module, method, *args, **kwargs)
+        self.connection.invoke_api.side_effect = create_filter
+
+        future = self.tracker.submit(self.task1)
+        self.assertFalse(future.done())
+        self.assertEqual([future, None], self.tracker._tasks['task-1'])
+
+    def test_result_timeout(self):
+        future = dvs_task_tracker.TaskFuture(self.task1)
+        self.assertRaises(vmware_exceptions.VimException, future.result, 0)
+
+    @mock.patch.object(dvs_task_tracker, 'RESULT_TIMEOUT', 0)
+    def test_wait_for_task_falls_back_to_polling(self):
+        self.tracker._reset_collector()
+        task_info = self.tracker.wait_for_task(self.task1)
+        self.assertIs(self.connection.wait_for_task.return_value, task_info)
+        self.connection.wait_for_task.assert_called_once_with(self.task1)
+        self.assertEqual({}, self.tracker._tasks)
+        self.assertFalse(self.tracker._pending.is_set())
+        self.connection.invoke_api.assert_any_call(
+            self.vim, 'DestroyPropertyFilter', self.filters['task-1'])
+
+    @mock.patch.object(dvs_task_tracker, 'RESULT_TIMEOUT', 0)
+    def test_wait_for_task_error(self):
+        future = dvs_task_tracker.TaskFuture(self.task1)
+        future.set_error(vmware_exceptions.VimException('failed'))
+        with mock.patch.object(self.tracker, 'submit', return_value=future):
+            self.assertRaises(vmware_exceptions.VimException,
+                              self.tracker.wait_for_task, self.task1)
+        self.assertFalse(self.connection.wait_for_task.called)
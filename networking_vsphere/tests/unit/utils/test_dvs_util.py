@@ -14,6 +14,7 @@
 #    under the License.
 
 import mock
+import threading
 
 from neutron.tests import base
 from oslo_vmware import exceptions as vmware_exceptions
@@ -198,6 +199,83 @@ class DVSControllerTestCase(DVSControllerBaseTestCase):
         self.connection.wait_for_task.return_value = mock.Mock(state="success")
         self.controller.release_port(fake_port)
 
+    def test_get_connected_port_keys(self):
+        self.controller.builder = mock.Mock()
+        self.connection.invoke_api.return_value = ['1']
+        self.assertEqual(set(['1']),
+                         self.controller.get_connected_port_keys(['1', '2']))
+        self.controller.builder.port_criteria.assert_called_once_with(
+            port_key=['1', '2'])
+        criteria = self.controller.builder.port_criteria.return_value
+        self.assertTrue(criteria.connected)
+        self.connection.invoke_api.assert_called_once_with(
+            self.vim, 'FetchDVPortKeys', self.dvs, criteria=criteria)
+
+        self.assertEqual(set(), self.controller.get_connected_port_keys([]))
+        self.assertEqual(1, self.connection.invoke_api.call_count)
+
+    def _get_released_ports(self):
+        ports = [{'id': 'port_%s' % i,
+                  'binding:vif_details': {'dvs_port_key': str(i)}}
+                 for i in range(2)]
+        ports.append({'id': 'port_by_name'})
+        port_infos = [mock.Mock(key=str(i)) for i in range(3)]
+        return ports, port_infos
+
+    def test_release_ports(self):
+        ports, port_infos = self._get_released_ports()
+        self.controller.builder = mock.Mock()
+        self.controller.builder.port_config_spec.side_effect = (
+            lambda *args, **kwargs: mock.Mock())
+        self.controller._blocked_ports.update(['0', '2'])
+        with mock.patch.object(self.controller, '_get_port_infos_by_portkeys',
+                               return_value=port_infos[:2]) as by_keys, \
+                mock.patch.object(self.controller, 'get_port_info',
+                                  return_value=port_infos[2]):
+            self.controller.release_ports(ports)
+
+        self.assertEqual(set(['0', '1']), set(by_keys.call_args[0][0]))
+        self.connection.invoke_api.assert_called_once_with(
+            self.vim, 'ReconfigureDVPort_Task', self.dvs, port=mock.ANY)
+        update_specs = self.connection.invoke_api.call_args[1]['port']
+        self.assertEqual(set(['0', '1', '2']),
+                         set(spec.key for spec in update_specs))
+        self.assertEqual(set(['remove']),
+                         set(spec.operation for spec in update_specs))
+        self.assertEqual(1, self.connection.wait_for_task.call_count)
+        self.assertEqual(set(), self.controller._blocked_ports)
+
+    def test_release_ports_in_use(self):
+        ports, port_infos = self._get_released_ports()
+        # Task faults are translated to driver exceptions, not VimException.
+        self.connection.wait_for_task.side_effect = (
+            vmware_exceptions.VMwareDriverException(
+                "The resource '1' %s" % dvs_const.RESOURCE_IN_USE))
+        with mock.patch.object(self.controller, '_get_port_infos_by_portkeys',
+                               return_value=port_infos[:2]), \
+                mock.patch.object(self.controller, 'get_port_info',
+                                  return_value=port_infos[2]), \
+                mock.patch.object(self.controller,
+                                  'release_port') as release_port_mock:
+            self.controller.release_ports(ports)
+
+        self.assertEqual(3, release_port_mock.call_count)
+
+    def test_release_ports_task_fault(self):
+        ports, port_infos = self._get_released_ports()
+        self.connection.wait_for_task.side_effect = (
+            vmware_exceptions.VMwareDriverException('Other fault'))
+        with mock.patch.object(self.controller, '_get_port_infos_by_portkeys',
+                               return_value=port_infos[:2]), \
+                mock.patch.object(self.controller, 'get_port_info',
+                                  return_value=port_infos[2]), \
+                mock.patch.object(self.controller,
+                                  'release_port') as release_port_mock:
+            self.assertRaises(vmware_exceptions.VMwareDriverException,
+                              self.controller.release_ports, ports)
+
+        self.assertFalse(release_port_mock.called)
+
     @mock.patch('networking_vsphere.utils.dvs_util.DVSController.'
                 'get_port_info', side_effect=exceptions.PortNotFound())
     def test_release_port_not_found(self, get_port_info_mock):
@@ -258,6 +336,61 @@ class DVSControllerTestCase(DVSControllerBaseTestCase):
             result = self.controller.get_port_info(port)
             self.assertEqual(result, fake_port_info)
 
+    def test_get_port_info_with_port_index(self):
+        port_info = mock.Mock()
+        self.controller._port_index = mock.Mock()
+        self.controller._port_index.get_by_name.return_value = port_info
+        self.assertEqual(port_info,
+                         self.controller.get_port_info({'id': 'port_id'}))
+        self.controller._port_index.get_by_name.assert_called_once_with(
+            'port_id')
+
+        self.controller._port_index.get_by_key.return_value = None
+        self.assertRaises(
+            exceptions.PortNotFound, self.controller.get_port_info,
+            {'id': 'port_id', 'binding:vif_details': {'dvs_port_key': '1'}})
+        self.controller._port_index.get_by_key.assert_called_once_with('1')
+        self.assertFalse(self.connection.invoke_api.called)
+
+    def test_get_port_info_by_name_index_miss(self):
+        port_info = mock.Mock()
+        self.controller._port_index = mock.Mock()
+        self.controller._port_index.get_by_name.side_effect = [None,
+                                                               port_info]
+        self.assertEqual(port_info,
+                         self.controller.get_port_info({'id': 'port_id'}))
+        self.controller._port_index.resync.assert_called_once_with()
+
+        self.controller._port_index.get_by_name.side_effect = None
+        self.controller._port_index.get_by_name.return_value = None
+        self.assertRaises(exceptions.PortNotFound,
+                          self.controller.get_port_info, {'id': 'port_id'})
+        self.assertEqual(2, self.controller._port_index.resync.call_count)
+
+    def test_get_port_info_refresh(self):
+        port = {'id': 'port_id', 'binding:vif_details': {'dvs_port_key': '1'}}
+        self.controller._port_index = mock.Mock()
+        self.controller.get_port_info(port)
+        self.assertFalse(self.controller._port_index.invalidate.called)
+
+        self.assertEqual(self.controller._port_index.get_by_key.return_value,
+                         self.controller.get_port_info(port, refresh=True))
+        self.controller._port_index.invalidate.assert_called_once_with('1')
+
+    def test_wait_for_task(self):
+        task = mock.Mock()
+        self.assertEqual(self.connection.wait_for_task.return_value,
+                         self.controller._wait_for_task(task))
+        self.connection.wait_for_task.assert_called_once_with(task)
+
+        self.controller.task_tracker = mock.Mock()
+        self.assertEqual(
+            self.controller.task_tracker.wait_for_task.return_value,
+            self.controller._wait_for_task(task))
+        self.controller.task_tracker.wait_for_task.assert_called_once_with(
+            task)
+        self.assertEqual(1, self.connection.wait_for_task.call_count)
+
     def _get_connection_mock(self, dvs_name):
         return mock.Mock(vim=self.vim)
 
@@ -572,6 +705,86 @@ class DVSControllerNetworkDeletionTestCase(DVSControllerBaseTestCase):
         return connection
 
 
+class DVSControllerPortGroupPropertiesTestCase(DVSControllerBaseTestCase):
+
+    def setUp(self):
+        super(DVSControllerPortGroupPropertiesTestCase, self).setUp()
+        self.pg = mock.Mock(value='pg-1')
+        self.removed_pg = mock.Mock(value='pg-2')
+        self.pg_to_delete = mock.Mock(value='pg-3')
+        self.obj_contents = [
+            self._get_obj_content(self.pg, 'pg_name', 10, 7),
+            mock.Mock(obj=self.removed_pg, propSet=None),
+            self._get_obj_content(
+                self.pg_to_delete,
+                self.controller._get_net_name(fake_network), 4, 8)]
+        self.connection.invoke_api.return_value = self.obj_contents
+
+    def _get_obj_content(self, pg, name, num_ports, vlan_id):
+        prop_set = []
+        for prop_name, val in (
+                ('name', name), ('key', pg.value),
+                ('config.configVersion', '1'),
+                ('config.numPorts', num_ports),
+                ('config.defaultPortConfig.vlan',
+                 mock.Mock(vlanId=vlan_id))):
+            prop = mock.Mock(val=val)
+            prop.name = prop_name
+            prop_set.append(prop)
+        return mock.Mock(obj=pg, propSet=prop_set)
+
+    def test_get_port_groups_properties(self):
+        pg_refs = [self.pg, self.removed_pg, self.pg_to_delete]
+        result = self.controller._get_port_groups_properties(pg_refs)
+
+        self.connection.invoke_api.assert_called_once_with(
+            dvs_util.vsphere_vim_util,
+            'get_properties_for_a_collection_of_objects', self.vim,
+            'DistributedVirtualPortgroup', pg_refs, dvs_util.PG_PROPERTIES)
+        self.assertEqual(2, len(result))
+        self.assertEqual({'item': self.pg,
+                          'name': 'pg_name',
+                          'pg_key': 'pg-1',
+                          'config_version': '1',
+                          'num_ports': 10,
+                          'vlan_id': 7}, result[0])
+
+    def test_get_port_groups_properties_without_port_groups(self):
+        self.assertEqual([], self.controller._get_port_groups_properties([]))
+        self.assertFalse(self.connection.invoke_api.called)
+
+    def test_delete_networks_without_active_ports(self):
+        with mock.patch.object(self.controller, '_get_all_port_groups'), \
+                mock.patch.object(self.controller,
+                                  '_delete_port_group') as delete_mock:
+            self.controller.delete_networks_without_active_ports(['pg-1'])
+        delete_mock.assert_called_once_with(
+            self.pg_to_delete, self.controller._get_net_name(fake_network))
+        self.assertEqual(1, self.connection.invoke_api.call_count)
+
+    def test_init_pg_cache(self):
+        with mock.patch.object(dvs_util.DVSController,
+                               '_get_all_port_groups'), \
+                mock.patch.object(dvs_util.DVSControllerWithCache,
+                                  '_start_free_ports_replenisher'):
+            controller = dvs_util.DVSControllerWithCache(
+                self.dvs_name, self.cluster_name, self.connection)
+        self.assertEqual(1, self.connection.invoke_api.call_count)
+        self.assertEqual(
+            {'item': self.pg,
+             'status': dvs_util.READY_PG_STATUS,
+             'pg_key': 'pg-1',
+             'config_version': '1',
+             'num_ports': 10,
+             'vlan_id': 7},
+            controller._pg_cache['pg_name'])
+        self.assertEqual(2, len(controller._pg_cache))
+        self.assertEqual('pg_name', controller._get_pg_name_by_key('pg-1'))
+
+    def _get_connection_mock(self, dvs_name):
+        return mock.Mock(vim=self.vim)
+
+
 class DVSControllerPortUpdateTestCase(DVSControllerBaseTestCase):
 
     def test_switch_port_blocked_state(self):
@@ -615,6 +828,512 @@ class DVSControllerPortUpdateTestCase(DVSControllerBaseTestCase):
         return mock.Mock(vim=self.vim)
 
 
+class DVSControllerBookPortTestCase(DVSControllerBaseTestCase):
+
+    def setUp(self):
+        super(DVSControllerBookPortTestCase, self).setUp()
+        self.pg = mock.Mock(value='_pg_key_')
+        self.controller.builder = spec_builder.SpecBuilder(
+            self._get_factory_mock(('ns0:DVPortConfigSpec',
+                                    'ns0:VMwareDVSPortSetting',
+                                    'ns0:BoolPolicy')))
+        self.use_patch('networking_vsphere.utils.dvs_util.DVSController.'
+                       '_get_or_create_pg', return_value=self.pg)
+
+    def _get_port_infos(self, count):
+        return [mock.Mock(key='_port_key_%s' % i) for i in range(count)]
+
+    def test_book_port_without_batch_window(self):
+        CONF.set_override('book_port_batch_window', 0, 'DVS')
+        self.addCleanup(CONF.clear_override, 'book_port_batch_window', 'DVS')
+        port_info = self._get_port_infos(1)[0]
+        with mock.patch.object(self.controller,
+                               '_lookup_unbound_ports_or_increase_pg',
+                               return_value=[port_info]):
+            result = self.controller.book_port(fake_network, 'port_id',
+                                               fake_segment)
+
+        self.assertEqual({'key': port_info.key,
+                          'dvs_uuid': self._dvs_uuid,
+                          'pg_key': '_pg_key_'}, result)
+        args, kwargs = self.connection.invoke_api.call_args
+        self.assertEqual('ReconfigureDVPort_Task', args[1])
+        self.assertEqual(1, len(kwargs['port']))
+        self.assertEqual('port_id', kwargs['port'][0].name)
+
+    def test_book_ports_with_single_task(self):
+        port_infos = self._get_port_infos(3)
+        with mock.patch.object(self.controller,
+                               '_lookup_unbound_ports_or_increase_pg',
+                               return_value=port_infos) as lookup:
+            results = self.controller._book_ports(
+                self.pg, ['port_0', 'port_1', 'port_2'])
+
+        lookup.assert_called_once_with(self.pg, 3)
+        self.assertEqual(1, self.connection.invoke_api.call_count)
+        self.assertEqual(1, self.connection.wait_for_task.call_count)
+        args, kwargs = self.connection.invoke_api.call_args
+        self.assertEqual(['port_0', 'port_1', 'port_2'],
+                         [spec.name for spec in kwargs['port']])
+        self.assertEqual([port_info.key for port_info in port_infos],
+                         [spec.key for spec in kwargs['port']])
+        self.assertEqual([port_info.key for port_info in port_infos],
+                         [result['key'] for result in results])
+
+    def test_book_ports_failure_unblocks_ports(self):
+        port_infos = self._get_port_infos(2)
+        self.connection.wait_for_task.side_effect = (
+            vmware_exceptions.VimException())
+        with mock.patch.object(self.controller,
+                               '_lookup_unbound_ports_or_increase_pg',
+                               return_value=port_infos), \
+                mock.patch.object(dvs_util, 'sleep'), \
+                mock.patch.object(self.controller,
+                                  'remove_block') as remove_block:
+            self.assertRaises(exceptions.VMWareDVSException,
+                              self.controller._book_ports,
+                              self.pg, ['port_0', 'port_1'])
+        self.assertEqual(dvs_util.BOOK_PORT_RETRIES,
+                         self.connection.wait_for_task.call_count)
+        self.assertEqual(2 * dvs_util.BOOK_PORT_RETRIES,
+                         remove_block.call_count)
+
+    def test_book_port_collects_requests_of_window(self):
+        other = dvs_util.PortBooking('port_1')
+
+        def concurrent_request(window):
+            self.controller._pending_bookings[self.pg.value].append(other)
+
+        with mock.patch.object(dvs_util, 'sleep',
+                               side_effect=concurrent_request), \
+                mock.patch.object(self.controller, '_book_ports',
+                                  return_value=['result_0', 'result_1']) as \
+                book_ports:
+            result = self.controller.book_port(fake_network, 'port_0',
+                                               fake_segment)
+
+        book_ports.assert_called_once_with(self.pg, ['port_0', 'port_1'])
+        self.assertEqual('result_0', result)
+        self.assertTrue(other.done.is_set())
+        self.assertEqual('result_1', other.result)
+        self.assertEqual({}, self.controller._pending_bookings)
+
+    def test_book_port_batch_aborted(self):
+        other = dvs_util.PortBooking('port_1')
+
+        def concurrent_request(window):
+            self.controller._pending_bookings[self.pg.value].append(other)
+
+        with mock.patch.object(dvs_util, 'sleep',
+                               side_effect=concurrent_request), \
+                mock.patch.object(self.controller, '_book_port_batch',
+                                  side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, self.controller.book_port,
+                              fake_network, 'port_0', fake_segment)
+
+        self.assertTrue(other.done.is_set())
+        self.assertIsInstance(other.error, exceptions.PortBookingFailed)
+        self.assertEqual({}, self.controller._pending_bookings)
+
+    def test_book_port_batch_aborted_during_window(self):
+        other = dvs_util.PortBooking('port_1')
+
+        def concurrent_request(window):
+            self.controller._pending_bookings[self.pg.value].append(other)
+            raise KeyboardInterrupt()
+
+        with mock.patch.object(dvs_util, 'sleep',
+                               side_effect=concurrent_request):
+            self.assertRaises(KeyboardInterrupt, self.controller.book_port,
+                              fake_network, 'port_0', fake_segment)
+
+        self.assertIsInstance(other.error, exceptions.PortBookingFailed)
+        self.assertEqual({}, self.controller._pending_bookings)
+
+    @mock.patch.object(dvs_util, 'BOOK_PORT_TIMEOUT', 0)
+    def test_book_port_in_batch_timeout(self):
+        # Another request leads the batch and never completes it.
+        self.controller._pending_bookings[self.pg.value] = [
+            dvs_util.PortBooking('port_1')]
+        self.assertRaises(exceptions.PortBookingFailed,
+                          self.controller.book_port,
+                          fake_network, 'port_0', fake_segment)
+
+    def test_book_port_batch_splits_by_batch_size(self):
+        CONF.set_override('book_port_batch_size', 2, 'DVS')
+        self.addCleanup(CONF.clear_override, 'book_port_batch_size', 'DVS')
+        bookings = [dvs_util.PortBooking('port_%s' % i) for i in range(3)]
+        with mock.patch.object(self.controller, '_book_ports',
+                               side_effect=[['result_0', 'result_1'],
+                                            ['result_2']]) as book_ports:
+            self.controller._book_port_batch(self.pg, bookings)
+
+        self.assertEqual([mock.call(self.pg, ['port_0', 'port_1']),
+                          mock.call(self.pg, ['port_2'])],
+                         book_ports.call_args_list)
+        self.assertEqual(['result_0', 'result_1', 'result_2'],
+                         [booking.result for booking in bookings])
+
+    def test_book_port_batch_failure(self):
+        bookings = [dvs_util.PortBooking('port_%s' % i) for i in range(2)]
+        error = exceptions.VMWareDVSException(type='VimException',
+                                              message='failed',
+                                              cause=None)
+        with mock.patch.object(self.controller, '_book_ports',
+                               side_effect=error):
+            self.controller._book_port_batch(self.pg, bookings)
+
+        for booking in bookings:
+            self.assertTrue(booking.done.is_set())
+            self.assertIs(error, booking.error)
+
+    def test_lookup_unbound_ports_or_increase_pg(self):
+        port_infos = self._get_port_infos(3)
+        with mock.patch.object(self.controller, '_lookup_unbound_ports',
+                               side_effect=[port_infos[:1],
+                                            port_infos[1:]]) as lookup, \
+                mock.patch.object(self.controller,
+                                  '_increase_ports_on_portgroup') as increase:
+            self.assertEqual(
+                port_infos,
+                self.controller._lookup_unbound_ports_or_increase_pg(
+                    self.pg, 3))
+
+        self.assertEqual([mock.call(self.pg, 3), mock.call(self.pg, 2)],
+                         lookup.call_args_list)
+        increase.assert_called_once_with(self.pg, 2)
+
+    def test_lookup_unbound_ports_skips_named_ports(self):
+        named = mock.Mock(key='named')
+        named.config.name = 'other_port'
+        unnamed = mock.Mock(key='unnamed')
+        unnamed.config.name = None
+        with mock.patch.object(self.controller, '_get_free_pg_keys',
+                               return_value=['named', 'unnamed']), \
+                mock.patch.object(self.controller,
+                                  '_get_port_infos_by_portkeys',
+                                  return_value=[named, unnamed]):
+            self.assertEqual(
+                [unnamed],
+                self.controller._lookup_unbound_ports(self.pg, 2))
+        self.assertEqual(set(['named', 'unnamed']),
+                         self.controller._blocked_ports)
+
+    def _get_connection_mock(self, dvs_name):
+        return mock.Mock(vim=self.vim)
+
+
+class DVSControllerWithCacheFreePortsTestCase(DVSControllerBaseTestCase):
+
+    def setUp(self):
+        self.use_patch('networking_vsphere.utils.dvs_util.DVSController.'
+                       '_get_all_port_groups', return_value=[])
+        self.use_patch('networking_vsphere.utils.dvs_util.'
+                       'DVSControllerWithCache._start_free_ports_replenisher')
+        super(DVSControllerWithCacheFreePortsTestCase, self).setUp()
+        self.controller = dvs_util.DVSControllerWithCache(
+            self.dvs_name, self.cluster_name, self.connection)
+        self.pg = mock.Mock(value='_pg_key_')
+        with self.controller._pg_cache_lock:
+            self.controller._set_pg_status(
+                'pg_name', dvs_util.READY_PG_STATUS,
+                item=self.pg, pg_key=self.pg.value)
+
+    def _get_port_infos(self, count):
+        port_infos = [mock.Mock(key='_port_key_%s' % i) for i in range(count)]
+        for port_info in port_infos:
+            port_info.config.name = None
+        return port_infos
+
+    def test_replenisher_disabled_by_default(self):
+        self.assertEqual(0, CONF.DVS.free_ports_low_water_mark)
+        with mock.patch.object(
+                dvs_util.DVSControllerWithCache,
+                '_start_free_ports_replenisher') as start:
+            dvs_util.DVSControllerWithCache(
+                self.dvs_name, self.cluster_name, self.connection)
+        self.assertFalse(start.called)
+
+    def test_lookup_unbound_ports_from_free_ports(self):
+        CONF.set_override('free_ports_low_water_mark', 5, 'DVS')
+        port_infos = self._get_port_infos(10)
+        fresh_port_infos = self._get_port_infos(10)[:-3:-1]
+        self.controller._pg_cache['pg_name']['free_port_infos'] = list(
+            port_infos)
+        with mock.patch.object(
+                self.controller,
+                '_lookup_unbound_ports_on_demand') as on_demand, \
+                mock.patch.object(
+                    self.controller, '_get_port_infos_by_portkeys',
+                    return_value=fresh_port_infos) as get_port_infos:
+            self.assertEqual(
+                fresh_port_infos,
+                self.controller._lookup_unbound_ports(self.pg, 2))
+
+        # Read again for their current configVersion.
+        get_port_infos.assert_called_once_with(
+            [port_info.key for port_info in port_infos[:-3:-1]])
+        self.assertFalse(on_demand.called)
+        self.assertFalse(self.controller._replenish_event.is_set())
+
+    def test_lookup_unbound_ports_free_port_booked_meanwhile(self):
+        port_infos = self._get_port_infos(2)
+        self.controller._pg_cache['pg_name']['free_port_infos'] = [
+            port_infos[0]]
+        booked = self._get_port_infos(1)[0]
+        booked.config.name = 'other_port'
+        with mock.patch.object(
+                self.controller, '_lookup_unbound_ports_on_demand',
+                return_value=[port_infos[1]]) as on_demand, \
+                mock.patch.object(self.controller,
+                                  '_get_port_infos_by_portkeys',
+                                  return_value=[booked]):
+            self.assertEqual(
+                [port_infos[1]],
+                self.controller._lookup_unbound_ports(self.pg, 1))
+        on_demand.assert_called_once_with('pg_name', self.pg, 1)
+
+    def test_lookup_unbound_ports_below_low_water_mark(self):
+        CONF.set_override('free_ports_low_water_mark', 5, 'DVS')
+        port_infos = self._get_port_infos(2)
+        self.controller._pg_cache['pg_name']['free_port_infos'] = [
+            port_infos[0]]
+        with mock.patch.object(
+                self.controller, '_lookup_unbound_ports_on_demand',
+                return_value=[port_infos[1]]) as on_demand, \
+                mock.patch.object(self.controller,
+                                  '_get_port_infos_by_portkeys',
+                                  return_value=port_infos[:1]):
+            self.assertEqual(
+                port_infos,
+                self.controller._lookup_unbound_ports(self.pg, 2))
+
+        on_demand.assert_called_once_with('pg_name', self.pg, 1)
+        self.assertTrue(self.controller._replenish_event.is_set())
+
+    def test_return_unbound_ports_to_free_ports(self):
+        CONF.set_override('cache_free_ports_size', 2, 'DVS')
+        port_infos = self._get_port_infos(3)
+        self.controller._pg_cache['pg_name']['free_port_infos'] = []
+        self.controller._blocked_ports.update(
+            port_info.key for port_info in port_infos)
+        self.controller._return_unbound_ports(self.pg, port_infos)
+        self.assertEqual(
+            port_infos[:2],
+            self.controller._pg_cache['pg_name']['free_port_infos'])
+        self.assertEqual(set(port_info.key for port_info in port_infos[:2]),
+                         self.controller._blocked_ports)
+
+    def test_return_unbound_ports_without_free_ports(self):
+        port_infos = self._get_port_infos(1)
+        self.controller._blocked_ports.add(port_infos[0].key)
+        self.controller._return_unbound_ports(self.pg, port_infos)
+        self.assertEqual(set(), self.controller._blocked_ports)
+        self.assertNotIn('free_port_infos',
+                         self.controller._pg_cache['pg_name'])
+
+    def test_replenish_free_ports(self):
+        CONF.set_override('free_ports_low_water_mark', 5, 'DVS')
+        port_infos = self._get_port_infos(CONF.DVS.cache_free_ports_size)
+        self.controller._pg_cache['pg_name']['free_port_infos'] = []
+        with mock.patch.object(
+                self.controller, '_get_free_pg_keys',
+                return_value=[port_info.key for port_info in port_infos]), \
+                mock.patch.object(self.controller,
+                                  '_get_port_infos_by_portkeys',
+                                  return_value=port_infos), \
+                mock.patch.object(self.controller,
+                                  '_increase_ports_on_portgroup') as increase:
+            self.controller._replenish_all_free_ports()
+
+        self.assertEqual(
+            port_infos,
+            self.controller._pg_cache['pg_name']['free_port_infos'])
+        self.assertEqual(set(port_info.key for port_info in port_infos),
+                         self.controller._blocked_ports)
+        self.assertFalse(increase.called)
+
+    def test_replenish_free_ports_grows_port_group(self):
+        CONF.set_override('free_ports_low_water_mark', 5, 'DVS')
+        self.controller._pg_cache['pg_name']['free_port_infos'] = []
+        with mock.patch.object(self.controller, '_get_free_pg_keys',
+                               return_value=[]), \
+                mock.patch.object(self.controller,
+                                  '_increase_ports_on_portgroup') as increase:
+            self.controller._replenish_free_ports('pg_name')
+
+        increase.assert_called_once_with(self.pg,
+                                         CONF.DVS.cache_free_ports_size)
+        self.assertTrue(self.controller._replenish_event.is_set())
+
+    def test_lookup_unbound_ports_on_demand(self):
+        port_infos = self._get_port_infos(3)
+        port_keys = [port_info.key for port_info in port_infos]
+        self.controller._blocked_ports.add(port_keys[2])
+        with mock.patch.object(self.controller, '_get_free_pg_keys',
+                               return_value=port_keys), \
+                mock.patch.object(self.controller,
+                                  '_get_unbound_port_infos',
+                                  return_value=port_infos[1:2]) as get_infos:
+            self.assertEqual(
+                port_infos[1:2],
+                self.controller._lookup_unbound_ports_on_demand(
+                    'pg_name', self.pg, 1))
+
+        get_infos.assert_called_once_with([port_keys[1]])
+        pg_cache_item = self.controller._pg_cache['pg_name']
+        self.assertEqual(port_keys[:1], pg_cache_item['free_cached_ports'])
+        self.assertEqual(1, pg_cache_item['free_ports_count'])
+
+    def test_lookup_unbound_ports_on_demand_port_group_removed(self):
+        def remove_port_group(port_group):
+            with self.controller._pg_cache_lock:
+                self.controller._pop_pg('pg_name')
+            return ['_port_key_0']
+
+        with mock.patch.object(self.controller, '_get_free_pg_keys',
+                               side_effect=remove_port_group), \
+                mock.patch.object(self.controller,
+                                  '_get_unbound_port_infos') as get_infos:
+            self.assertEqual(
+                [], self.controller._lookup_unbound_ports_on_demand(
+                    'pg_name', self.pg, 1))
+        self.assertFalse(get_infos.called)
+        self.assertNotIn('pg_name', self.controller._pg_cache)
+
+    def test_replenish_free_ports_port_group_removed(self):
+        with self.controller._pg_cache_lock:
+            self.controller._pop_pg('pg_name')
+        with mock.patch.object(self.controller,
+                               '_get_free_pg_keys') as get_keys:
+            self.controller._replenish_free_ports('pg_name')
+        self.assertFalse(get_keys.called)
+
+    def test_replenish_skips_port_groups_without_bookings(self):
+        with mock.patch.object(self.controller,
+                               '_replenish_free_ports') as replenish:
+            self.controller._replenish_all_free_ports()
+        self.assertFalse(replenish.called)
+
+    def _get_connection_mock(self, dvs_name):
+        return mock.Mock(vim=self.vim)
+
+
+class DVSControllerWithCacheStatusTestCase(DVSControllerBaseTestCase):
+
+    def setUp(self):
+        self.use_patch('networking_vsphere.utils.dvs_util.DVSController.'
+                       '_get_all_port_groups', return_value=[])
+        self.use_patch('networking_vsphere.utils.dvs_util.'
+                       'DVSControllerWithCache._start_free_ports_replenisher')
+        super(DVSControllerWithCacheStatusTestCase, self).setUp()
+        self.controller = dvs_util.DVSControllerWithCache(
+            self.dvs_name, self.cluster_name, self.connection)
+        self.pg = mock.Mock(value='_pg_key_')
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _blocking(self, result=None, error=None):
+        def side_effect(*args):
+            self.started.set()
+            self.release.wait(5)
+            if error:
+                raise error
+            return result
+        return side_effect
+
+    def _run_concurrently(self, func, *args):
+        """Run func in two threads, the second one once the first blocks."""
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self._call(func, *args))) for i in range(2)]
+        threads[0].start()
+        self.assertTrue(self.started.wait(5))
+        threads[1].start()
+        threads[1].join(0.1)
+        self.assertTrue(threads[1].is_alive())
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def _call(self, func, *args):
+        try:
+            return func(*args)
+        except Exception as e:
+            return e
+
+    def test_create_network_shares_creation(self):
+        with mock.patch.object(
+                dvs_util.DVSController, 'create_network',
+                side_effect=self._blocking(result=self.pg)) as create_mock:
+            results = self._run_concurrently(
+                self.controller.create_network, fake_network, fake_segment)
+
+        self.assertEqual([self.pg, self.pg], results)
+        self.assertEqual(1, create_mock.call_count)
+        name = self.controller._get_net_name(fake_network)
+        self.assertEqual(dvs_util.READY_PG_STATUS,
+                         self.controller._pg_cache[name]['status'])
+
+    def test_create_network_failure_wakes_up_waiters(self):
+        error = exceptions.VMWareDVSException(type='VimException',
+                                              message='failed',
+                                              cause=None)
+        failing_create = self._blocking(error=error)
+
+        def create_side_effect(*args):
+            if create_mock.call_count == 1:
+                return failing_create(*args)
+            return self.pg
+
+        with mock.patch.object(
+                dvs_util.DVSController, 'create_network',
+                side_effect=create_side_effect) as create_mock:
+            results = self._run_concurrently(
+                self.controller.create_network, fake_network, fake_segment)
+
+        self.assertEqual([error, self.pg], results)
+        self.assertEqual(2, create_mock.call_count)
+
+    def test_pg_names_by_key(self):
+        with self.controller._pg_cache_lock:
+            self.controller._set_pg_status(
+                'pg_name', dvs_util.CREATING_PG_STATUS,
+                item=None, pg_key=None)
+            self.assertIsNone(self.controller._get_pg_name_by_key(None))
+            self.controller._set_pg_status(
+                'pg_name', dvs_util.READY_PG_STATUS,
+                item=self.pg, pg_key=self.pg.value)
+            self.controller._set_pg_status('pg_name',
+                                           dvs_util.UPDATING_PG_STATUS)
+        self.assertEqual('pg_name',
+                         self.controller._get_pg_name_by_key(self.pg.value))
+
+        with self.controller._pg_cache_lock:
+            self.controller._pop_pg('pg_name')
+        self.assertIsNone(self.controller._get_pg_name_by_key(self.pg.value))
+        self.assertEqual({}, self.controller._pg_names_by_key)
+
+    def test_increase_ports_shares_reconfigure_task(self):
+        with self.controller._pg_cache_lock:
+            self.controller._set_pg_status(
+                'pg_name', dvs_util.READY_PG_STATUS,
+                item=self.pg, pg_key=self.pg.value)
+        with mock.patch.object(
+                dvs_util.DVSController, '_increase_ports_on_portgroup',
+                side_effect=self._blocking()) as increase_mock:
+            self._run_concurrently(
+                self.controller._increase_ports_on_portgroup, self.pg, 2)
+
+        increase_mock.assert_called_once_with(self.pg, 2)
+        self.assertEqual(dvs_util.READY_PG_STATUS,
+                         self.controller._pg_cache['pg_name']['status'])
+
+    def _get_connection_mock(self, dvs_name):
+        return mock.Mock(vim=self.vim)
+
+
 class UpdateSecurityGroupRulesTestCase(DVSControllerBaseTestCase):
     BOUND_PORTS = (1, 7, 15)
     UNBOUND_PORT = 123
@@ -725,6 +1444,58 @@ class SpecBuilderTestCase(base.BaseTestCase):
         self.assertNotIn('portKey', dir(criteria))
 
 
+class DVSRoutingTableTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(DVSRoutingTableTestCase, self).setUp()
+        self.dvs1 = self._get_controller('dvs1', 'uuid1', ['dvs1net-1'])
+        self.dvs2 = self._get_controller('dvs2', 'uuid2', ['dvs2net-2'])
+        self.table = dvs_util.DVSRoutingTable([self.dvs1, self.dvs2])
+
+    def _get_controller(self, dvs_name, dvs_uuid, pg_names):
+        controller = mock.Mock(dvs_name=dvs_name, _dvs_uuid=dvs_uuid)
+        controller._get_port_group_names.return_value = pg_names
+        controller._get_net_name.side_effect = (
+            lambda network: dvs_name + network['id'])
+        controller._get_pg_by_name.side_effect = (
+            exceptions.PortGroupNotFound(pg_name='pg'))
+        return controller
+
+    def test_load(self):
+        self.assertIs(self.table, self.dvs1.routing_table)
+        self.assertIs(self.dvs2, self.table.get_dvs_by_uuid('uuid2'))
+        self.assertIsNone(self.table.get_dvs_by_uuid('uuid3'))
+        self.assertIs(self.dvs1, self.table.get_dvs_by_network('net-1'))
+        self.assertIs(self.dvs2,
+                      self.table.get_dvs_by_network('net-2', 'dvs2net-2'))
+        self.assertFalse(self.dvs1._get_pg_by_name.called)
+        self.assertFalse(self.dvs2._get_pg_by_name.called)
+
+    def test_load_failure(self):
+        dvs3 = self._get_controller('dvs3', 'uuid3', [])
+        dvs3._get_port_group_names.side_effect = Exception
+        table = dvs_util.DVSRoutingTable([self.dvs1, dvs3])
+        self.assertIs(dvs3, table.get_dvs_by_uuid('uuid3'))
+        self.assertIs(self.dvs1, table.get_dvs_by_network('net-1'))
+
+    def test_add_remove_port_group(self):
+        self.table.add_port_group(self.dvs2, 'dvs2net-3')
+        self.assertIs(self.dvs2, self.table.get_dvs_by_network('net-3'))
+
+        self.table.remove_port_group(self.dvs2, 'dvs2net-3')
+        self.assertIsNone(self.table.get_dvs_by_network('net-3'))
+        self.assertIsNone(
+            self.table.get_dvs_by_network('net-3', 'dvs2net-3'))
+
+    def test_get_dvs_by_network_looks_up_missing_network(self):
+        self.dvs2._get_pg_by_name.side_effect = None
+        self.assertIs(self.dvs2, self.table.get_dvs_by_network('net-4'))
+        self.dvs2._get_pg_by_name.assert_called_once_with('dvs2net-4')
+
+        self.assertIs(self.dvs2, self.table.get_dvs_by_network('net-4'))
+        self.assertEqual(1, self.dvs2._get_pg_by_name.call_count)
+
+
 class UtilTestCase(base.BaseTestCase):
     """TestCase for functions in util module"""
 
@@ -171,3 +171,57 @@ class TestOVSvAppTunnelBridge(base.TestCase):
             self.assertTrue(mock_del_flow.called)
             self.assertEqual(mock_del_flow.call_count, 2)
             mock_del_flow.assert_any_call(dl_vlan=FAKE_LVID)
+
+
+class TestOVSvAppSecurityBridge(base.TestCase):
+
+    @mock.patch('neutron.agent.ovsdb.api.'
+                'API.get')
+    def setUp(self, mock_ovsdb_api):
+        super(TestOVSvAppSecurityBridge, self).setUp()
+        self.sec_br = ovsvapp_br.OVSvAppSecurityBridge("br-sec")
+
+    def test_bundle_flows(self):
+        with mock.patch.object(ovsvapp_br.utils, "execute") as mock_execute:
+            self.sec_br.bundle_flows(
+                [('del', {'cookie': '0x1/-1'}),
+                 ('add', {'table': 0, 'priority': 10, 'cookie': '0x1',
+                          'actions': 'normal'})])
+            mock_execute.assert_called_once_with(
+                ["ovs-ofctl", "--bundle", "add-flows", "br-sec", "-"],
+                run_as_root=True, process_input=mock.ANY)
+            lines = mock_execute.call_args[1]['process_input'].split("\n")
+            self.assertEqual(2, len(lines))
+            self.assertEqual("delete cookie=0x1/-1", lines[0])
+            self.assertTrue(lines[1].startswith("add "))
+            self.assertIn("actions=normal", lines[1])
+
+    def test_deferred_apply_as_bundle(self):
+        with mock.patch.object(self.sec_br, "bundle_flows") as mock_bundle, \
+                mock.patch.object(self.sec_br,
+                                  "do_action_flows") as mock_do_action:
+            with self.sec_br.deferred(full_ordered=True) as deferred_br:
+                deferred_br.delete_flows(cookie='0x1/-1')
+                deferred_br.add_flow(priority=10, actions='normal')
+                deferred_br.delete_flows(cookie='0x2/-1')
+            mock_bundle.assert_called_once_with(
+                [('del', {'cookie': '0x1/-1'}),
+                 ('add', {'priority': 10, 'actions': 'normal'}),
+                 ('del', {'cookie': '0x2/-1'})])
+            self.assertFalse(mock_do_action.called)
+
+    def test_deferred_apply_bundle_fallback(self):
+        with mock.patch.object(self.sec_br, "bundle_flows",
+                               side_effect=RuntimeError()) as mock_bundle, \
+                mock.patch.object(self.sec_br,
+                                  "do_action_flows") as mock_do_action:
+            with self.sec_br.deferred() as deferred_br:
+                deferred_br.add_flow(priority=10, actions='normal')
+            self.assertTrue(mock_bundle.called)
+            mock_do_action.assert_called_once_with(
+                'add', [{'priority': 10, 'actions': 'normal'}])
+            self.assertFalse(self.sec_br.use_bundle)
+            mock_bundle.reset_mock()
+            with self.sec_br.deferred() as deferred_br:
+                deferred_br.add_flow(priority=10, actions='normal')
+            self.assertFalse(mock_bundle.called)
@@ -0,0 +1,72 @@
+# Copyright 2016 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from neutron.tests import base
+
+from networking_vsphere.utils import rpc_translator
+
+
+class UpdateRulesTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(UpdateRulesTestCase, self).setUp()
+        self.remote_rule = {'direction': 'ingress', 'ethertype': 'IPv4',
+                            'protocol': 'tcp', 'remote_group_id': 'sg-1'}
+        self.egress_rule = {'direction': 'egress', 'ethertype': 'IPv4'}
+        self.devices_info = {
+            'sg_member_ips': {
+                'sg-1': {'IPv4': ['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+                         'IPv6': []}},
+            'security_groups': {
+                'sg-1': [self.remote_rule, self.egress_rule]},
+            'devices': {
+                'port-1': {'fixed_ips': ['10.0.0.1'],
+                           'security_groups': ['sg-1'],
+                           'security_group_rules': []},
+                'port-2': {'fixed_ips': ['10.0.0.2'],
+                           'security_groups': ['sg-1'],
+                           'security_group_rules': []}}}
+
+    def _get_prefixes(self, device):
+        return [rule.get('source_ip_prefix')
+                for rule in device['security_group_rules']]
+
+    def test_update_rules(self):
+        devices = rpc_translator.update_rules(self.devices_info)
+
+        self.assertEqual(['10.0.0.2/32', '10.0.0.3/32', None],
+                         self._get_prefixes(devices['port-1']))
+        self.assertEqual(['10.0.0.1/32', '10.0.0.3/32', None],
+                         self._get_prefixes(devices['port-2']))
+        self.assertIs(self.egress_rule,
+                      devices['port-1']['security_group_rules'][-1])
+        self.assertNotIn('source_ip_prefix', self.remote_rule)
+
+    def test_update_rules_expands_rule_once(self):
+        with mock.patch.object(
+                rpc_translator, 'expand_rule_from_sg',
+                wraps=rpc_translator.expand_rule_from_sg) as expand_mock:
+            rpc_translator.update_rules(self.devices_info)
+        expand_mock.assert_called_once_with(
+            self.remote_rule, self.devices_info['sg_member_ips'])
+
+    def test_build_rules_from_sg(self):
+        rules = rpc_translator.build_rules_from_sg(
+            self.remote_rule, self.devices_info['sg_member_ips'],
+            ['10.0.0.3'])
+        self.assertEqual(['10.0.0.1/32', '10.0.0.2/32'],
+                         [rule['source_ip_prefix'] for rule in rules])
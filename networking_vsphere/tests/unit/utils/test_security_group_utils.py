@@ -13,8 +13,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
+
 import mock
 from neutron.tests import base
+from oslo_vmware import exceptions as vmware_exceptions
 import six
 
 from networking_vsphere.common import constants as dvs_const
@@ -216,3 +219,325 @@ class SpecBuilderSecurityGroupsTestCase(base.BaseTestCase):
         result = rule.build(sequence)
         self.assertEqual(result.sequence, sequence)
         return result
+
+
+class FakeSpec(object):
+
+    def __init__(self, spec_type):
+        self.spec_type = spec_type
+
+
+class BuiltSpecsCacheTestCase(base.BaseTestCase):
+
+    def test_least_recently_used_dropped(self):
+        cache = sg_util.BuiltSpecsCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+
+class PortConfigurationTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(PortConfigurationTestCase, self).setUp()
+        self.factory = mock.Mock(name='factory')
+        self.factory.create.side_effect = FakeSpec
+        self.builder = sg_util.PortConfigSpecBuilder(self.factory)
+        sg_util._built_rules.clear()
+        sg_util._filter_policies.clear()
+        self.addCleanup(sg_util._built_rules.clear)
+        self.addCleanup(sg_util._filter_policies.clear)
+        self.sg_rules = [
+            {'direction': 'ingress', 'ethertype': 'IPv4', 'protocol': 'tcp',
+             'port_range_min': 22, 'port_range_max': 22},
+            {'direction': 'egress', 'ethertype': 'IPv4', 'protocol': 'udp',
+             'dest_ip_prefix': '10.0.0.0/24'}]
+
+    def _get_rules(self, spec):
+        return spec.setting.filterPolicy.filterConfig[0].trafficRuleset.rules
+
+    def test_ports_share_filter_policy(self):
+        spec1 = sg_util.port_configuration(self.builder, '1', self.sg_rules)
+        spec2 = sg_util.port_configuration(self.builder, '2',
+                                           list(self.sg_rules))
+
+        self.assertEqual('1', spec1.key)
+        self.assertEqual('2', spec2.key)
+        self.assertIsNot(spec1, spec2)
+        # Each port gets its own policy, built once.
+        self.assertIsNot(spec1.setting.filterPolicy,
+                         spec2.setting.filterPolicy)
+        self.assertIs(spec1.setting.filterPolicy.filterConfig,
+                      spec2.setting.filterPolicy.filterConfig)
+        rules = self._get_rules(spec1)
+        self.assertEqual([0, 20, 10, 30, 40, 50],
+                         [rule.sequence for rule in rules])
+        self.assertEqual('10. regular', rules[2].description)
+        self.assertEqual('30. reversed 10. regular', rules[3].description)
+
+    def test_built_rules_reused(self):
+        sg_util.port_configuration(self.builder, '1', self.sg_rules)
+        with mock.patch.object(sg_util, '_create_rule') as create_rule:
+            spec = sg_util.port_configuration(
+                self.builder, '2', list(reversed(self.sg_rules)))
+        self.assertFalse(create_rule.called)
+
+        rules = self._get_rules(spec)
+        self.assertEqual([0, 20, 10, 30, 40, 50],
+                         [rule.sequence for rule in rules])
+        self.assertEqual('outgoingPackets', rules[0].direction)
+        self.assertEqual('incomingPackets', rules[2].direction)
+
+    def test_specs_not_shared_between_factories(self):
+        spec1 = sg_util.port_configuration(self.builder, '1', self.sg_rules)
+        factory = mock.Mock(name='other_factory')
+        factory.create.side_effect = FakeSpec
+        builder = sg_util.PortConfigSpecBuilder(factory)
+        spec2 = sg_util.port_configuration(builder, '1', self.sg_rules)
+
+        self.assertIsNot(spec1.setting.filterPolicy.filterConfig,
+                         spec2.setting.filterPolicy.filterConfig)
+        for rule1, rule2 in zip(self._get_rules(spec1),
+                                self._get_rules(spec2)):
+            self.assertIsNot(rule1, rule2)
+        self.assertEqual(2, len(sg_util._filter_policies))
+
+
+class CompactRulesTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(CompactRulesTestCase, self).setUp()
+        sg_util._compacted_rules.clear()
+        self.addCleanup(sg_util._compacted_rules.clear)
+
+    def _rule(self, direction='ingress', ethertype='IPv4', protocol='tcp',
+              **kwargs):
+        rule = {'direction': direction, 'ethertype': ethertype,
+                'protocol': protocol}
+        rule.update(kwargs)
+        return rule
+
+    def test_merge_cidrs(self):
+        rules = [self._rule(source_ip_prefix='10.0.0.%d/32' % i,
+                            port_range_min=22, port_range_max=22)
+                 for i in range(4)]
+        rules.append(self._rule(direction='egress',
+                                dest_ip_prefix='10.0.0.1/32'))
+        compacted = sg_util.compact_rules(rules)
+        self.assertEqual(2, len(compacted))
+        self.assertEqual('10.0.0.0/30', compacted[0]['source_ip_prefix'])
+        self.assertEqual(22, compacted[0]['port_range_min'])
+        self.assertEqual(rules[4], compacted[1])
+
+    def test_fold_port_ranges(self):
+        rules = [self._rule(port_range_min=80, port_range_max=80),
+                 self._rule(port_range_min=81, port_range_max=90),
+                 self._rule(port_range_min=85, port_range_max=100),
+                 self._rule(port_range_min=443, port_range_max=443),
+                 self._rule(protocol='udp', port_range_min=101,
+                            port_range_max=101)]
+        compacted = sg_util.compact_rules(rules)
+        self.assertEqual(
+            [('tcp', 80, 100), ('tcp', 443, 443), ('udp', 101, 101)],
+            [(r['protocol'], r['port_range_min'], r['port_range_max'])
+             for r in compacted])
+
+    def test_drop_covered_rules(self):
+        min_port = dvs_const.MIN_EPHEMERAL_PORT
+        max_port = dvs_const.MAX_EPHEMERAL_PORT
+        rules = [self._rule(source_ip_prefix='10.0.0.5/32',
+                            port_range_min=22, port_range_max=22),
+                 self._rule(source_ip_prefix='10.0.0.0/8'),
+                 self._rule(protocol='icmp', source_ip_prefix='10.1.0.0/16'),
+                 self._rule(protocol=None, source_ip_prefix='10.1.0.0/16'),
+                 self._rule(source_ip_prefix='10.0.0.0/8',
+                            source_port_range_min=min_port,
+                            source_port_range_max=max_port),
+                 self._rule(source_ip_prefix='10.0.0.0/8',
+                            source_port_range_min=1000,
+                            source_port_range_max=1000)]
+        compacted = sg_util.compact_rules(rules)
+        self.assertEqual([rules[3], rules[1], rules[5]], compacted)
+
+    def test_keep_special_rules(self):
+        dhcp = self._rule(protocol='udp', port_range_min=68,
+                          port_range_max=68, source_port_range_min=67,
+                          source_port_range_max=67)
+        rules = [self._rule(protocol=None), dhcp, dhcp]
+        self.assertEqual([dhcp, rules[0]], sg_util.compact_rules(rules))
+
+    def test_compacted_rules_cached(self):
+        rules = [self._rule(source_ip_prefix='10.0.0.%d/32' % i)
+                 for i in range(2)]
+        compacted = sg_util.compact_rules(rules)
+        with mock.patch.object(sg_util, '_compact_rules') as compact_mock:
+            self.assertEqual(compacted,
+                             sg_util.compact_rules(copy.deepcopy(rules)))
+        self.assertFalse(compact_mock.called)
+
+        # The cached rules are not changed through the returned ones.
+        compacted[0]['protocol'] = 'udp'
+        self.assertEqual('tcp', sg_util.compact_rules(rules)[0]['protocol'])
+
+
+class UpdatePortRulesTestCase(test_dvs_util.DVSControllerBaseTestCase):
+
+    def setUp(self):
+        super(UpdatePortRulesTestCase, self).setUp()
+        self.port_configuration = self.use_patch(
+            'networking_vsphere.utils.security_group_utils.'
+            'port_configuration')
+        self.ports = [self._get_port('port-1', '1'),
+                      self._get_port('port-2', '2')]
+
+    def _get_connection_mock(self, dvs_name):
+        return mock.Mock(vim=self.vim)
+
+    def _get_port(self, port_id, port_key, protocol='tcp'):
+        return {'id': port_id,
+                'binding:vif_details': {'dvs_port_key': port_key},
+                'security_group_rules': [{'direction': 'ingress',
+                                          'ethertype': 'IPv4',
+                                          'protocol': protocol}]}
+
+    def _get_configured_keys(self):
+        return [call[0][1] for call in
+                self.port_configuration.call_args_list]
+
+    def test_update_port_rules_skips_applied_rules(self):
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.assertEqual(['1', '2'], self._get_configured_keys())
+        self.assertEqual(1, self.connection.invoke_api.call_count)
+
+        self.port_configuration.reset_mock()
+        self.connection.invoke_api.reset_mock()
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.assertFalse(self.port_configuration.called)
+        self.assertFalse(self.connection.invoke_api.called)
+
+    def test_update_port_rules_reset_rules(self):
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.port_configuration.reset_mock()
+
+        ports = [dict(self.ports[0], reset_rules=True), self.ports[1]]
+        sg_util.update_port_rules(self.controller, ports)
+        self.assertEqual(['1'], self._get_configured_keys())
+
+        self.port_configuration.reset_mock()
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.assertFalse(self.port_configuration.called)
+
+    def test_update_port_rules_changed_rules(self):
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.port_configuration.reset_mock()
+
+        ports = [self.ports[0], self._get_port('port-2', '2', 'udp')]
+        sg_util.update_port_rules(self.controller, ports)
+        self.assertEqual(['2'], self._get_configured_keys())
+
+    def test_update_port_rules_port_key_reused(self):
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.port_configuration.reset_mock()
+
+        sg_util.update_port_rules(self.controller,
+                                  [self._get_port('port-3', '1')])
+        self.assertEqual(['1'], self._get_configured_keys())
+
+    def test_update_port_rules_task_failure(self):
+        self.controller.task_tracker = mock.Mock()
+        self.controller.task_tracker.wait_for_task.side_effect = (
+            vmware_exceptions.VimException(
+                'The object or item referred to could not be found'))
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.assertIsNone(self.controller.get_applied_rules('1'))
+
+        self.controller.task_tracker.wait_for_task.side_effect = None
+        self.port_configuration.reset_mock()
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.assertEqual(['1', '2'], self._get_configured_keys())
+        self.assertEqual('port-1', self.controller.get_applied_rules('1')[0])
+
+    def test_update_port_rules_concurrent_modification(self):
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.port_configuration.reset_mock()
+        self.controller.task_tracker = mock.Mock()
+        self.controller.task_tracker.wait_for_task.side_effect = [
+            vmware_exceptions.VimFaultException(
+                [], dvs_const.CONCURRENT_MODIFICATION_TEXT), None]
+
+        ports = [self.ports[0], self._get_port('port-2', '2', 'udp')]
+        sg_util.update_port_rules(self.controller, ports)
+        # Retried with the rules of all the ports of the batch.
+        self.assertEqual(['2', '1', '2'], self._get_configured_keys())
+        self.assertEqual('port-1', self.controller.get_applied_rules('1')[0])
+
+    def test_update_port_rules_not_found_forgets_batch(self):
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.controller.task_tracker = mock.Mock()
+        self.controller.task_tracker.wait_for_task.side_effect = (
+            vmware_exceptions.VimException(
+                'The object or item referred to could not be found'))
+
+        ports = [self.ports[0], self._get_port('port-2', '2', 'udp')]
+        sg_util.update_port_rules(self.controller, ports)
+        self.assertIsNone(self.controller.get_applied_rules('1'))
+        self.assertIsNone(self.controller.get_applied_rules('2'))
+
+    def test_update_port_rules_port_moved(self):
+        sg_util.update_port_rules(self.controller, self.ports)
+        sg_util.update_port_rules(self.controller,
+                                  [self._get_port('port-1', '3')])
+        self.assertIsNone(self.controller.get_applied_rules('1'))
+        self.assertEqual('port-1', self.controller.get_applied_rules('3')[0])
+        self.assertEqual('3', self.controller._applied_keys['port-1'])
+
+    def test_update_port_rules_config_version_changed(self):
+        port_index = self.controller._port_index = mock.Mock()
+        port_info = port_index.get_by_key.return_value
+        port_info.config.configVersion = '5'
+        sg_util.update_port_rules(self.controller, self.ports)
+        port_index.invalidate.assert_has_calls([mock.call('1'),
+                                                mock.call('2')],
+                                               any_order=True)
+
+        # The version read after the update is the one of the rules.
+        self.port_configuration.reset_mock()
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.assertFalse(self.port_configuration.called)
+
+        # Changes made by the controller itself are expected.
+        self.controller._invalidate_port('1')
+        port_info.config.configVersion = '6'
+        sg_util.update_port_rules(self.controller, self.ports[:1])
+        self.assertFalse(self.port_configuration.called)
+
+        # Reconfigured by someone else.
+        port_info.config.configVersion = '7'
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.assertEqual(['1', '2'], self._get_configured_keys())
+
+    def test_update_port_rules_state_store(self):
+        state_store = mock.Mock()
+        state_store.get_applied_rules.return_value = {
+            '1': ('port-1', sg_util.get_rules_fingerprint(
+                self.ports[0]['security_group_rules'])),
+            '3': ('port-3', 'fingerprint')}
+        self.controller.load_applied_rules(state_store)
+        state_store.get_applied_rules.assert_called_once_with(
+            self.controller._dvs_uuid)
+
+        sg_util.update_port_rules(self.controller, self.ports)
+        self.assertEqual(['2'], self._get_configured_keys())
+        state_store.set_applied_rules.assert_called_once_with(
+            self.controller._dvs_uuid,
+            {'2': ('port-2', self.controller.get_applied_rules('2')[1])})
+
+        self.controller.forget_applied_rules(['3', '4'])
+        state_store.forget_applied_rules.assert_called_once_with(
+            self.controller._dvs_uuid, ['3'])
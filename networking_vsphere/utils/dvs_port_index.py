@@ -0,0 +1,249 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from oslo_log import log
+from oslo_vmware import vim_util as vutil
+
+from networking_vsphere._i18n import _LE, _LI
+from networking_vsphere.common import vmware_conf as config
+from networking_vsphere.utils import common_util
+from networking_vsphere.utils import vim_util
+
+CONF = config.CONF
+LOG = log.getLogger(__name__)
+
+# Seconds a WaitForUpdatesEx call may block, below the http socket timeout.
+MAX_WAIT_SECONDS = 60
+RETRY_INTERVAL = 5
+
+
+class DVSPortIndex(object):
+    """In-memory index of the ports of a DVS by port key and port name.
+
+    The index is loaded with a single FetchDVPorts of the whole switch and
+    kept current from property collector updates of the port keys of the
+    switch port groups: new ports are fetched, removed ones are dropped.
+    Ports reconfigured by the agent are invalidated and fetched again on
+    their next lookup. As updates do not carry the port configuration, the
+    whole switch is fetched again every port_index_resync_interval seconds.
+    """
+
+    def __init__(self, connection, dvs_ref, builder):
+        self.connection = connection
+        self.dvs_ref = dvs_ref
+        self.builder = builder
+        self._ports = {}
+        self._names = {}
+        self._pg_ports = {}
+        self._stale = set()
+        self._lock = threading.RLock()
+        self._last_sync = None
+        self._running = False
+
+    def _fetch_ports(self, port_keys=None):
+        criteria = self.builder.port_criteria(port_key=port_keys)
+        return self.connection.invoke_api(
+            self.connection.vim,
+            'FetchDVPorts',
+            self.dvs_ref, criteria=criteria) or []
+
+    def _add(self, port_info):
+        self._remove(port_info.key)
+        self._ports[port_info.key] = port_info
+        name = getattr(port_info.config, 'name', None)
+        if name:
+            self._names[name] = port_info.key
+        pg_key = getattr(port_info, 'portgroupKey', None)
+        if pg_key:
+            self._pg_ports.setdefault(pg_key, set()).add(port_info.key)
+
+    def _remove(self, port_key):
+        self._stale.discard(port_key)
+        port_info = self._ports.pop(port_key, None)
+        if port_info is None:
+            return
+        name = getattr(port_info.config, 'name', None)
+        if name and self._names.get(name) == port_key:
+            del self._names[name]
+        pg_key = getattr(port_info, 'portgroupKey', None)
+        if pg_key in self._pg_ports:
+            self._pg_ports[pg_key].discard(port_key)
+
+    def resync(self):
+        """Replace the content of the index with all ports of the switch."""
+        start = time.time()
+        port_infos = self._fetch_ports()
+        with self._lock:
+            self._ports = {}
+            self._names = {}
+            self._pg_ports = {}
+            self._stale = set()
+            for port_info in port_infos:
+                self._add(port_info)
+            self._last_sync = time.time()
+        LOG.debug("Indexed %(count)s ports of DVS in %(time).2f seconds.",
+                  {'count': len(port_infos), 'time': time.time() - start})
+
+    def refresh(self, port_keys):
+        """Fetch the given ports again, dropping the ones which are gone."""
+        port_keys = list(port_keys)
+        if not port_keys:
+            return
+        port_infos = self._fetch_ports(port_keys)
+        with self._lock:
+            for port_key in port_keys:
+                self._remove(port_key)
+            for port_info in port_infos:
+                self._add(port_info)
+
+    def invalidate(self, port_key, name=None):
+        """Fetch the port again on its next lookup.
+
+        :param name: new name given to the port, if any.
+        """
+        with self._lock:
+            self._stale.add(port_key)
+            if name:
+                self._names[name] = port_key
+
+    def remove(self, port_key):
+        with self._lock:
+            self._remove(port_key)
+
+    def get_by_key(self, port_key):
+        with self._lock:
+            fetch = port_key in self._stale or port_key not in self._ports
+        if fetch:
+            self.refresh([port_key])
+        return self._ports.get(port_key)
+
+    def get_by_name(self, name):
+        with self._lock:
+            port_key = self._names.get(name)
+        if port_key is None:
+            return None
+        port_info = self.get_by_key(port_key)
+        # The port may have been renamed since it was indexed.
+        if (port_info is None or
+                getattr(port_info.config, 'name', None) != name):
+            return None
+        return port_info
+
+    def get_ports(self):
+        with self._lock:
+            return list(self._ports.values())
+
+    def update_port_group(self, pg_key, port_keys):
+        """Apply the current port keys of a port group to the index."""
+        port_keys = set(port_keys or [])
+        with self._lock:
+            known = set(self._pg_ports.get(pg_key, set()))
+            for port_key in known - port_keys:
+                self._remove(port_key)
+            added = port_keys - known
+        self.refresh(added)
+
+    def remove_port_group(self, pg_key):
+        with self._lock:
+            for port_key in list(self._pg_ports.pop(pg_key, set())):
+                self._remove(port_key)
+
+    def start(self):
+        """Load the index and keep it current from vCenter updates."""
+        self.resync()
+        self._running = True
+        watcher = threading.Thread(target=self._watch_updates,
+                                   name='dvs-port-index')
+        watcher.daemon = True
+        watcher.start()
+
+    def stop(self):
+        self._running = False
+
+    def _build_filter_spec(self):
+        client_factory = self.connection.vim.client.factory
+        traversal_spec = vutil.build_traversal_spec(
+            client_factory, 'dvsToPg', 'DistributedVirtualSwitch',
+            'portgroup', False, [])
+        object_spec = vutil.build_object_spec(
+            client_factory, self.dvs_ref, [traversal_spec])
+        property_spec = vutil.build_property_spec(
+            client_factory, type_='DistributedVirtualPortgroup',
+            properties_to_collect=['portKeys'])
+        return vutil.build_property_filter_spec(
+            client_factory, [property_spec], [object_spec])
+
+    def _process_update_set(self, update_set):
+        for filter_update in update_set.filterSet or []:
+            for object_update in filter_update.objectSet or []:
+                pg_key = object_update.obj.value
+                if object_update.kind == 'leave':
+                    self.remove_port_group(pg_key)
+                    continue
+                changes = common_util.convert_objectupdate_to_dict(
+                    object_update)
+                if 'portKeys' in changes:
+                    port_keys = changes['portKeys']
+                    self.update_port_group(
+                        pg_key, getattr(port_keys, 'string', port_keys))
+
+    def _watch_updates(self):
+        collector = None
+        version = ""
+        while self._running:
+            try:
+                if collector is None:
+                    collector = self.connection.invoke_api(
+                        vim_util, 'create_property_collector',
+                        self.connection.vim)
+                    self.connection.invoke_api(
+                        vim_util, 'create_filter', self.connection.vim,
+                        self._build_filter_spec(), collector)
+                    version = ""
+                update_set = self.connection.invoke_api(
+                    vim_util, 'wait_for_updates_ex', self.connection.vim,
+                    version, collector=collector,
+                    max_wait=MAX_WAIT_SECONDS)
+                if update_set:
+                    version = update_set.version
+                    self._process_update_set(update_set)
+                if (time.time() - self._last_sync >=
+                        CONF.DVS.port_index_resync_interval):
+                    self.resync()
+            except Exception:
+                LOG.exception(_LE("Unable to process DVS port updates, "
+                                  "resyncing the port index."))
+                self._destroy_collector(collector)
+                collector = None
+                time.sleep(RETRY_INTERVAL)
+                try:
+                    self.resync()
+                except Exception:
+                    LOG.exception(_LE("Unable to resync the DVS port "
+                                      "index."))
+        self._destroy_collector(collector)
+        LOG.info(_LI("Stopped watching DVS port updates."))
+
+    def _destroy_collector(self, collector):
+        if collector is not None:
+            try:
+                self.connection.invoke_api(
+                    vim_util, 'destroy_property_collector',
+                    self.connection.vim, collector)
+            except Exception:
+                LOG.debug("Unable to destroy property collector.")
@@ -0,0 +1,189 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+import uuid
+
+from oslo_log import log
+from oslo_vmware import vim_util as vutil
+
+from networking_vsphere._i18n import _LE, _LI
+from networking_vsphere.utils import common_util
+from networking_vsphere.utils import vim_util
+
+LOG = log.getLogger(__name__)
+
+# Seconds a WaitForUpdatesEx call may block, below the http socket timeout.
+MAX_WAIT_SECONDS = 60
+RETRY_INTERVAL = 5
+
+
+def _is_neutron_port_name(name):
+    try:
+        uuid.UUID(name, version=4)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+class DVSPortMonitor(object):
+    """Reports the neutron ports connected to and disconnected from a DVS.
+
+    The virtual machines of the switch port groups are followed with a
+    property collector. When they change, the connected ports of the port
+    group are fetched and compared with the previous ones, the names of the
+    added and removed ports, which are neutron port ids, are given to the
+    callback as two sets.
+    """
+
+    def __init__(self, connection, dvs_ref, builder, callback):
+        self.connection = connection
+        self.dvs_ref = dvs_ref
+        self.builder = builder
+        self.callback = callback
+        # port group key -> names of its connected neutron ports
+        self._pg_ports = {}
+        self._lock = threading.Lock()
+        self._running = False
+
+    def _fetch_connected_ports(self, pg_key=None):
+        criteria = self.builder.port_criteria(port_group_key=pg_key,
+                                              connected=True)
+        port_infos = self.connection.invoke_api(
+            self.connection.vim,
+            'FetchDVPorts',
+            self.dvs_ref, criteria=criteria) or []
+        pg_ports = {}
+        for port_info in port_infos:
+            name = getattr(port_info.config, 'name', None)
+            if _is_neutron_port_name(name):
+                pg_ports.setdefault(port_info.portgroupKey, set()).add(name)
+        return pg_ports
+
+    def _report(self, added, removed):
+        if added or removed:
+            LOG.debug("Ports connected to DVS: %(added)s, disconnected: "
+                      "%(removed)s.", {'added': added, 'removed': removed})
+            self.callback(added, removed)
+
+    def _get_ports(self):
+        """Must be called with _lock held."""
+        ports = set()
+        for names in self._pg_ports.values():
+            ports |= names
+        return ports
+
+    def resync(self):
+        """Fetch all connected ports, reporting the changes."""
+        pg_ports = self._fetch_connected_ports()
+        with self._lock:
+            known = self._get_ports()
+            self._pg_ports = pg_ports
+            ports = self._get_ports()
+        self._report(ports - known, known - ports)
+
+    def update_port_group(self, pg_key):
+        pg_ports = self._fetch_connected_ports(pg_key)
+        with self._lock:
+            known = self._get_ports()
+            self._pg_ports[pg_key] = pg_ports.get(pg_key, set())
+            ports = self._get_ports()
+        self._report(ports - known, known - ports)
+
+    def remove_port_group(self, pg_key):
+        with self._lock:
+            known = self._get_ports()
+            self._pg_ports.pop(pg_key, None)
+            ports = self._get_ports()
+        self._report(set(), known - ports)
+
+    def start(self):
+        """Report the connected ports and follow their changes."""
+        self._running = True
+        watcher = threading.Thread(target=self._watch_updates,
+                                   name='dvs-port-monitor')
+        watcher.daemon = True
+        watcher.start()
+
+    def stop(self):
+        self._running = False
+
+    def _build_filter_spec(self):
+        client_factory = self.connection.vim.client.factory
+        traversal_spec = vutil.build_traversal_spec(
+            client_factory, 'dvsToPg', 'DistributedVirtualSwitch',
+            'portgroup', False, [])
+        object_spec = vutil.build_object_spec(
+            client_factory, self.dvs_ref, [traversal_spec])
+        property_spec = vutil.build_property_spec(
+            client_factory, type_='DistributedVirtualPortgroup',
+            properties_to_collect=['vm'])
+        return vutil.build_property_filter_spec(
+            client_factory, [property_spec], [object_spec])
+
+    def _process_update_set(self, update_set):
+        for filter_update in update_set.filterSet or []:
+            for object_update in filter_update.objectSet or []:
+                pg_key = object_update.obj.value
+                if object_update.kind == 'leave':
+                    self.remove_port_group(pg_key)
+                elif 'vm' in common_util.convert_objectupdate_to_dict(
+                        object_update):
+                    self.update_port_group(pg_key)
+
+    def _watch_updates(self):
+        collector = None
+        version = ""
+        while self._running:
+            try:
+                if collector is None:
+                    collector = self.connection.invoke_api(
+                        vim_util, 'create_property_collector',
+                        self.connection.vim)
+                    self.connection.invoke_api(
+                        vim_util, 'create_filter', self.connection.vim,
+                        self._build_filter_spec(), collector)
+                    # The first update set holds every port group, the
+                    # ports are fetched for the whole switch at once.
+                    update_set = self.connection.invoke_api(
+                        vim_util, 'wait_for_updates_ex', self.connection.vim,
+                        "", collector=collector, max_wait=MAX_WAIT_SECONDS)
+                    version = update_set.version if update_set else ""
+                    self.resync()
+                update_set = self.connection.invoke_api(
+                    vim_util, 'wait_for_updates_ex', self.connection.vim,
+                    version, collector=collector,
+                    max_wait=MAX_WAIT_SECONDS)
+                if update_set:
+                    version = update_set.version
+                    self._process_update_set(update_set)
+            except Exception:
+                LOG.exception(_LE("Unable to process DVS port connection "
+                                  "updates, following them again."))
+                self._destroy_collector(collector)
+                collector = None
+                time.sleep(RETRY_INTERVAL)
+        self._destroy_collector(collector)
+        LOG.info(_LI("Stopped watching DVS port connections."))
+
+    def _destroy_collector(self, collector):
+        if collector is not None:
+            try:
+                self.connection.invoke_api(
+                    vim_util, 'destroy_property_collector',
+                    self.connection.vim, collector)
+            except Exception:
+                LOG.debug("Unable to destroy property collector.")
@@ -0,0 +1,113 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import sqlite3
+import threading
+
+# Seconds a write waits for the other process of the agent to commit.
+LOCK_TIMEOUT = 30
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS ports ("
+    "device TEXT PRIMARY KEY, port TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS applied_rules ("
+    "dvs_uuid TEXT NOT NULL, port_key TEXT NOT NULL, port_id TEXT NOT NULL, "
+    "fingerprint TEXT NOT NULL, PRIMARY KEY (dvs_uuid, port_key))",
+)
+
+
+class StateStore(object):
+    """Snapshot of the state the DVS agent applied, kept across restarts.
+
+    Holds the ports the firewall driver filters and the fingerprints of the
+    rules applied to each DVS port, in a SQLite database shared by the
+    agent and its firewall process. The database is opened on first use,
+    so a store created before the firewall process is forked is not shared
+    with it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _get_db(self):
+        """Must be called with _lock held."""
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            with db:
+                for statement in SCHEMA:
+                    db.execute(statement)
+            self._db = db
+        return self._db
+
+    def _query(self, statement, params=()):
+        with self._lock:
+            return self._get_db().execute(statement, params).fetchall()
+
+    def _write(self, statement, params_list):
+        with self._lock:
+            db = self._get_db()
+            with db:
+                db.executemany(statement, params_list)
+
+    def get_ports(self):
+        """Return the stored ports by device."""
+        ports = {}
+        for device, port in self._query("SELECT device, port FROM ports"):
+            ports[device] = json.loads(port)
+        return ports
+
+    def set_ports(self, ports):
+        self._write("INSERT OR REPLACE INTO ports (device, port) "
+                    "VALUES (?, ?)",
+                    [(port['device'], json.dumps(port)) for port in ports])
+
+    def remove_ports(self, devices):
+        self._write("DELETE FROM ports WHERE device = ?",
+                    [(device,) for device in devices])
+
+    def get_applied_rules(self, dvs_uuid):
+        """Return (port id, fingerprint) of the DVS ports by port key."""
+        return dict(
+            (port_key, (port_id, fingerprint))
+            for port_key, port_id, fingerprint in self._query(
+                "SELECT port_key, port_id, fingerprint FROM applied_rules "
+                "WHERE dvs_uuid = ?", (dvs_uuid,)))
+
+    def set_applied_rules(self, dvs_uuid, applied):
+        self._write("INSERT OR REPLACE INTO applied_rules "
+                    "(dvs_uuid, port_key, port_id, fingerprint) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(dvs_uuid, port_key, port_id, fingerprint)
+                     for port_key, (port_id, fingerprint)
+                     in applied.items()])
+
+    def forget_applied_rules(self, dvs_uuid, port_keys=None):
+        if port_keys is None:
+            self._write("DELETE FROM applied_rules WHERE dvs_uuid = ?",
+                        [(dvs_uuid,)])
+        else:
+            self._write("DELETE FROM applied_rules "
+                        "WHERE dvs_uuid = ? AND port_key = ?",
+                        [(dvs_uuid, port_key) for port_key in port_keys])
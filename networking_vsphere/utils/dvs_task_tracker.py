@@ -0,0 +1,250 @@
+# Copyright 2015 Mirantis, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from oslo_log import log
+from oslo_vmware import exceptions as vmware_exceptions
+from oslo_vmware import vim_util as vutil
+
+from networking_vsphere._i18n import _LE, _LW
+from networking_vsphere.utils import common_util
+from networking_vsphere.utils import vim_util
+
+LOG = log.getLogger(__name__)
+
+# Seconds a WaitForUpdatesEx call may block, below the http socket timeout.
+MAX_WAIT_SECONDS = 60
+RETRY_INTERVAL = 5
+# Seconds to wait for the update stream before polling the task instead.
+RESULT_TIMEOUT = 300
+
+
+class TaskFuture(object):
+    """Outcome of a vCenter task tracked by TaskTracker."""
+
+    def __init__(self, task):
+        self.task = task
+        self._done = threading.Event()
+        self._task_info = None
+        self._error = None
+
+    def set_result(self, task_info):
+        self._task_info = task_info
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Block until the task is done.
+
+        Returns the info of the task, like VMwareAPISession.wait_for_task,
+        and raises the translated fault of a failed task. Raises
+        VimException if the task is not done within timeout seconds.
+        """
+        if not self._done.wait(timeout):
+            raise vmware_exceptions.VimException(
+                "Timed out waiting for task %s." % self.task.value)
+        if self._error is not None:
+            raise self._error
+        return self._task_info
+
+
+class TaskTracker(object):
+    """Tracks the state of many vCenter tasks with one update stream.
+
+    Submitted tasks are watched by a single property collector, one
+    property filter per task, and completed from one WaitForUpdatesEx loop
+    instead of a polling loop per task.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+        # task value -> [future, property filter]
+        self._tasks = {}
+        self._pending = threading.Event()
+        self._collector = None
+
+    def start(self):
+        watcher = threading.Thread(target=self._watch_tasks,
+                                   name='dvs-task-tracker')
+        watcher.daemon = True
+        watcher.start()
+
+    def submit(self, task):
+        """Track the task, returns its TaskFuture."""
+        future = TaskFuture(task)
+        with self._lock:
+            self._tasks[task.value] = [future, None]
+            collector = self._collector
+            self._pending.set()
+        if collector is not None:
+            try:
+                property_filter = self._create_filter(task, collector)
+            except Exception:
+                with self._lock:
+                    # A new collector watches the task already.
+                    if self._collector is collector:
+                        self._forget(task.value)
+                        raise
+            else:
+                self._set_filter(task.value, collector, property_filter)
+        return future
+
+    def wait_for_task(self, task):
+        """Wait for the task through the update stream.
+
+        Falls back to polling the task if the update stream does not
+        complete it within RESULT_TIMEOUT seconds.
+        """
+        future = self.submit(task)
+        try:
+            return future.result(RESULT_TIMEOUT)
+        except vmware_exceptions.VimException:
+            if future.done():
+                raise
+        LOG.warning(_LW("No update received for task %s, polling it."),
+                    task.value)
+        with self._lock:
+            _future, property_filter = self._forget(task.value)
+        self._destroy_filter(task.value, property_filter)
+        return self.connection.wait_for_task(task)
+
+    def _create_filter(self, task, collector):
+        client_factory = self.connection.vim.client.factory
+        object_spec = vutil.build_object_spec(client_factory, task, [])
+        property_spec = vutil.build_property_spec(
+            client_factory, type_='Task', properties_to_collect=['info'])
+        filter_spec = vutil.build_property_filter_spec(
+            client_factory, [property_spec], [object_spec])
+        return self.connection.invoke_api(
+            vim_util, 'create_filter', self.connection.vim, filter_spec,
+            collector)
+
+    def _set_filter(self, task_value, collector, property_filter):
+        """Record the filter created for a task outside of _lock.
+
+        The filter is destroyed if the task completed meanwhile, and
+        dropped if the collector was replaced.
+        """
+        with self._lock:
+            if self._collector is not collector:
+                return
+            entry = self._tasks.get(task_value)
+            if entry is not None:
+                entry[1] = property_filter
+                return
+        self._destroy_filter(task_value, property_filter)
+
+    def _destroy_filter(self, task_value, property_filter):
+        if property_filter is None:
+            return
+        try:
+            self.connection.invoke_api(
+                self.connection.vim, 'DestroyPropertyFilter',
+                property_filter)
+        except Exception:
+            LOG.debug("Unable to destroy property filter of task %s.",
+                      task_value)
+
+    def _forget(self, task_value):
+        """Stop tracking a task, must be called with _lock held.
+
+        Returns the future and property filter of the task.
+        """
+        future, property_filter = self._tasks.pop(task_value, [None, None])
+        if not self._tasks:
+            self._pending.clear()
+        return future, property_filter
+
+    def _reset_collector(self):
+        with self._lock:
+            collector, self._collector = self._collector, None
+        if collector is not None:
+            try:
+                self.connection.invoke_api(
+                    vim_util, 'destroy_property_collector',
+                    self.connection.vim, collector)
+            except Exception:
+                LOG.debug("Unable to destroy property collector.")
+        collector = self.connection.invoke_api(
+            vim_util, 'create_property_collector', self.connection.vim)
+        with self._lock:
+            self._collector = collector
+            tasks = [future.task for future, _filter in self._tasks.values()]
+        # Filters of the previous collector are gone with it. Tasks
+        # submitted from now on create their own filter.
+        for task in tasks:
+            try:
+                property_filter = self._create_filter(task, collector)
+            except vmware_exceptions.ManagedObjectNotFoundException as e:
+                # The task is gone, it will never be reported.
+                with self._lock:
+                    future, _filter = self._forget(task.value)
+                if future is not None:
+                    future.set_error(e)
+                continue
+            self._set_filter(task.value, collector, property_filter)
+
+    def _complete(self, task_value, task_info):
+        with self._lock:
+            future, property_filter = self._forget(task_value)
+        if future is None:
+            return
+        self._destroy_filter(task_value, property_filter)
+        if task_info.state == 'success':
+            future.set_result(task_info)
+        else:
+            future.set_error(vmware_exceptions.translate_fault(
+                task_info.error))
+
+    def _process_update_set(self, update_set):
+        for filter_update in update_set.filterSet or []:
+            for object_update in filter_update.objectSet or []:
+                task_info = common_util.convert_objectupdate_to_dict(
+                    object_update).get('info')
+                if (task_info is not None and
+                        task_info.state in ('success', 'error')):
+                    self._complete(object_update.obj.value, task_info)
+
+    def _watch_tasks(self):
+        version = ""
+        reset = True
+        while True:
+            self._pending.wait()
+            try:
+                if reset:
+                    self._reset_collector()
+                    version = ""
+                    reset = False
+                update_set = self.connection.invoke_api(
+                    vim_util, 'wait_for_updates_ex', self.connection.vim,
+                    version, collector=self._collector,
+                    max_wait=MAX_WAIT_SECONDS)
+                if update_set:
+                    version = update_set.version
+                    self._process_update_set(update_set)
+            except Exception:
+                LOG.exception(_LE("Unable to process vCenter task updates, "
+                                  "tracking the tasks again."))
+                reset = True
+                time.sleep(RETRY_INTERVAL)
@@ -14,6 +14,8 @@
 #    under the License.
 
 import six
+import threading
+import time
 from time import sleep
 import uuid
 
@@ -27,7 +29,12 @@ from networking_vsphere._i18n import _LI, _LW, _LE
 from networking_vsphere.common import constants as dvs_const
 from networking_vsphere.common import exceptions
 from networking_vsphere.common import vmware_conf as config
+from networking_vsphere.utils import common_util
+from networking_vsphere.utils import dvs_port_index
+from networking_vsphere.utils import dvs_port_monitor
+from networking_vsphere.utils import dvs_task_tracker
 from networking_vsphere.utils import spec_builder
+from networking_vsphere.utils import vim_util as vsphere_vim_util
 
 
 CONF = config.CONF
@@ -39,6 +46,22 @@ UPDATING_PG_STATUS = 'updating'
 REMOVING_PG_STATUS = 'removing'
 
 MAX_OBJECTS_COUNT_TO_RETURN = 100
+PG_PROPERTIES = ['name', 'key', 'config.configVersion', 'config.numPorts',
+                 'config.defaultPortConfig.vlan']
+
+BOOK_PORT_RETRIES = 4
+# Seconds a bind request waits for the batch it was collected in.
+BOOK_PORT_TIMEOUT = 600
+
+
+class PortBooking(object):
+    """Bind request waiting to be booked together with others."""
+
+    def __init__(self, port_name):
+        self.port_name = port_name
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
 
 class DVSController(object):
@@ -48,15 +71,135 @@ class DVSController(object):
         self.connection = connection
         self.dvs_name = dvs_name
         self._blocked_ports = set()
+        # Bind requests collected per port group key, booked by the first
+        # request of the batch once the batch window is over.
+        self._pending_bookings = {}
+        self._bookings_lock = threading.Lock()
         self.builder = spec_builder.SpecBuilder(
             self.connection.vim.client.factory)
         self.uplink_map = {}
+        self._port_index = None
+        self._port_monitor = None
+        self.routing_table = None
+        self.task_tracker = None
+        # port key -> (neutron port id, fingerprint of the applied rules)
+        self._applied_rules = {}
+        # neutron port id -> port key its rules were applied to, and port
+        # key -> configVersion of the port with its rules applied, None
+        # until it is read again.
+        self._applied_keys = {}
+        self._applied_versions = {}
+        self.state_store = None
         try:
             self._dvs, self._dvs_uuid, self._inventory = \
                 self._get_dvs(dvs_name, cluster_name, connection)
         except vmware_exceptions.VimException as e:
             raise exceptions.wrap_wmvare_vim_exception(e)
 
+    def start_port_index(self):
+        """Look ports up in a local index instead of fetching them."""
+        try:
+            port_index = dvs_port_index.DVSPortIndex(
+                self.connection, self._dvs, self.builder)
+            port_index.start()
+        except vmware_exceptions.VimException as e:
+            raise exceptions.wrap_wmvare_vim_exception(e)
+        self._port_index = port_index
+
+    def start_port_monitor(self, callback):
+        """Report ports connected to and disconnected from the DVS."""
+        port_monitor = dvs_port_monitor.DVSPortMonitor(
+            self.connection, self._dvs, self.builder, callback)
+        port_monitor.start()
+        self._port_monitor = port_monitor
+
+    def _wait_for_task(self, task):
+        if self.task_tracker:
+            return self.task_tracker.wait_for_task(task)
+        return self.connection.wait_for_task(task)
+
+    def _invalidate_port(self, port_key, name=None):
+        if self._port_index:
+            self._port_index.invalidate(port_key, name)
+        # Changed by this controller, not by someone else.
+        if port_key in self._applied_versions:
+            self._applied_versions[port_key] = None
+
+    def get_applied_rules(self, port_key):
+        """Return (port id, rules fingerprint) last applied to the port."""
+        return self._applied_rules.get(port_key)
+
+    def rules_applied(self, port_key, port_id, fingerprint):
+        """Whether the rules were applied to the port and are still there.
+
+        With the port index, the port must also have kept the configVersion
+        it had once the rules were applied, so that a port reconfigured by
+        someone else gets its rules again once the index is resynced.
+        """
+        if self._applied_rules.get(port_key) != (port_id, fingerprint):
+            return False
+        if not self._port_index:
+            return True
+        port_info = self._port_index.get_by_key(port_key)
+        if port_info is None:
+            return False
+        version = getattr(port_info.config, 'configVersion', None)
+        if self._applied_versions.get(port_key) is None:
+            self._applied_versions[port_key] = version
+        return self._applied_versions[port_key] == version
+
+    def set_applied_rules(self, applied):
+        """Record the rules applied, (port id, fingerprint) by port key."""
+        # The previous port key of the ports which moved.
+        moved = []
+        for port_key, (port_id, _fingerprint) in applied.items():
+            old_key = self._applied_keys.get(port_id)
+            if (old_key not in (None, port_key) and
+                    self._applied_rules.get(old_key, (None,))[0] == port_id):
+                moved.append(old_key)
+        if moved:
+            self.forget_applied_rules(moved)
+        self._applied_rules.update(applied)
+        for port_key, (port_id, _fingerprint) in applied.items():
+            self._applied_keys[port_id] = port_key
+            self._applied_versions[port_key] = None
+            if self._port_index:
+                self._port_index.invalidate(port_key)
+        if self.state_store:
+            self.state_store.set_applied_rules(self._dvs_uuid, applied)
+
+    def forget_applied_rules(self, port_keys=None):
+        """Reapply the rules of the ports, or of all ports, on next update."""
+        if port_keys is None:
+            self._applied_rules.clear()
+            self._applied_keys.clear()
+            self._applied_versions.clear()
+        else:
+            forgotten = []
+            for port_key in port_keys:
+                self._applied_versions.pop(port_key, None)
+                port_id, _fingerprint = self._applied_rules.pop(
+                    port_key, (None, None))
+                if port_id is None:
+                    continue
+                if self._applied_keys.get(port_id) == port_key:
+                    del self._applied_keys[port_id]
+                forgotten.append(port_key)
+            port_keys = forgotten
+            if not port_keys:
+                return
+        if self.state_store:
+            self.state_store.forget_applied_rules(self._dvs_uuid, port_keys)
+
+    def load_applied_rules(self, state_store):
+        """Keep the applied rules in the store, starting from its ones."""
+        self._applied_rules = state_store.get_applied_rules(self._dvs_uuid)
+        self._applied_keys = dict(
+            (port_id, port_key) for port_key, (port_id, _fingerprint)
+            in self._applied_rules.items())
+        self._applied_versions = {}
+        self.state_store = state_store
+
     def load_uplinks(self, phys, uplinks):
         self.uplink_map[phys] = uplinks
 
@@ -69,6 +212,16 @@ class DVSController(object):
                                        self._dvs, criteria=criteria))
         return key not in connected_port_keys
 
+    def get_connected_port_keys(self, port_keys):
+        """Return which of the given ports are connected, in one call."""
+        if not port_keys:
+            return set()
+        criteria = self.builder.port_criteria(port_key=list(port_keys))
+        criteria.connected = True
+        return set(self.connection.invoke_api(
+            self.connection.vim, 'FetchDVPortKeys',
+            self._dvs, criteria=criteria))
+
     def create_network(self, network, segment):
         name = self._get_net_name(network)
         blocked = not network['admin_state_up']
@@ -81,13 +234,15 @@ class DVSController(object):
                 'CreateDVPortgroup_Task',
                 self._dvs, spec=pg_spec)
 
-            result = self.connection.wait_for_task(pg_create_task)
+            result = self._wait_for_task(pg_create_task)
         except vmware_exceptions.VimException as e:
             raise exceptions.wrap_wmvare_vim_exception(e)
         else:
             pg = result.result
             LOG.info(_LI('Network %(name)s created \n%(pg_ref)s'),
                      {'name': name, 'pg_ref': pg})
+            if self.routing_table:
+                self.routing_table.add_port_group(self, name)
             return pg
 
     def update_network(self, network, original=None):
@@ -111,7 +266,7 @@ class DVSController(object):
                     'ReconfigureDVPortgroup_Task',
                     pg_ref, spec=pg_spec)
 
-                self.connection.wait_for_task(pg_update_task)
+                self._wait_for_task(pg_update_task)
                 LOG.info(_LI('Network %(name)s updated'),
                          {'name': current_name})
         except vmware_exceptions.VimException as e:
@@ -128,13 +283,13 @@ class DVSController(object):
         self._delete_port_group(pg_ref, name)
 
     def delete_networks_without_active_ports(self, pg_keys_with_active_ports):
-        for pg_ref in self._get_all_port_groups():
-            if pg_ref.value not in pg_keys_with_active_ports:
+        for pg_props in self._get_port_groups_properties(
+                self._get_all_port_groups()):
+            pg_ref = pg_props['item']
+            if pg_props['pg_key'] not in pg_keys_with_active_ports:
                 # check name
                 try:
-                    name = self.connection.invoke_api(
-                        vim_util, 'get_object_property',
-                        self.connection.vim, pg_ref, 'name')
+                    name = pg_props['name']
                     name_tokens = name.split(self.dvs_name)
                     if (len(name_tokens) == 2 and not name_tokens[0] and
                             self._valid_uuid(name_tokens[1])):
@@ -151,8 +306,10 @@ class DVSController(object):
                     self.connection.vim,
                     'Destroy_Task',
                     pg_ref)
-                self.connection.wait_for_task(pg_delete_task)
+                self._wait_for_task(pg_delete_task)
                 LOG.info(_LI('Network %(name)s deleted.'), {'name': name})
+                if self.routing_table:
+                    self.routing_table.remove_port_group(self, name)
                 break
             except vmware_exceptions.VimException as e:
                 if dvs_const.RESOURCE_IN_USE in e.message:
@@ -184,54 +341,138 @@ class DVSController(object):
             update_task = self.connection.invoke_api(
                 self.connection.vim, 'ReconfigureDVPort_Task',
                 self._dvs, port=[update_spec])
-            self.connection.wait_for_task(update_task)
+            self._wait_for_task(update_task)
+            self._invalidate_port(port_info.key)
         except exceptions.PortNotFound:
             LOG.debug("Port %s was not found. Nothing to block.", port['id'])
         except vmware_exceptions.VimException as e:
             raise exceptions.wrap_wmvare_vim_exception(e)
 
     def _lookup_unbound_port_or_increase_pg(self, pg):
+        return self._lookup_unbound_ports_or_increase_pg(pg, 1)[0]
+
+    def _lookup_unbound_ports_or_increase_pg(self, pg, count):
+        port_infos = []
         while True:
-            try:
-                port_info = self._lookup_unbound_port(pg)
+            port_infos.extend(
+                self._lookup_unbound_ports(pg, count - len(port_infos)))
+            if len(port_infos) >= count:
                 break
-            except exceptions.UnboundPortNotFound:
-                try:
-                    self._increase_ports_on_portgroup(pg)
-                except (vmware_exceptions.VMwareDriverException,
-                        exceptions.VMWareDVSException) as e:
-                    if dvs_const.CONCURRENT_MODIFICATION_TEXT in e.message:
-                        LOG.info(_LI('Concurrent modification on '
-                                     'increase port group.'))
-                        continue
-                    raise e
-        return port_info
+            try:
+                self._increase_ports_on_portgroup(
+                    pg, count - len(port_infos))
+            except (vmware_exceptions.VMwareDriverException,
+                    exceptions.VMWareDVSException) as e:
+                if dvs_const.CONCURRENT_MODIFICATION_TEXT in e.message:
+                    LOG.info(_LI('Concurrent modification on '
+                                 'increase port group.'))
+                    continue
+                raise e
+        return port_infos
 
     def book_port(self, network, port_name, segment, net_name=None):
         try:
             if not net_name:
                 net_name = self._get_net_name(network)
             pg = self._get_or_create_pg(net_name, network, segment)
-            for iter in range(0, 4):
+        except vmware_exceptions.VimException as e:
+            raise exceptions.wrap_wmvare_vim_exception(e)
+        if CONF.DVS.book_port_batch_window <= 0:
+            return self._book_ports(pg, [port_name])[0]
+        return self._book_port_in_batch(pg, port_name)
+
+    def _book_port_in_batch(self, pg, port_name):
+        """Book a port together with the other requests of the window.
+
+        The first request for a port group waits for the batch window and
+        books the ports of all requests collected meanwhile, every request
+        gets its own result or error back.
+        """
+        booking = PortBooking(port_name)
+        with self._bookings_lock:
+            bookings = self._pending_bookings.setdefault(pg.value, [])
+            bookings.append(booking)
+            first = len(bookings) == 1
+        if first:
+            bookings = None
+            try:
+                sleep(CONF.DVS.book_port_batch_window)
+                with self._bookings_lock:
+                    bookings = self._pending_bookings.pop(pg.value)
+                self._book_port_batch(pg, bookings)
+            finally:
+                if bookings is None:
+                    with self._bookings_lock:
+                        bookings = self._pending_bookings.pop(pg.value, [])
+                # Nobody else would wake the requests of the batch up.
+                for pending in bookings:
+                    if not pending.done.is_set():
+                        pending.error = exceptions.PortBookingFailed(
+                            port_name=pending.port_name,
+                            reason='the batch was aborted')
+                        pending.done.set()
+        if not booking.done.wait(BOOK_PORT_TIMEOUT):
+            raise exceptions.PortBookingFailed(port_name=port_name,
+                                               reason='timed out')
+        if booking.error is not None:
+            raise booking.error
+        return booking.result
+
+    def _book_port_batch(self, pg, bookings):
+        batch_size = max(CONF.DVS.book_port_batch_size, 1)
+        for i in range(0, len(bookings), batch_size):
+            batch = bookings[i:i + batch_size]
+            try:
+                results = self._book_ports(
+                    pg, [booking.port_name for booking in batch])
+            except Exception as e:
+                for booking in batch:
+                    booking.error = e
+            else:
+                for booking, result in zip(batch, results):
+                    booking.result = result
+            LOG.debug("Booked %(count)s ports on port group %(pg_key)s.",
+                      {'count': len(batch), 'pg_key': pg.value})
+            for booking in batch:
+                booking.done.set()
+
+    def _book_ports(self, pg, port_names):
+        """Book a free port of the port group for every port name.
+
+        The ports are reserved with a single reconfigure task.
+        """
+        try:
+            for iter in range(0, BOOK_PORT_RETRIES):
+                port_infos = []
                 try:
-                    port_info = self._lookup_unbound_port_or_increase_pg(pg)
-
-                    port_settings = self.builder.port_setting()
-                    port_settings.blocked = self.builder.blocked(False)
-                    update_spec = self.builder.port_config_spec(
-                        port_info.config.configVersion, port_settings,
-                        name=port_name)
-                    update_spec.key = port_info.key
+                    port_infos = self._lookup_unbound_ports_or_increase_pg(
+                        pg, len(port_names))
+                    update_specs = []
+                    for port_info, port_name in zip(port_infos, port_names):
+                        port_settings = self.builder.port_setting()
+                        port_settings.blocked = self.builder.blocked(False)
+                        update_spec = self.builder.port_config_spec(
+                            port_info.config.configVersion, port_settings,
+                            name=port_name)
+                        update_spec.key = port_info.key
+                        update_specs.append(update_spec)
                     update_task = self.connection.invoke_api(
                         self.connection.vim, 'ReconfigureDVPort_Task',
-                        self._dvs, port=[update_spec])
-                    self.connection.wait_for_task(update_task)
-                    return {'key': port_info.key,
-                            'dvs_uuid': self._dvs_uuid,
-                            'pg_key': pg.value}
+                        self._dvs, port=update_specs)
+                    self._wait_for_task(update_task)
+                    for port_info, port_name in zip(port_infos, port_names):
+                        self._invalidate_port(port_info.key, port_name)
+                    return [{'key': port_info.key,
+                             'dvs_uuid': self._dvs_uuid,
+                             'pg_key': pg.value}
+                            for port_info in port_infos]
                 except vmware_exceptions.VimException as e:
+                    error = e
+                    # Ports of a failed batch are unbound, they may be
+                    # booked by the next attempt.
+                    self._return_unbound_ports(pg, port_infos)
                     sleep(0.1)
-            raise exceptions.wrap_wmvare_vim_exception(e)
+            raise exceptions.wrap_wmvare_vim_exception(error)
         except vmware_exceptions.VimException as e:
             raise exceptions.wrap_wmvare_vim_exception(e)
 
@@ -246,6 +487,9 @@ class DVSController(object):
                 self.connection.vim, 'ReconfigureDVPort_Task',
                 self._dvs, port=[update_spec])
             self.remove_block(port_info.key)
+            self.forget_applied_rules([port_info.key])
+            if self._port_index:
+                self._port_index.remove(port_info.key)
         except exceptions.PortNotFound:
             LOG.debug("Port %s was not found. Nothing to delete.", port['id'])
         except vmware_exceptions.VimException as e:
@@ -254,9 +498,73 @@ class DVSController(object):
             else:
                 raise exceptions.wrap_wmvare_vim_exception(e)
 
+    def release_ports(self, ports):
+        """Release the ports of many neutron ports with one task.
+
+        Falls back to release_port for each port when the task fails
+        because one of the ports is in use.
+        """
+        ports_by_key = {}
+        released = []
+        for port in ports:
+            key = port.get('binding:vif_details', {}).get('dvs_port_key')
+            if key is not None:
+                ports_by_key[key] = port
+                continue
+            try:
+                released.append((port, self.get_port_info(port)))
+            except exceptions.PortNotFound:
+                LOG.debug("Port %s was not found. Nothing to delete.",
+                          port['id'])
+        try:
+            if ports_by_key:
+                for port_info in self._get_port_infos_by_portkeys(
+                        list(ports_by_key)):
+                    released.append((ports_by_key[port_info.key], port_info))
+            if not released:
+                return
+            update_specs = []
+            for port, port_info in released:
+                update_spec = self.builder.port_config_spec(
+                    port_info.config.configVersion, name='')
+                update_spec.key = port_info.key
+                update_spec.operation = 'remove'
+                update_specs.append(update_spec)
+            update_task = self.connection.invoke_api(
+                self.connection.vim, 'ReconfigureDVPort_Task',
+                self._dvs, port=update_specs)
+            self._wait_for_task(update_task)
+        except vmware_exceptions.VimException as e:
+            if dvs_const.RESOURCE_IN_USE not in e.message:
+                raise exceptions.wrap_wmvare_vim_exception(e)
+            self._release_ports_one_by_one(released)
+            return
+        except vmware_exceptions.VMwareDriverException as e:
+            # Faults of the task, like ResourceInUse.
+            if dvs_const.RESOURCE_IN_USE not in e.msg:
+                raise
+            self._release_ports_one_by_one(released)
+            return
+        for port, port_info in released:
+            self.remove_block(port_info.key)
+            self.forget_applied_rules([port_info.key])
+            if self._port_index:
+                self._port_index.remove(port_info.key)
+
+    def _release_ports_one_by_one(self, released):
+        LOG.debug("Ports %s could not be released together, releasing "
+                  "them one by one.", [port['id'] for port, _ in released])
+        for port, port_info in released:
+            self.release_port(port)
+
     def remove_block(self, port_key):
         self._blocked_ports.discard(port_key)
 
+    def _return_unbound_ports(self, pg, port_infos):
+        """Give back the ports of a failed booking."""
+        for port_info in port_infos:
+            self.remove_block(port_info.key)
+
     def _build_pg_create_spec(self, name, vlan_tag, blocked, uplinks):
         port_setting = self.builder.port_setting()
 
@@ -386,6 +694,36 @@ class DVSController(object):
         type_value = 'DistributedVirtualPortgroup'
         return self._get_object_by_type(net_list, type_value)
 
+    def _get_port_groups_properties(self, pg_refs):
+        """Get the properties of port groups with one paged retrieval.
+
+        Returns a list of dicts with item, name, pg_key, config_version,
+        num_ports and vlan_id of the port groups. Port groups removed in
+        the meantime are skipped.
+        """
+        if not pg_refs:
+            return []
+        obj_contents = self.connection.invoke_api(
+            vsphere_vim_util, 'get_properties_for_a_collection_of_objects',
+            self.connection.vim, 'DistributedVirtualPortgroup', pg_refs,
+            PG_PROPERTIES)
+        pg_props_list = []
+        for obj_content in obj_contents:
+            props = common_util.convert_propset_to_dict(
+                getattr(obj_content, 'propSet', None) or [])
+            if 'name' not in props:
+                continue
+            vlan = props.get('config.defaultPortConfig.vlan')
+            pg_props_list.append({
+                'item': obj_content.obj,
+                'name': props['name'],
+                'pg_key': props.get('key', obj_content.obj.value),
+                'config_version': props.get('config.configVersion'),
+                'num_ports': props.get('config.numPorts'),
+                'vlan_id': getattr(vlan, 'vlanId', None)
+            })
+        return pg_props_list
+
     def _get_or_create_pg(self, pg_name, network, segment):
         try:
             return self._get_pg_by_name(pg_name)
@@ -435,28 +773,52 @@ class DVSController(object):
         return list(all_port_keys - connected_port_keys - self._blocked_ports)
 
     def _lookup_unbound_port(self, port_group):
-        for port_key in self._get_free_pg_keys(port_group):
-            self._blocked_ports.add(port_key)
-            p_info = self._get_port_info_by_portkey(port_key)
-            if not getattr(p_info.config, 'name', None):
-                return p_info
-        raise exceptions.UnboundPortNotFound()
-
-    def _increase_ports_on_portgroup(self, port_group):
+        port_infos = self._lookup_unbound_ports(port_group, 1)
+        if not port_infos:
+            raise exceptions.UnboundPortNotFound()
+        return port_infos[0]
+
+    def _lookup_unbound_ports(self, port_group, count):
+        """Return up to count unbound ports of the port group."""
+        free_port_keys = self._get_free_pg_keys(port_group)
+        port_infos = []
+        while free_port_keys and len(port_infos) < count:
+            port_keys = free_port_keys[:count - len(port_infos)]
+            del free_port_keys[:len(port_keys)]
+            port_infos.extend(self._get_unbound_port_infos(port_keys))
+        return port_infos
+
+    def _get_unbound_port_infos(self, port_keys):
+        """Block the ports and return the ones without a name."""
+        self._blocked_ports.update(port_keys)
+        return [p_info for p_info in
+                self._get_port_infos_by_portkeys(port_keys)
+                if not getattr(p_info.config, 'name', None)]
+
+    def _increase_ports_on_portgroup(self, port_group, missing_ports=0):
         pg_info = self._get_config_by_ref(port_group)
         # TODO(ekosareva): need to have max size of ports number
-        ports_number = max(CONF.DVS.init_pg_ports_count, pg_info.numPorts * 2)
+        ports_number = max(CONF.DVS.init_pg_ports_count, pg_info.numPorts * 2,
+                           pg_info.numPorts + missing_ports)
         pg_spec = self._build_pg_update_spec(
             pg_info.configVersion, ports_number=ports_number)
         pg_update_task = self.connection.invoke_api(
             self.connection.vim,
             'ReconfigureDVPortgroup_Task',
             port_group, spec=pg_spec)
-        self.connection.wait_for_task(pg_update_task)
+        self._wait_for_task(pg_update_task)
+
+    def get_port_info(self, port, refresh=False):
+        """Return the DVS port of the neutron port.
 
-    def get_port_info(self, port):
+        :param refresh: fetch the DVS port again instead of taking it from
+                        the port index, which only learns of the changes
+                        made through other controllers on its next resync.
+        """
         key = port.get('binding:vif_details', {}).get('dvs_port_key')
         if key is not None:
+            if refresh and self._port_index:
+                self._port_index.invalidate(key)
             port_info = self._get_port_info_by_portkey(key)
         else:
             port_info = self._get_port_info_by_name(port['id'])
@@ -464,6 +826,11 @@ class DVSController(object):
 
     def _get_port_info_by_portkey(self, port_key):
         """pg - ManagedObjectReference of Port Group"""
+        if self._port_index:
+            port_info = self._port_index.get_by_key(port_key)
+            if port_info is None:
+                raise exceptions.PortNotFound(id=port_key)
+            return port_info
         criteria = self.builder.port_criteria(port_key=port_key)
         port_info = self.connection.invoke_api(
             self.connection.vim,
@@ -473,7 +840,24 @@ class DVSController(object):
             raise exceptions.PortNotFound(id=port_key)
         return port_info[0]
 
+    def _get_port_infos_by_portkeys(self, port_keys):
+        criteria = self.builder.port_criteria(port_key=port_keys)
+        return self.connection.invoke_api(
+            self.connection.vim,
+            'FetchDVPorts',
+            self._dvs, criteria=criteria) or []
+
     def _get_port_info_by_name(self, name, port_list=None):
+        if port_list is None and self._port_index:
+            port_info = self._port_index.get_by_name(name)
+            if port_info is None:
+                # The index only sees the renames made by other processes
+                # or controllers on its resync, fetch the switch again.
+                self._port_index.resync()
+                port_info = self._port_index.get_by_name(name)
+            if port_info is None:
+                raise exceptions.PortNotFound(id=name)
+            return port_info
         if port_list is None:
             port_list = self.get_ports(None)
         ports = [port for port in port_list if port.config.name == name]
@@ -496,6 +880,10 @@ class DVSController(object):
                 p_ret.append(port)
         return p_ret
 
+    def _get_port_group_names(self):
+        return [pg_props['name'] for pg_props in
+                self._get_port_groups_properties(self._get_all_port_groups())]
+
     def _get_ports_ids(self):
         return [port.config.name for port in self.get_ports()]
 
@@ -511,25 +899,127 @@ class DVSControllerWithCache(DVSController):
     def __init__(self, dvs_name, cluster_name, connection):
         super(DVSControllerWithCache, self).__init__(
             dvs_name, cluster_name, connection)
+        # Guards _pg_cache and is notified on every port group status
+        # transition.
+        self._pg_cache_lock = threading.Condition()
         self._init_pg_cache()
+        self._replenish_event = threading.Event()
+        if CONF.DVS.free_ports_low_water_mark > 0:
+            self._start_free_ports_replenisher()
+
+    def _start_free_ports_replenisher(self):
+        replenisher = threading.Thread(
+            target=self._free_ports_replenisher_loop,
+            name='free-ports-replenisher-%s' % self.dvs_name)
+        replenisher.daemon = True
+        replenisher.start()
+
+    def _free_ports_replenisher_loop(self):
+        while True:
+            self._replenish_event.wait(
+                CONF.DVS.free_ports_replenish_interval)
+            self._replenish_event.clear()
+            self._replenish_all_free_ports()
+
+    def _replenish_all_free_ports(self):
+        # Only port groups which had ports booked are kept warm.
+        for pg_name, pg_cache_item in list(six.iteritems(self._pg_cache)):
+            if (pg_cache_item.get('status') != READY_PG_STATUS or
+                    not pg_cache_item.get('item') or
+                    'free_port_infos' not in pg_cache_item):
+                continue
+            if (len(pg_cache_item['free_port_infos']) >=
+                    CONF.DVS.free_ports_low_water_mark):
+                continue
+            try:
+                self._replenish_free_ports(pg_name)
+            except Exception:
+                LOG.exception(_LE("Unable to replenish free ports of "
+                                  "network %s."), pg_name)
+
+    def _replenish_free_ports(self, pg_name):
+        """Fill the pool of verified unbound ports of a port group.
+
+        The port group is grown when it has not enough free ports left, so
+        that binds do not have to wait for it.
+        """
+        with self._pg_cache_lock:
+            pg_cache_item = self._pg_cache.get(pg_name)
+            if not pg_cache_item or 'free_port_infos' not in pg_cache_item:
+                return
+            port_group = pg_cache_item['item']
+            free_port_infos = pg_cache_item['free_port_infos']
+        missing = CONF.DVS.cache_free_ports_size - len(free_port_infos)
+        port_keys = self._get_free_pg_keys(port_group)[:missing]
+        if port_keys:
+            port_infos = self._get_unbound_port_infos(port_keys)
+            with self._pg_cache_lock:
+                free_port_infos.extend(port_infos)
+        if len(free_port_infos) < CONF.DVS.free_ports_low_water_mark:
+            self._increase_ports_on_portgroup(
+                port_group,
+                CONF.DVS.cache_free_ports_size - len(free_port_infos))
+            # Fill the pool from the new ports right away.
+            self._replenish_event.set()
+        LOG.debug("Network %(name)s has %(count)s free ports ready.",
+                  {'name': pg_name, 'count': len(free_port_infos)})
 
     def _init_pg_cache(self):
         self._pg_cache = {}
-        for pg in self._get_all_port_groups():
-            name = self.connection.invoke_api(
-                vim_util, 'get_object_property',
-                self.connection.vim, pg, 'name')
-            self._pg_cache[name] = {
-                'item': pg,
-                'status': READY_PG_STATUS,
-                'pg_key': pg.value
-            }
+        # pg_key -> name of the port groups in _pg_cache, only changed
+        # together with it.
+        self._pg_names_by_key = {}
+        start = time.time()
+        pg_props_list = self._get_port_groups_properties(
+            self._get_all_port_groups())
+        with self._pg_cache_lock:
+            for pg_props in pg_props_list:
+                pg_props = dict(pg_props)
+                self._set_pg_status(pg_props.pop('name'), READY_PG_STATUS,
+                                    **pg_props)
+        elapsed = time.time() - start
+        LOG.info(_LI("Loaded %(count)s networks of DVS %(dvs)s in "
+                     "%(time).2f seconds (%(rate).2f seconds per 1000 "
+                     "networks)."),
+                 {'count': len(pg_props_list), 'dvs': self.dvs_name,
+                  'time': elapsed,
+                  'rate': elapsed * 1000 / max(len(pg_props_list), 1)})
 
     def _wait_port_group_stable_status(self, pg_name,
                                        waiting_status_list=(READY_PG_STATUS,)):
+        """Block until the port group reaches one of the given statuses.
+
+        Must be called with _pg_cache_lock held, which is released while
+        waiting. Returns at once if the port group is not in the cache.
+        """
         while (pg_name in self._pg_cache and
                self._pg_cache[pg_name]['status'] not in waiting_status_list):
-            sleep(CONF.DVS.cache_pool_interval)
+            self._pg_cache_lock.wait()
+
+    def _set_pg_status(self, pg_name, status, **fields):
+        """Must be called with _pg_cache_lock held."""
+        pg_cache_item = self._pg_cache.setdefault(pg_name, {})
+        if 'pg_key' in fields:
+            self._unindex_pg(pg_name, pg_cache_item.get('pg_key'))
+            if fields['pg_key'] is not None:
+                self._pg_names_by_key[fields['pg_key']] = pg_name
+        pg_cache_item.update(status=status, **fields)
+        self._pg_cache_lock.notify_all()
+
+    def _pop_pg(self, pg_name):
+        """Must be called with _pg_cache_lock held."""
+        pg_cache_item = self._pg_cache.pop(pg_name, None)
+        if pg_cache_item is not None:
+            self._unindex_pg(pg_name, pg_cache_item.get('pg_key'))
+        self._pg_cache_lock.notify_all()
+        return pg_cache_item
+
+    def _unindex_pg(self, pg_name, pg_key):
+        if self._pg_names_by_key.get(pg_key) == pg_name:
+            del self._pg_names_by_key[pg_key]
+
+    def _get_pg_name_by_key(self, pg_key):
+        return self._pg_names_by_key.get(pg_key)
 
     def _create_missed_pg_by_ref(self, pg_ref):
         pg_info = self._get_config_by_ref(pg_ref)
@@ -542,119 +1032,206 @@ class DVSControllerWithCache(DVSController):
 
     def create_network(self, network, segment):
         name = self._get_net_name(network)
-        self._wait_port_group_stable_status(
-            name, (READY_PG_STATUS, UPDATING_PG_STATUS))
-        if name in self._pg_cache and self._pg_cache[name]['item']:
-            return self._pg_cache[name]['item']
-
-        self._pg_cache.setdefault(name, {}).update({
-            'item': None,
-            'status': CREATING_PG_STATUS,
-            'pg_key': None
-        })
+        with self._pg_cache_lock:
+            # A port group being created by another request is returned
+            # once its creation task is done.
+            self._wait_port_group_stable_status(
+                name, (READY_PG_STATUS, UPDATING_PG_STATUS))
+            if name in self._pg_cache and self._pg_cache[name]['item']:
+                return self._pg_cache[name]['item']
+            self._set_pg_status(name, CREATING_PG_STATUS,
+                                item=None, pg_key=None)
         try:
-            pg = super(DVSControllerWithCache, self).create_network(
-                network, segment)
-        except exceptions.VMWareDVSException as e:
-            if dvs_const.DUPLICATE_NAME in str(e):
+            try:
+                pg = super(DVSControllerWithCache, self).create_network(
+                    network, segment)
+            except exceptions.VMWareDVSException as e:
+                if dvs_const.DUPLICATE_NAME not in str(e):
+                    raise
                 pg = super(DVSControllerWithCache, self)._get_pg_by_name(name)
-            else:
-                self._pg_cache.pop(name)
-                raise e
-        self._pg_cache[name].update({
-            'item': pg,
-            'status': READY_PG_STATUS,
-            'pg_key': pg.value
-        })
+        except Exception:
+            # Wake up the waiters, they try to create the port group again.
+            with self._pg_cache_lock:
+                self._pop_pg(name)
+            raise
+        with self._pg_cache_lock:
+            self._set_pg_status(name, READY_PG_STATUS,
+                                item=pg, pg_key=pg.value)
         return pg
 
     def _delete_port_group(self, pg_ref, name):
-        self._wait_port_group_stable_status(name)
-        if name not in self._pg_cache:
-            LOG.info(_LI('Network %(name)s has been already deleted. '
-                         'Nothing to do.'), {'name': name})
-            return
-
-        self._pg_cache[name].update({'status': REMOVING_PG_STATUS})
+        with self._pg_cache_lock:
+            self._wait_port_group_stable_status(name)
+            if name not in self._pg_cache:
+                LOG.info(_LI('Network %(name)s has been already deleted. '
+                             'Nothing to do.'), {'name': name})
+                return
+            self._set_pg_status(name, REMOVING_PG_STATUS)
         try:
             super(DVSControllerWithCache, self).\
                 _delete_port_group(pg_ref, name)
         except Exception as e:
             if dvs_const.DELETED_TEXT not in str(e):
-                self._pg_cache[name].update({'status': READY_PG_STATUS})
+                with self._pg_cache_lock:
+                    self._set_pg_status(name, READY_PG_STATUS)
                 raise e
-        self._pg_cache.pop(name, None)
+        with self._pg_cache_lock:
+            pg_cache_item = self._pop_pg(name) or {}
+        for port_info in pg_cache_item.get('free_port_infos', []):
+            self.remove_block(port_info.key)
 
-    def _get_pg_by_name(self, pg_name):
-        if pg_name not in self._pg_cache:
-            # if pg not in cache, try to find port group on vsphere
-            pg = super(DVSControllerWithCache, self)._get_pg_by_name(pg_name)
-            self._pg_cache.setdefault(pg_name, {}).update({
-                'item': pg,
-                'status': READY_PG_STATUS,
-                'pg_key': pg.value
-            })
-            return pg
-        if self._pg_cache.get(pg_name, {}).get('status') in (
-                READY_PG_STATUS, UPDATING_PG_STATUS, REMOVING_PG_STATUS):
-            return self._pg_cache[pg_name]['item']
-        raise exceptions.PortGroupNotFound(pg_name=pg_name)
+    def _get_port_group_names(self):
+        with self._pg_cache_lock:
+            return list(self._pg_cache)
 
-    def _increase_ports_on_portgroup(self, port_group):
-        pg_name = next((name for name, pg in six.iteritems(self._pg_cache)
-                        if pg.get('pg_key') == port_group.value), None)
-        prev_status = self._pg_cache.get(pg_name, {}).get('status')
-        self._wait_port_group_stable_status(pg_name)
-        if prev_status == UPDATING_PG_STATUS:
-            return
+    def _get_pg_by_name(self, pg_name):
+        with self._pg_cache_lock:
+            pg_cache_item = self._pg_cache.get(pg_name)
+            if pg_cache_item is not None:
+                if pg_cache_item.get('status') in (
+                        READY_PG_STATUS, UPDATING_PG_STATUS,
+                        REMOVING_PG_STATUS):
+                    return pg_cache_item['item']
+                raise exceptions.PortGroupNotFound(pg_name=pg_name)
+        # if pg not in cache, try to find port group on vsphere
+        pg = super(DVSControllerWithCache, self)._get_pg_by_name(pg_name)
+        with self._pg_cache_lock:
+            if pg_name not in self._pg_cache:
+                self._set_pg_status(pg_name, READY_PG_STATUS,
+                                    item=pg, pg_key=pg.value)
+        return pg
 
-        if pg_name not in self._pg_cache:
+    def _increase_ports_on_portgroup(self, port_group, missing_ports=0):
+        with self._pg_cache_lock:
+            pg_name = self._get_pg_name_by_key(port_group.value)
+            prev_status = self._pg_cache.get(pg_name, {}).get('status')
+            self._wait_port_group_stable_status(pg_name)
+            # Callers arriving while the port group grows share the
+            # running reconfigure task instead of starting another one.
+            if prev_status == UPDATING_PG_STATUS:
+                return
+            missed = pg_name not in self._pg_cache
+
+        if missed:
             self._create_missed_pg_by_ref(port_group)
 
-        self._pg_cache[pg_name].update({'status': UPDATING_PG_STATUS})
+        with self._pg_cache_lock:
+            self._wait_port_group_stable_status(pg_name)
+            if self._pg_cache[pg_name]['status'] == UPDATING_PG_STATUS:
+                return
+            self._set_pg_status(pg_name, UPDATING_PG_STATUS)
         try:
             super(DVSControllerWithCache, self).\
-                _increase_ports_on_portgroup(port_group)
+                _increase_ports_on_portgroup(port_group, missing_ports)
         finally:
-            self._pg_cache[pg_name].update({'status': READY_PG_STATUS})
+            with self._pg_cache_lock:
+                self._set_pg_status(pg_name, READY_PG_STATUS)
 
     def _refill_free_cached_ports(self, pg_name, port_group):
-        free_port_keys = self._get_free_pg_keys(port_group)
-        self._pg_cache[pg_name].update({
-            'free_ports_count': len(free_port_keys),
-            'free_cached_ports':
-                free_port_keys[:CONF.DVS.cache_free_ports_size]
-        })
-
-    def _lookup_unbound_port(self, port_group):
-        pg_name = next((name for name, pg in six.iteritems(self._pg_cache)
-                        if pg.get('pg_key') == port_group.value), None)
-        self._wait_port_group_stable_status(pg_name)
+        """Cache the free port keys of a port group.
 
-        if pg_name not in self._pg_cache:
-            self._create_missed_pg_by_ref(port_group)
+        Returns False if the port group left the cache meanwhile.
+        """
+        free_port_keys = self._get_free_pg_keys(port_group)
+        with self._pg_cache_lock:
+            pg_cache_item = self._pg_cache.get(pg_name)
+            if pg_cache_item is None:
+                return False
+            pg_cache_item.update({
+                'free_ports_count': len(free_port_keys),
+                'free_cached_ports':
+                    free_port_keys[:CONF.DVS.cache_free_ports_size]
+            })
+        return True
 
-        if not self._pg_cache[pg_name].get('free_cached_ports'):
-            self._refill_free_cached_ports(pg_name, port_group)
-
-        while self._pg_cache[pg_name]['free_ports_count'] > 0:
-            pg_cache_item = self._pg_cache[pg_name].get('free_cached_ports')
-            while pg_cache_item:
-                port_key = pg_cache_item.pop()
-                self._pg_cache[pg_name]['free_ports_count'] -= 1
-                if port_key not in self._blocked_ports:
-                    self._blocked_ports.add(port_key)
-                    p_info = self._get_port_info_by_portkey(port_key)
-                    if not getattr(p_info.config, 'name', None):
-                        return p_info
+    def _lookup_unbound_ports(self, port_group, count):
+        pg_name = self._get_pg_name_by_key(port_group.value)
+        # Ports verified by the replenisher are already blocked, they are
+        # handed out without a lookup of the free ports, even while the
+        # port group grows.
+        with self._pg_cache_lock:
+            free_port_infos = self._pg_cache.get(pg_name, {}).get(
+                'free_port_infos', [])
+            port_infos = []
+            while free_port_infos and len(port_infos) < count:
+                port_infos.append(free_port_infos.pop())
+        if port_infos:
+            # They are read again by key, their configVersion may have
+            # changed since they were verified, and another agent may have
+            # booked them meanwhile.
+            port_infos = self._get_unbound_port_infos(
+                [port_info.key for port_info in port_infos])
+        if len(port_infos) < count:
+            with self._pg_cache_lock:
+                self._wait_port_group_stable_status(pg_name)
+                missed = pg_name not in self._pg_cache
+            if missed:
+                self._create_missed_pg_by_ref(port_group)
+
+            with self._pg_cache_lock:
+                free_port_infos = self._pg_cache.get(pg_name, {}).setdefault(
+                    'free_port_infos', [])
+            port_infos.extend(self._lookup_unbound_ports_on_demand(
+                pg_name, port_group, count - len(port_infos)))
+        if len(free_port_infos) < CONF.DVS.free_ports_low_water_mark:
+            self._replenish_event.set()
+        return port_infos
+
+    def _return_unbound_ports(self, pg, port_infos):
+        """Put the ports of a failed booking back into the free ports.
+
+        They stay blocked, and are read again before they are booked.
+        """
+        pg_name = self._get_pg_name_by_key(pg.value)
+        with self._pg_cache_lock:
+            free_port_infos = self._pg_cache.get(pg_name, {}).get(
+                'free_port_infos')
+            if free_port_infos is not None:
+                room = max(CONF.DVS.cache_free_ports_size -
+                           len(free_port_infos), 0)
+                free_port_infos.extend(port_infos[:room])
+                port_infos = port_infos[room:]
+        super(DVSControllerWithCache, self)._return_unbound_ports(
+            pg, port_infos)
+
+    def _lookup_unbound_ports_on_demand(self, pg_name, port_group, count):
+        with self._pg_cache_lock:
+            refill = not self._pg_cache.get(pg_name, {}).get(
+                'free_cached_ports')
+        if refill and not self._refill_free_cached_ports(pg_name,
+                                                         port_group):
+            return []
+
+        port_infos = []
+        while len(port_infos) < count:
+            port_keys = []
+            with self._pg_cache_lock:
+                pg_cache_item = self._pg_cache.get(pg_name)
+                if not pg_cache_item or (
+                        pg_cache_item['free_ports_count'] <= 0):
+                    break
+                free_cached_ports = pg_cache_item.get('free_cached_ports')
+                while (free_cached_ports and
+                       len(port_keys) < count - len(port_infos)):
+                    port_key = free_cached_ports.pop()
+                    pg_cache_item['free_ports_count'] -= 1
+                    if port_key not in self._blocked_ports:
+                        port_keys.append(port_key)
+                free_ports_count = pg_cache_item['free_ports_count']
+            if port_keys:
+                port_infos.extend(self._get_unbound_port_infos(port_keys))
             # free cached ports is ended, but free pg keys exist on vSphere,
             # refill free_cached_ports in pg_cache
-            if self._pg_cache[pg_name]['free_ports_count'] > 0:
-                self._refill_free_cached_ports(pg_name, port_group)
-        raise exceptions.UnboundPortNotFound()
+            elif free_ports_count > 0:
+                if not self._refill_free_cached_ports(pg_name, port_group):
+                    break
+            else:
+                break
+        return port_infos
 
 
-def create_network_map_from_config(config, pg_cache=False):
+def create_network_map_from_config(config, pg_cache=False,
+                                   port_index=False, task_tracker=False):
     """Creates physical network to dvs map from config"""
     connection = None
     while not connection:
@@ -676,10 +1253,18 @@ def create_network_map_from_config(config, pg_cache=False):
             sleep(10)
     network_map = {}
     controller_class = DVSControllerWithCache if pg_cache else DVSController
+    tracker = None
+    if task_tracker:
+        # Tasks of all switches are tracked with one update stream.
+        tracker = dvs_task_tracker.TaskTracker(connection)
+        tracker.start()
     for pair in config.network_maps:
         network, dvs = pair.split(':')
         network_map[network] = controller_class(dvs, config.cluster_name,
                                                 connection)
+        network_map[network].task_tracker = tracker
+        if port_index:
+            network_map[network].start_port_index()
     return network_map
 
 
@@ -722,6 +1307,69 @@ def create_port_map(dvs_list):
     return port_map
 
 
+class DVSRoutingTable(object):
+    """Maps DVS uuids, network ids and port group names to controllers.
+
+    The table is loaded from the port groups of the switches and kept
+    current by the controllers on port group creation and deletion.
+    Networks missing from it are looked up on the switches once.
+    """
+
+    def __init__(self, controllers):
+        self._controllers = list(controllers)
+        self._lock = threading.Lock()
+        self._by_uuid = {}
+        self._by_pg_name = {}
+        self._by_network_id = {}
+        for controller in self._controllers:
+            controller.routing_table = self
+            self._by_uuid[controller._dvs_uuid] = controller
+            try:
+                for pg_name in controller._get_port_group_names():
+                    self.add_port_group(controller, pg_name)
+            except Exception:
+                LOG.exception(_LE("Unable to load networks of DVS %s, they "
+                                  "are looked up on demand."),
+                              controller.dvs_name)
+
+    def add_port_group(self, controller, pg_name):
+        with self._lock:
+            self._by_pg_name[pg_name] = controller
+            network_id = self._get_network_id(controller, pg_name)
+            if network_id:
+                self._by_network_id[network_id] = controller
+
+    def remove_port_group(self, controller, pg_name):
+        with self._lock:
+            if self._by_pg_name.get(pg_name) is controller:
+                del self._by_pg_name[pg_name]
+            network_id = self._get_network_id(controller, pg_name)
+            if self._by_network_id.get(network_id) is controller:
+                del self._by_network_id[network_id]
+
+    @staticmethod
+    def _get_network_id(controller, pg_name):
+        if pg_name.startswith(controller.dvs_name):
+            return pg_name[len(controller.dvs_name):]
+
+    def get_dvs_by_uuid(self, uuid):
+        return self._by_uuid.get(uuid)
+
+    def get_dvs_by_network(self, network_id, network_name=None):
+        with self._lock:
+            if network_name:
+                dvs = self._by_pg_name.get(network_name)
+            else:
+                dvs = self._by_network_id.get(network_id)
+        if dvs is None:
+            dvs = get_dvs_by_network(self._controllers, network_id,
+                                     network_name)
+            if dvs is not None:
+                self.add_port_group(
+                    dvs, network_name or dvs._get_net_name({'id': network_id}))
+        return dvs
+
+
 def get_dvs_by_uuid(dvs_list, uuid):
     for dvs in dvs_list:
         if dvs._dvs_uuid == uuid:
@@ -732,9 +1380,8 @@ def get_dvs_by_uuid(dvs_list, uuid):
 def get_dvs_by_network(dvs_list, network_id, network_name=None):
     for dvs in dvs_list:
         try:
-            if not network_name:
-                network_name = dvs._get_net_name({'id': network_id})
-            if dvs._get_pg_by_name(network_name):
+            pg_name = network_name or dvs._get_net_name({'id': network_id})
+            if dvs._get_pg_by_name(pg_name):
                 return dvs
         except exceptions.PortGroupNotFound:
             continue
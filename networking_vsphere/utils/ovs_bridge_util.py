@@ -15,14 +15,23 @@
 
 from oslo_log import log
 
+from neutron.agent.common import ovs_lib
+from neutron.agent.common import utils
 from neutron.plugins.common import constants as p_const
 from neutron.plugins.ml2.drivers.openvswitch.agent.common import constants as ovs_const  # noqa
 from neutron.plugins.ml2.drivers.openvswitch.agent.openflow.ovs_ofctl import br_int  # noqa
 from neutron.plugins.ml2.drivers.openvswitch.agent.openflow.ovs_ofctl import br_phys  # noqa
 from neutron.plugins.ml2.drivers.openvswitch.agent.openflow.ovs_ofctl import br_tun  # noqa
 
+from networking_vsphere._i18n import _LW
+
 LOG = log.getLogger(__name__)
 
+# Flow mod commands understood in an add-flows file.
+BUNDLE_COMMANDS = {'add': 'add',
+                   'mod': 'modify',
+                   'del': 'delete'}
+
 
 class OVSvAppIntegrationBridge(br_int.OVSIntegrationBridge):
 
@@ -109,3 +118,63 @@ class OVSvAppTunnelBridge(br_tun.OVSTunnelBridge):
             table=ovs_const.TUN_TABLE[p_const.TYPE_VXLAN],
             tun_id=segmentation_id)
         self.delete_flows(dl_vlan=vlan)
+
+
+class OVSvAppSecurityBridge(ovs_lib.OVSBridge):
+    """Security bridge applying deferred flow changes atomically.
+
+    The flow changes of a deferred bridge are committed as one OpenFlow
+    bundle, so that a port never goes without its rules while they are
+    replaced, and a whole batch of changes costs a single ovs-ofctl run.
+    If Open vSwitch rejects the bundle, the changes are applied the usual
+    way, one ovs-ofctl run per action, from then on.
+    """
+
+    def __init__(self, br_name, *args, **kwargs):
+        super(OVSvAppSecurityBridge, self).__init__(br_name, *args, **kwargs)
+        self.use_bundle = True
+
+    def deferred(self, **kwargs):
+        return BundledDeferredOVSBridge(self, **kwargs)
+
+    def bundle_flows(self, action_flow_tuples):
+        """Apply (action, flow) tuples in one atomic transaction.
+
+        :raises RuntimeError: if the bundle was rejected, in which case
+                              none of the changes were applied.
+        """
+        lines = []
+        for action, flow in action_flow_tuples:
+            flow = dict(flow)
+            if action != 'del' and 'cookie' not in flow:
+                flow['cookie'] = self._default_cookie
+            lines.append("%s %s" % (BUNDLE_COMMANDS[action],
+                                    ovs_lib._build_flow_expr_str(flow,
+                                                                 action)))
+        utils.execute(["ovs-ofctl", "--bundle", "add-flows", self.br_name,
+                       "-"], run_as_root=True,
+                      process_input="\n".join(lines))
+
+
+class BundledDeferredOVSBridge(ovs_lib.DeferredOVSBridge):
+    """Deferred bridge committing its flow changes as one bundle."""
+
+    def apply_flows(self):
+        action_flow_tuples = self.action_flow_tuples
+        if not action_flow_tuples or not self.br.use_bundle:
+            return super(BundledDeferredOVSBridge, self).apply_flows()
+        if not self.full_ordered:
+            weights = dict((action, weight)
+                           for weight, action in enumerate(self.order))
+            action_flow_tuples = sorted(action_flow_tuples,
+                                        key=lambda af: weights[af[0]])
+        try:
+            self.br.bundle_flows(action_flow_tuples)
+        except RuntimeError as e:
+            LOG.warning(_LW("Unable to commit flows on %(bridge)s as a "
+                            "bundle, applying them without bundles from now "
+                            "on: %(error)s"),
+                        {'bridge': self.br.br_name, 'error': e})
+            self.br.use_bundle = False
+            return super(BundledDeferredOVSBridge, self).apply_flows()
+        self.action_flow_tuples = []
@@ -21,25 +21,38 @@ def update_rules(devices_rules_info):
     sg_members = devices_rules_info['sg_member_ips']
     devices = devices_rules_info['devices']
     result = copy.copy(devices)
+    # (security group, rule index) -> [(member ip, rule)], the remote group
+    # rules are expanded once for all devices using the security group.
+    expanded_rules = {}
     for device, device_info in devices.items():
-        device_ips = device_info['fixed_ips']
+        device_ips = set(device_info['fixed_ips'])
         for sg in device_info['security_groups']:
-            for sg_rule in devices_rules_info['security_groups'][sg]:
+            sg_rules = devices_rules_info['security_groups'][sg]
+            for i, sg_rule in enumerate(sg_rules):
                 if 'remote_group_id' in sg_rule:
+                    rules = expanded_rules.get((sg, i))
+                    if rules is None:
+                        rules = expand_rule_from_sg(sg_rule, sg_members)
+                        expanded_rules[(sg, i)] = rules
                     result[device]['security_group_rules'].extend(
-                        build_rules_from_sg(sg_rule, sg_members, device_ips))
+                        rule for ip, rule in rules if ip not in device_ips)
                 else:
                     result[device]['security_group_rules'].append(sg_rule)
     return result
 
 
 def build_rules_from_sg(rule, sg_members, device_ips):
+    return [r for ip, r in expand_rule_from_sg(rule, sg_members)
+            if ip not in device_ips]
+
+
+def expand_rule_from_sg(rule, sg_members):
+    """Return (member ip, rule) of each member of the remote group."""
     rules = []
+    direction_ip_prefix = 'source_ip_prefix' \
+        if rule['direction'] == 'ingress' else 'dest_ip_prefix'
     for ip in sg_members[rule['remote_group_id']][rule['ethertype']]:
-        if ip not in device_ips:
-            r_builder = copy.copy(rule)
-            direction_ip_prefix = 'source_ip_prefix' \
-                if rule['direction'] == 'ingress' else 'dest_ip_prefix'
-            r_builder[direction_ip_prefix] = str(netaddr.IPNetwork(ip).cidr)
-            rules.append(r_builder)
+        r_builder = copy.copy(rule)
+        r_builder[direction_ip_prefix] = str(netaddr.IPNetwork(ip).cidr)
+        rules.append((ip, r_builder))
     return rules
@@ -14,9 +14,12 @@
 #    under the License.
 
 import abc
+import collections
 import copy
+import hashlib
 import netaddr
 import six
+import threading
 
 from oslo_log import log
 from oslo_vmware import exceptions as vmware_exceptions
@@ -42,6 +45,52 @@ HASHED_RULE_INFO_KEYS = [
     'source_port_range_max'
 ]
 
+# Bounds of the compiled rule caches shared by all update_port_rules calls.
+BUILT_RULES_CACHE_SIZE = 4096
+FILTER_POLICIES_CACHE_SIZE = 1024
+
+
+class BuiltSpecsCache(object):
+    """Bounded LRU of built specs, dropping the least recently used."""
+
+    def __init__(self, size):
+        self.size = size
+        self._specs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            spec = self._specs.pop(key, None)
+            if spec is not None:
+                self._specs[key] = spec
+            return spec
+
+    def put(self, key, spec):
+        with self._lock:
+            self._specs.pop(key, None)
+            self._specs[key] = spec
+            while len(self._specs) > self.size:
+                self._specs.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._specs.clear()
+
+    def __len__(self):
+        return len(self._specs)
+
+
+# The built specs are keyed by the factory which created them too, as each
+# vCenter connection has its own.
+# (factory, rule key) -> (built rule, built reverse rule), sequence and
+# description are set on copies for each use.
+_built_rules = BuiltSpecsCache(BUILT_RULES_CACHE_SIZE)
+# (factory, rule keys of a port) -> filter policy, a copy is attached to
+# each port with the same rules.
+_filter_policies = BuiltSpecsCache(FILTER_POLICIES_CACHE_SIZE)
+# rule keys of a port -> the compacted rules of the port, copied for each use.
+_compacted_rules = BuiltSpecsCache(FILTER_POLICIES_CACHE_SIZE)
+
 
 class PortConfigSpecBuilder(spec_builder.SpecBuilder):
     def __init__(self, spec_factory):
@@ -231,16 +280,43 @@ def filter_port_sg_rules_by_ethertype(port_info):
 
 @dvs_util.wrap_retry
 def update_port_rules(dvs, ports):
+    """Apply the rules of the ports, skipping ports already up to date.
+
+    The rules are compacted with compact_rules first. The fingerprint of the
+    rules applied to each DVS port is kept by the controller, ports whose
+    rules did not change since are left out of the ReconfigureDVPort_Task,
+    unless the port is flagged with reset_rules because its configuration
+    was reset on the DVS. The fingerprints of all the ports are forgotten
+    when the update fails.
+    """
+    applied = {}
+    port_keys = []
+    rules_count = compacted_count = 0
     try:
         builder = PortConfigSpecBuilder(dvs.connection.vim.client.factory)
         port_config_list = []
-        hashed_rules = {}
         for port in ports:
             key = port.get('binding:vif_details', {}).get('dvs_port_key')
             if key:
-                port_config = port_configuration(
-                    builder, key, port['security_group_rules'], hashed_rules)
+                port_keys.append(key)
+                sg_rules = compact_rules(port['security_group_rules'])
+                rules_count += len(port['security_group_rules'])
+                compacted_count += len(sg_rules)
+                fingerprint = get_rules_fingerprint(sg_rules)
+                if (not port.get('reset_rules') and
+                        dvs.rules_applied(key, port['id'], fingerprint)):
+                    continue
+                # The port key moved to another port or the rules changed,
+                # forget them until the new ones are applied.
+                dvs.forget_applied_rules([key])
+                applied[key] = (port['id'], fingerprint)
+                port_config = port_configuration(builder, key, sg_rules)
                 port_config_list.append(port_config)
+        if rules_count != compacted_count:
+            LOG.debug("Compacted %(rules)d security group rules of ports "
+                      "%(ports)s to %(compacted)d.",
+                      {'rules': rules_count, 'compacted': compacted_count,
+                       'ports': [port['id'] for port in ports]})
         if port_config_list:
             task = dvs.connection.invoke_api(
                 dvs.connection.vim,
@@ -248,36 +324,68 @@ def update_port_rules(dvs, ports):
                 dvs._dvs,
                 port=port_config_list
             )
-            dvs.connection.wait_for_task(task)
+            dvs._wait_for_task(task)
+            dvs.set_applied_rules(applied)
+        else:
+            LOG.debug("Rules of ports %s are up to date.",
+                      [port['id'] for port in ports])
     except vmware_exceptions.VimException as e:
+        # Some ports may have been reconfigured by someone else.
+        dvs.forget_applied_rules(port_keys)
         if 'The object or item referred to could not be found' in str(e):
             pass
         else:
             raise exceptions.wrap_wmvare_vim_exception(e)
+    except vmware_exceptions.VMwareDriverException:
+        # Faults of the task, like a concurrent modification retried by
+        # wrap_retry.
+        dvs.forget_applied_rules(port_keys)
+        raise
+
+
+def get_rules_fingerprint(sg_rules):
+    """Fingerprint of the traffic rules port_configuration builds."""
+    rule_keys = '|'.join(','.join(six.text_type(value) for value in rule_key)
+                         for rule_key in _get_rule_keys(sg_rules))
+    return hashlib.sha1(rule_keys.encode('utf-8')).hexdigest()
+
+
+def port_configuration(builder, port_key, sg_rules):
+    rule_keys = _get_rule_keys(sg_rules)
+    policy_key = (builder.factory, rule_keys)
+    filter_policy = _filter_policies.get(policy_key)
+    if filter_policy is None:
+        filter_policy = _build_filter_policy(builder, sg_rules, rule_keys)
+        _filter_policies.put(policy_key, filter_policy)
+    setting = builder.port_setting()
+    setting.filterPolicy = copy.copy(filter_policy)
+    spec = builder.port_config_spec(setting=setting)
+    spec.key = port_key
+    return spec
 
 
-def port_configuration(builder, port_key, sg_rules, hashed_rules):
+def _build_filter_policy(builder, sg_rules, rule_keys):
     rules = []
     seq = 0
     reverse_seq = len(sg_rules) * 10
-    for rule_info in sg_rules:
-        rule_hash = _get_rule_hash(rule_info)
-        if rule_hash in hashed_rules:
-            rule, reverse_rule = hashed_rules[rule_hash]
-            built_rule = copy.copy(rule)
-            built_reverse_rule = copy.copy(reverse_rule)
-            built_rule.description = str(seq) + '. regular'
-            built_rule.sequence = seq
-            built_reverse_rule.description = '%s. reversed %s' % (
-                str(reverse_seq), built_rule.description)
-            built_reverse_rule.sequence = reverse_seq
-        else:
+    for rule_info, rule_key in zip(sg_rules, rule_keys):
+        built = _built_rules.get((builder.factory, rule_key))
+        if built is None:
             rule = _create_rule(builder, rule_info, name='regular')
             built_rule = rule.build(seq)
             cidr_revert = not _rule_excepted(rule)
             reverse_rule = rule.reverse(cidr_revert)
             built_reverse_rule = reverse_rule.build(reverse_seq)
-            hashed_rules[rule_hash] = (built_rule, built_reverse_rule)
+            built = (built_rule, built_reverse_rule)
+            _built_rules.put((builder.factory, rule_key), built)
+
+        built_rule = copy.copy(built[0])
+        built_reverse_rule = copy.copy(built[1])
+        built_rule.description = str(seq) + '. regular'
+        built_rule.sequence = seq
+        built_reverse_rule.description = '%s. reversed %s' % (
+            str(reverse_seq), built_rule.description)
+        built_reverse_rule.sequence = reverse_seq
 
         rules.extend([built_rule, built_reverse_rule])
         seq += 10
@@ -291,12 +399,7 @@ def port_configuration(builder, port_key, sg_rules, hashed_rules):
     rules.append(DropAllRule(builder, 'IPv6', None,
                              name='drop all').build(seq))
 
-    filter_policy = builder.filter_policy(rules)
-    setting = builder.port_setting()
-    setting.filterPolicy = filter_policy
-    spec = builder.port_config_spec(setting=setting)
-    spec.key = port_key
-    return spec
+    return builder.filter_policy(rules)
 
 
 def _rule_excepted(rule):
@@ -310,12 +413,200 @@ def _rule_excepted(rule):
     return False
 
 
-def _get_rule_hash(rule):
-    rule_tokens = []
-    for k in sorted(rule):
-        if k in HASHED_RULE_INFO_KEYS:
-            rule_tokens.append('%s:%s' % (k, rule[k]))
-    return ','.join(rule_tokens)
+def _get_rule_key(rule, exclude=()):
+    return tuple(rule.get(k) for k in HASHED_RULE_INFO_KEYS
+                 if k not in exclude)
+
+
+def _get_rule_keys(sg_rules):
+    return tuple(_get_rule_key(rule) for rule in sg_rules)
+
+
+def compact_rules(sg_rules):
+    """Return rules allowing the same traffic with fewer DVS rules.
+
+    Adjacent or overlapping CIDRs of otherwise equal rules are merged,
+    port ranges of otherwise equal tcp and udp rules are folded together
+    and rules covered by a broader rule are dropped. DVS rules only accept
+    traffic until the final drop all rules, so their order does not matter.
+    """
+    rule_keys = _get_rule_keys(sg_rules)
+    compacted = _compacted_rules.get(rule_keys)
+    if compacted is None:
+        compacted = [dict(rule) for rule in _compact_rules(sg_rules)]
+        _compacted_rules.put(rule_keys, compacted)
+    return [dict(rule) for rule in compacted]
+
+
+def _compact_rules(sg_rules):
+    kept = []
+    rules = []
+    seen = set()
+    for rule in sg_rules:
+        rule_key = _get_rule_key(rule)
+        if rule_key in seen:
+            continue
+        seen.add(rule_key)
+        # Reverse rules of these are not built from the rule itself.
+        if _is_special_rule(rule):
+            kept.append(rule)
+        else:
+            rules.append(rule)
+
+    while True:
+        count = len(rules)
+        rules = _fold_port_ranges(_merge_cidrs(rules))
+        if len(rules) == count:
+            break
+    return kept + _drop_covered_rules(rules)
+
+
+def _is_special_rule(rule):
+    if rule.get('protocol') == 'udp' and rule['direction'] == 'ingress':
+        ports = (rule.get('port_range_min'), rule.get('port_range_max'),
+                 rule.get('source_port_range_min'),
+                 rule.get('source_port_range_max'))
+        if (rule['ethertype'] == 'IPv4' and ports == (68, 68, 67, 67) or
+                rule['ethertype'] == 'IPv6' and
+                ports == (546, 546, 547, 547)):
+            return True
+    return (rule['ethertype'] == 'IPv6' and
+            rule.get('protocol') == 'ipv6-icmp' and
+            rule.get('source_port_range_min') == 134)
+
+
+def _get_cidr_key(rule):
+    if rule['direction'] == 'ingress':
+        return 'source_ip_prefix'
+    return 'dest_ip_prefix'
+
+
+def _group_rules(rules, exclude):
+    groups = collections.OrderedDict()
+    for rule in rules:
+        groups.setdefault(_get_rule_key(rule, exclude), []).append(rule)
+    return groups.values()
+
+
+def _merge_cidrs(rules):
+    result = []
+    for cidr_key in ('source_ip_prefix', 'dest_ip_prefix'):
+        cidr_rules = [rule for rule in rules
+                      if _get_cidr_key(rule) == cidr_key]
+        for group in _group_rules(cidr_rules, (cidr_key,)):
+            any_ip = [rule for rule in group if not rule.get(cidr_key)]
+            if any_ip:
+                result.append(any_ip[0])
+                continue
+            cidrs = netaddr.cidr_merge(
+                [netaddr.IPNetwork(rule[cidr_key]) for rule in group])
+            if len(cidrs) == len(group):
+                result.extend(group)
+                continue
+            for cidr in cidrs:
+                rule = copy.copy(group[0])
+                rule[cidr_key] = str(cidr)
+                result.append(rule)
+    return result
+
+
+def _fold_port_ranges(rules):
+    result = []
+    port_rules = []
+    for rule in rules:
+        if rule.get('protocol') in ('tcp', 'udp'):
+            port_rules.append(rule)
+        else:
+            result.append(rule)
+    for group in _group_rules(port_rules,
+                              ('port_range_min', 'port_range_max')):
+        any_port = [rule for rule in group if not rule.get('port_range_min')]
+        if any_port:
+            result.append(any_port[0])
+            continue
+        ranges = []
+        for port_min, port_max in sorted(
+                (rule['port_range_min'], rule['port_range_max'])
+                for rule in group):
+            if ranges and port_min <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], port_max)
+            else:
+                ranges.append([port_min, port_max])
+        if len(ranges) == len(group):
+            result.extend(group)
+            continue
+        for port_min, port_max in ranges:
+            rule = copy.copy(group[0])
+            rule['port_range_min'] = port_min
+            rule['port_range_max'] = port_max
+            result.append(rule)
+    return result
+
+
+def _drop_covered_rules(rules):
+    result = []
+    for i, rule in enumerate(rules):
+        for j, other in enumerate(rules):
+            # Of rules covering each other, the first one is kept.
+            if (i != j and _rule_covers(other, rule) and
+                    (j < i or not _rule_covers(rule, other))):
+                break
+        else:
+            result.append(rule)
+    return result
+
+
+def _cidr_covers(cidr, other_cidr):
+    if not cidr:
+        return True
+    if not other_cidr:
+        return False
+    return netaddr.IPNetwork(other_cidr) in netaddr.IPNetwork(cidr)
+
+
+def _range_covers(range_, other_range):
+    if range_[0] is None:
+        return True
+    if other_range[0] is None:
+        return False
+    return range_[0] <= other_range[0] and other_range[1] <= range_[1]
+
+
+def _rule_covers(rule, other):
+    """Whether rule and its reverse rule accept all traffic of other."""
+    if (rule['direction'] != other['direction'] or
+            rule['ethertype'] != other['ethertype']):
+        return False
+    cidr_key = _get_cidr_key(rule)
+    if not _cidr_covers(rule.get(cidr_key), other.get(cidr_key)):
+        return False
+    # The prefix of the other end is not used by the rules, equal ones only.
+    unused_key = ('dest_ip_prefix' if cidr_key == 'source_ip_prefix'
+                  else 'source_ip_prefix')
+    if rule.get(unused_key) != other.get(unused_key):
+        return False
+
+    protocol = rule.get('protocol')
+    if protocol is None:
+        return True
+    if protocol != other.get('protocol'):
+        return False
+    if protocol in ('tcp', 'udp'):
+        def source_range(rule_info):
+            return (rule_info.get('source_port_range_min') or
+                    dvs_const.MIN_EPHEMERAL_PORT,
+                    rule_info.get('source_port_range_max') or
+                    dvs_const.MAX_EPHEMERAL_PORT)
+        return (_range_covers(
+            (rule.get('port_range_min'), rule.get('port_range_max')),
+            (other.get('port_range_min'), other.get('port_range_max'))) and
+            _range_covers(source_range(rule), source_range(other)))
+    if protocol in ('icmp', 'ipv6-icmp'):
+        return rule.get('source_port_range_min') in (
+            None, other.get('source_port_range_min'))
+    return all(rule.get(k) == other.get(k)
+               for k in ('port_range_min', 'port_range_max',
+                         'source_port_range_min', 'source_port_range_max'))
 
 
 def _create_rule(builder, rule_info, ip=None, name=None):